@@ -4,6 +4,7 @@
 """
 import os
 import json
+import math
 import re
 import asyncio
 import threading
@@ -11,8 +12,10 @@ import time
 import csv
 import io
 import uuid
+import queue
+import weakref
 from threading import Lock
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from typing import Optional, List
 from urllib.parse import unquote, quote
@@ -21,6 +24,7 @@ from typing import Dict, Set
 # 尝试导入openpyxl，如果没有则使用CSV
 try:
     from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
     from openpyxl.styles import Font, Alignment
     from openpyxl.utils import get_column_letter
     from openpyxl.styles.numbers import FORMAT_DATE_DATETIME  # pyright: ignore[reportMissingModuleSource]
@@ -30,7 +34,9 @@ except ImportError:
     print("⚠️ openpyxl未安装，将使用CSV格式导出。要使用XLSX格式，请运行: pip install openpyxl")
 from fastapi import FastAPI, HTTPException, BackgroundTasks, WebSocket, WebSocketDisconnect, Header, Depends, Request, UploadFile, File, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response, StreamingResponse, JSONResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 from typing import Optional
@@ -40,8 +46,19 @@ from contextlib import asynccontextmanager
 load_dotenv()
 
 # 导入邮件工具
-from src.tools.QQEmailTools import QQEmailToolsClass
+from src.tools.QQEmailTools import QQEmailToolsClass, flush_all_mark_as_read, close_all_smtp_pools
 from src.tools.EmailUrgencyDetector import analyze_email_urgency
+from src.user_store import get_user_store, close_all_user_stores
+from src.email_collection import EmailCollection, make_email_record
+from src.history_index import HistoryCollection, HistoryQuery
+from src.history_archive import get_history_archive, query_tiered, iter_tiered
+from src.stats_rollup import StatsRollup
+from src.change_log import ChangeLog
+from src.scheduler import TimerScheduler
+from src.send_queue import SendQueue, SlidingWindowLimiter
+from src.cancellation import CancellationToken, run_cancellable, cancellation_metrics
+from src.work_scheduler import FairShareScheduler
+from src.deadlines import ResponseSLO, response_deadline
 
 # 保存主事件循环引用，在线程中使用 run_coroutine_threadsafe 推送
 websocket_event_loop: Optional[asyncio.AbstractEventLoop] = None
@@ -53,7 +70,7 @@ async def lifespan(app: FastAPI):
     global websocket_event_loop
     try:
         websocket_event_loop = asyncio.get_event_loop()
-       
+        notification_bus.start(websocket_event_loop)
     except Exception as e:
         print(f"⚠️ [WS] 无法保存事件循环: {e}")
     
@@ -61,6 +78,34 @@ async def lifespan(app: FastAPI):
     
     # Shutdown (如果需要清理资源，可以在这里添加)
     print("🔄 [应用] 正在关闭...")
+    try:
+        await notification_bus.stop()
+    except Exception as e:
+        print(f"⚠️ [应用] 停止通知总线失败: {e}")
+    try:
+        flush_all_mark_as_read()
+    except Exception as e:
+        print(f"⚠️ [应用] 提交待标记已读邮件失败: {e}")
+    try:
+        close_all_smtp_pools()
+    except Exception as e:
+        print(f"⚠️ [应用] 关闭SMTP连接失败: {e}")
+    try:
+        timer_scheduler.shutdown()
+    except Exception as e:
+        print(f"⚠️ [应用] 停止定时调度失败: {e}")
+    try:
+        pipeline_scheduler.shutdown()
+    except Exception as e:
+        print(f"⚠️ [应用] 停止邮件处理调度失败: {e}")
+    try:
+        email_data_persister.shutdown()
+    except Exception as e:
+        print(f"⚠️ [应用] 写入待保存的用户数据失败: {e}")
+    try:
+        close_all_user_stores()
+    except Exception as e:
+        print(f"⚠️ [应用] 关闭用户数据库失败: {e}")
 
 app = FastAPI(
     title="邮件自动化系统 API",
@@ -78,80 +123,62 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 响应压缩：超过 1KB 的响应在客户端支持时使用 gzip
+app.add_middleware(GZipMiddleware, minimum_size=1024)
+
 # ==================== 线程池管理 ====================
 
 # 主线程池：用于常规操作（邮件获取、索引构建等）
 # 固定大小，确保其他API请求不受影响
 thread_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="email_processor")
 
-# 单封邮件处理线程池：专门用于单封邮件处理，独立于主线程池
-# 根据用户设置的 singleEmailConcurrency 动态调整
-# 避免单封邮件处理占用主线程池，影响其他API请求
-single_email_thread_pool = None
-single_email_thread_pool_lock = Lock()
+# 邮件处理调度器：自动处理、处理全部和单封处理共用固定数量的工作线程，
+# 每个用户的并发数由 batchSize / singleEmailConcurrency 限制，各用户轮流获得空闲线程
+# 工作线程总数，默认按CPU核数估算（处理时间主要花在等待模型接口上），可通过环境变量 PIPELINE_WORKERS 覆盖
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", str(max(4, min(32, (os.cpu_count() or 1) * 4)))))
+# 单个用户不能占用、留给其他用户的线程数，默认为总数的四分之一
+PIPELINE_RESERVED_WORKERS = int(os.getenv("PIPELINE_RESERVED_WORKERS", str(PIPELINE_WORKERS // 4)))
+
+pipeline_scheduler = FairShareScheduler(
+    workers=PIPELINE_WORKERS,
+    reserved=PIPELINE_RESERVED_WORKERS,
+    name="email_pipeline"
+)
 
-def get_or_create_single_email_thread_pool(concurrency: int = 4):
+def run_pipeline_tasks(username: str, kind: str, items, worker, cap: int, on_done=None, priority=None) -> int:
     """
-    获取或创建单封邮件处理专用的线程池
-    这个线程池独立于主线程池，不会影响其他API请求
+    把一组邮件处理任务交给处理调度器，并按完成顺序处理结果
     
-    线程池大小应该 >= concurrency，但不超过20（避免资源耗尽）
-    """
-    global single_email_thread_pool
-    with single_email_thread_pool_lock:
-        # 计算需要的线程数：concurrency + 1（预留一些线程）
-        required_workers = min(max(concurrency, 2), 20)  # 最小2，最大20
-        
-        # 如果还没有创建，或者当前线程池大小不够，创建新的线程池
-        if single_email_thread_pool is None or single_email_thread_pool._max_workers < required_workers:
-            if single_email_thread_pool is not None:
-                print(f"🔄 [单封邮件线程池] 调整线程池大小: {single_email_thread_pool._max_workers} -> {required_workers} (concurrency={concurrency})")
-                # 关闭旧线程池（不等待，因为新任务会使用新线程池）
-                single_email_thread_pool.shutdown(wait=False)
-            else:
-                print(f"🔄 [单封邮件线程池] 创建单封邮件处理线程池: {required_workers} 个工作线程 (concurrency={concurrency})")
-            
-            # 创建新线程池
-            single_email_thread_pool = ThreadPoolExecutor(
-                max_workers=required_workers, 
-                thread_name_prefix="single_email_processor"
-            )
-        
-        return single_email_thread_pool
-
-# 批量处理线程池：专门用于批量邮件处理，根据用户设置的 batchSize 动态调整
-# 独立线程池，不会影响其他操作
-batch_thread_pool = None
-batch_thread_pool_lock = Lock()
-
-def get_or_create_batch_thread_pool(batch_size: int = 4):
-    """
-    获取或创建批量处理专用的线程池
-    这个线程池独立于主线程池，不会影响其他API请求
+    调度器保证该用户同时执行的任务不超过 cap，任意一个完成立即开始下一个，
+    同时与其他用户公平地分享工作线程。
     
-    线程池大小应该 >= batch_size，但不超过30（避免资源耗尽）
+    @param username: 用户名
+    @param kind: 任务类型（'batch' 批量/自动处理，'single' 单封处理），每类单独限制并发
+    @param items: 待处理项
+    @param worker: worker(item)，在调度器的工作线程中执行
+    @param cap: 该用户同时执行的任务数上限
+    @param on_done: on_done(item, future, done_count, total, in_flight)，在调用线程中按完成顺序调用
+    @param priority: priority(item) -> 数值，越小越先执行（如回复截止时间）；None 表示按顺序排队
+    @return: 完成的任务数
     """
-    global batch_thread_pool
-    with batch_thread_pool_lock:
-        # 计算需要的线程数：batch_size + 2（预留一些线程）
-        required_workers = min(max(batch_size, 4), 30)  # 最小4，最大30
-        
-        # 如果还没有创建，或者当前线程池大小不够，创建新的线程池
-        if batch_thread_pool is None or batch_thread_pool._max_workers < required_workers:
-            if batch_thread_pool is not None:
-                print(f"🔄 [批量线程池] 调整线程池大小: {batch_thread_pool._max_workers} -> {required_workers} (batch_size={batch_size})")
-                # 关闭旧线程池（不等待，因为新任务会使用新线程池）
-                batch_thread_pool.shutdown(wait=False)
-            else:
-                print(f"🔄 [批量线程池] 创建批量处理线程池: {required_workers} 个工作线程 (batch_size={batch_size})")
-            
-            # 创建新线程池
-            batch_thread_pool = ThreadPoolExecutor(
-                max_workers=required_workers, 
-                thread_name_prefix="batch_email_processor"
-            )
-        
-        return batch_thread_pool
+    from concurrent.futures import wait, FIRST_COMPLETED
+    items = list(items)
+    total = len(items)
+    remaining = {
+        pipeline_scheduler.submit(username, kind, worker, item, cap=cap,
+                                  priority=priority(item) if priority else None): item
+        for item in items
+    }
+    done_count = 0
+    while remaining:
+        finished, _ = wait(remaining, return_when=FIRST_COMPLETED)
+        for future in finished:
+            item = remaining.pop(future)
+            done_count += 1
+            if on_done is not None:
+                in_flight = sum(1 for f in remaining if f.running())
+                on_done(item, future, done_count, total, in_flight)
+    return done_count
 
 # 摘要生成线程池：专门用于异步生成邮件摘要，避免阻塞其他操作
 # 固定大小，限制并发摘要生成的数量，防止资源耗尽
@@ -185,6 +212,9 @@ def clear_rag_cancel_flag(username: str):
     if username in rag_test_cancelled:
         rag_test_cancelled[username].clear()
 
+# 进行中的RAG测试的取消令牌（按用户存储），取消时立即中断模型调用
+rag_test_tokens: dict[str, CancellationToken] = {}
+
 # ==================== 发送速率控制 ====================
 
 # 发送速率控制配置
@@ -194,221 +224,215 @@ SEND_RATE_LIMIT = {
     "interval": 30         # 每封邮件之间至少间隔30秒（便于测试）
 }
 
-# 发送速率控制（按用户）
-send_rate_control = {}  # {username: {"last_send_time": timestamp, "send_count_hour": count, "send_count_half_hour": count, "reset_time_hour": timestamp, "reset_time_half_hour": timestamp}}
-send_rate_lock = Lock()
+# 滑动窗口限制：(上限, 窗口秒数)，任意连续窗口内的发送数不超过上限
+SEND_RATE_WINDOWS = [
+    (SEND_RATE_LIMIT["per_hour"], 3600),
+    (SEND_RATE_LIMIT["per_half_hour"], 1800),
+]
+# 窗口的显示名称
+SEND_RATE_WINDOW_NAMES = {3600: "每小时", 1800: "每半小时"}
+# 单封邮件发送失败后的最多尝试次数，超过后移出队列（保持已处理状态，可手动发送）
+SEND_RETRY_LIMIT = 3
+
+# 每个账户的待发送队列和速率限制器（按用户）
+send_queues: dict[str, SendQueue] = {}
+send_queues_lock = Lock()
+# 发送失败次数: {username: {邮件ID: 次数}}
+send_failures: dict[str, dict[str, int]] = {}
+
+
+def get_send_queue(username: str) -> SendQueue:
+    """获取用户的待发送队列（首次访问时从用户数据库恢复队列和最近的发送记录）"""
+    if username not in send_queues:
+        # 先加载用户状态：数据库文件需要由加载流程创建（或从旧的 JSON 文件迁移）
+        get_user_state(username, check_auto_start=False)
+    with send_queues_lock:
+        send_queue = send_queues.get(username)
+        if send_queue is None:
+            limiter = SlidingWindowLimiter(SEND_RATE_WINDOWS, SEND_RATE_LIMIT["interval"])
+            try:
+                store = get_user_store(get_user_email_db_file(username))
+            except Exception as e:
+                print(f"⚠️ [发送队列] 无法打开用户 {username} 的数据库，发送队列只保存在内存中: {e}")
+                store = None
+            send_queue = SendQueue(limiter, store)
+            send_queues[username] = send_queue
+            if len(send_queue):
+                print(f"📬 [发送队列] 已恢复用户 {username} 的待发送队列: {len(send_queue)} 封")
+        return send_queue
+
 
 def check_send_rate_limit(username: str) -> tuple[bool, str]:
     """
     检查是否达到发送速率限制
     返回 (是否可以发送, 提示信息)
     """
-    with send_rate_lock:
-        now = time.time()
-        
-        if username not in send_rate_control:
-            send_rate_control[username] = {
-                "last_send_time": 0,
-                "send_count_hour": 0,
-                "send_count_half_hour": 0,
-                "reset_time_hour": now + 3600,      # 1小时后重置
-                "reset_time_half_hour": now + 1800  # 30分钟后重置
-            }
-            print(f"✅ [速率限制] 用户 {username} 首次发送，允许发送")
-            return True, ""
-        
-        control = send_rate_control[username]
-        
-        # 检查每小时限制
-        if now > control["reset_time_hour"]:
-            control["send_count_hour"] = 0
-            control["reset_time_hour"] = now + 3600
-        
-        # 检查每半小时限制
-        if now > control["reset_time_half_hour"]:
-            control["send_count_half_hour"] = 0
-            control["reset_time_half_hour"] = now + 1800
-        
-        # 检查是否达到每小时限制
-        if control["send_count_hour"] >= SEND_RATE_LIMIT["per_hour"]:
-            remaining_time = control["reset_time_hour"] - now
-            remaining_minutes = int(remaining_time / 60)
-            msg = f"已达到每小时发送限制（{SEND_RATE_LIMIT['per_hour']}封），请等待 {remaining_minutes} 分钟后重试"
-            print(f"⏸️ [速率限制] 用户 {username}: {msg}")
-            return False, msg
-        
-        # 检查是否达到每半小时限制
-        if control["send_count_half_hour"] >= SEND_RATE_LIMIT["per_half_hour"]:
-            remaining_time = control["reset_time_half_hour"] - now
-            remaining_minutes = int(remaining_time / 60)
-            msg = f"已达到每半小时发送限制（{SEND_RATE_LIMIT['per_half_hour']}封），请等待 {remaining_minutes} 分钟后重试"
-            print(f"⏸️ [速率限制] 用户 {username}: {msg}")
-            return False, msg
-        
-        # 检查发送间隔（至少30秒）
-        # 注意：如果 last_send_time 为 0，说明是首次发送，允许发送
-        if control["last_send_time"] > 0:
-            time_since_last = now - control["last_send_time"]
-            print(f"🔍 [速率限制] 用户 {username} 距离上次发送: {int(time_since_last)} 秒 (需要间隔 {SEND_RATE_LIMIT['interval']} 秒)")
-            if time_since_last < SEND_RATE_LIMIT["interval"]:
-                wait_time = SEND_RATE_LIMIT["interval"] - time_since_last
-                wait_seconds = int(wait_time)
-                msg = f"发送间隔不足，请等待 {wait_seconds} 秒后重试（每封邮件需间隔30秒）"
-                print(f"⏸️ [速率限制] 用户 {username}: {msg}")
-                return False, msg
-            print(f"✅ [速率限制] 用户 {username} 检查通过，允许发送 (距离上次发送 {int(time_since_last)} 秒)")
-        else:
-            print(f"✅ [速率限制] 用户 {username} 首次发送，允许发送")
-        
+    wait, rule = get_send_queue(username).limiter.check()
+    if wait <= 0:
         return True, ""
+    if rule == 'interval':
+        msg = f"发送间隔不足，请等待 {math.ceil(wait)} 秒后重试（每封邮件需间隔{SEND_RATE_LIMIT['interval']}秒）"
+    else:
+        limit, seconds = rule
+        window_name = SEND_RATE_WINDOW_NAMES.get(seconds, f"每{int(seconds // 60)}分钟")
+        msg = f"已达到{window_name}发送限制（{limit}封），请等待 {math.ceil(wait / 60)} 分钟后重试"
+    print(f"⏸️ [速率限制] 用户 {username}: {msg}")
+    return False, msg
+
 
 def update_send_rate_limit(username: str):
-    """更新发送速率限制计数"""
-    with send_rate_lock:
-        now = time.time()
-        if username not in send_rate_control:
-            send_rate_control[username] = {
-                "last_send_time": now,
-                "send_count_hour": 1,
-                "send_count_half_hour": 1,
-                "reset_time_hour": now + 3600,
-                "reset_time_half_hour": now + 1800
-            }
-        else:
-            control = send_rate_control[username]
-            old_time = control["last_send_time"]
-            control["last_send_time"] = now
-            control["send_count_hour"] += 1
-            control["send_count_half_hour"] += 1
-            old_time_str = datetime.fromtimestamp(old_time).strftime('%H:%M:%S') if old_time > 0 else '首次'
-            print(f"📝 [速率限制] 用户 {username} 更新计数: {control['send_count_hour']}/20 (小时), {control['send_count_half_hour']}/10 (半小时), 上次发送: {old_time_str}, 当前时间: {datetime.fromtimestamp(now).strftime('%H:%M:%S')}")
-
-def send_processed_emails_with_rate_limit(username: str):
-    """
-    在后台发送所有已处理的邮件（受速率限制）
-    当用户开启自动发送并保存设置时调用
-    """
-    try:
-        print(f"📧 [自动发送] 开始检查用户 {username} 的已处理邮件...")
-        user_state = get_user_state(username, check_auto_start=False)
-        
-        # 使用用户锁保护数据读取（避免读取到不一致的数据）
-        user_lock = get_user_lock(username)
-        with user_lock:
-            # 调试：打印所有邮件的状态
-            print(f"🔍 [自动发送] 调试信息：缓存中共有 {len(user_state.emails_cache)} 封邮件")
-            for idx, email in enumerate(user_state.emails_cache):
-                status = email.get('status', '未知')
-                has_reply = bool(email.get('reply'))
-                subject = email.get('subject', '无主题')[:30]
-                print(f"  [{idx+1}] 状态: {status}, 有回复: {has_reply}, 主题: {subject}")
-            
-            # 查找所有已处理且有回复内容的邮件（复制一份，避免在锁外访问）
-            processed_emails = [
-                e.copy() for e in user_state.emails_cache 
-                if e.get('status') == 'processed' and e.get('reply')
-            ]
-        
-        if not processed_emails:
-            print(f"📧 [自动发送] 用户 {username} 没有需要发送的已处理邮件")
-            # 调试：检查是否有状态为 processed 但没有 reply 的邮件
-            with user_lock:
-                processed_without_reply = [
-                    e for e in user_state.emails_cache 
-                    if e.get('status') == 'processed' and not e.get('reply')
-                ]
-            if processed_without_reply:
-                print(f"⚠️ [自动发送] 发现 {len(processed_without_reply)} 封已处理但无回复内容的邮件（无法发送）")
-            return
-        
-        print(f"📧 [自动发送] 检测到 {len(processed_emails)} 封已处理邮件，开始自动发送（受速率限制）...")
-        
-        # 导入 nodes（需要在这里导入，因为是在后台任务中执行）
-        from src.nodes import Nodes
-        # 获取用户设置中的模板配置
-        user_settings = get_user_settings(username)
-        nodes = Nodes(
-            signature=user_settings.get("signature"),
-            greeting=user_settings.get("greeting"),
-            closing=user_settings.get("closing")
-        )
-        
-        # 创建邮件对象类
-        class EmailObj:
-            def __init__(self, data):
-                # 确保 sender 不为空，如果为空则抛出错误
-                sender = data.get('sender', '').strip()
-                if not sender:
-                    print(f"❌ [自动发送] 错误：邮件数据中缺少发件人地址")
-                    print(f"   邮件数据: {data}")
-                    raise ValueError(f"邮件数据中缺少发件人地址: {data.get('subject', '无主题')}")
-                
-                # 如果 sender 包含 < >，提取邮箱地址部分（与 fetch_unanswered_emails 中的逻辑一致）
-                if '<' in sender and '>' in sender:
-                    try:
-                        sender = sender.split('<')[1].split('>')[0].strip()
-                    except (IndexError, AttributeError):
-                        print(f"⚠️ [自动发送] 警告：无法从发件人地址中提取邮箱，使用原始值: {sender}")
-                
-                # 验证邮箱地址格式
-                if '@' not in sender:
-                    print(f"❌ [自动发送] 错误：发件人地址格式无效（缺少@符号）: {sender}")
-                    raise ValueError(f"无效的发件人地址格式（缺少@符号）: {sender}")
-                
-                self.sender = sender
-                self.subject = data.get('subject', '')
-                self.messageId = data.get('messageId', '')
-                self.references = data.get('references', '')
-                self.imap_id = data.get('imap_id', b'')
-                
-                print(f"📧 [自动发送] 创建邮件对象: 发件人={self.sender}, 主题={self.subject[:30]}")
+    """记录一次成功发送（写入用户数据库，重启后速率限制仍然有效）"""
+    send_queue = get_send_queue(username)
+    send_queue.record_sent()
+    counts = ", ".join(
+        f"{count}/{limit} ({SEND_RATE_WINDOW_NAMES.get(seconds, f'{int(seconds // 60)}分钟')})"
+        for limit, seconds, count in send_queue.limiter.counts()
+    )
+    print(f"📝 [速率限制] 用户 {username} 更新计数: {counts}")
+
+
+class _AutoSendEmail:
+    """自动发送使用的邮件对象（从邮件记录中取出回复所需的字段）"""
+    
+    def __init__(self, data):
+        # 确保 sender 不为空，如果为空则抛出错误
+        sender = data.get('sender', '').strip()
+        if not sender:
+            print(f"❌ [自动发送] 错误：邮件数据中缺少发件人地址")
+            raise ValueError(f"邮件数据中缺少发件人地址: {data.get('subject', '无主题')}")
+        
+        # 如果 sender 包含 < >，提取邮箱地址部分（与 fetch_unanswered_emails 中的逻辑一致）
+        if '<' in sender and '>' in sender:
+            try:
+                sender = sender.split('<')[1].split('>')[0].strip()
+            except (IndexError, AttributeError):
+                print(f"⚠️ [自动发送] 警告：无法从发件人地址中提取邮箱，使用原始值: {sender}")
         
-        # 遍历已处理的邮件，使用速率限制发送
-        sent_count = 0
-        failed_count = 0
-        limited_count = 0
+        # 验证邮箱地址格式
+        if '@' not in sender:
+            print(f"❌ [自动发送] 错误：发件人地址格式无效（缺少@符号）: {sender}")
+            raise ValueError(f"无效的发件人地址格式（缺少@符号）: {sender}")
         
-        for email in processed_emails:
-            email_obj = EmailObj(email)
-            result, message = send_reply_with_rate_limit(
-                username,
-                nodes.email_tools,
-                email_obj,
-                email.get('reply', ''),
-                email
+        self.sender = sender
+        self.subject = data.get('subject', '')
+        self.messageId = data.get('messageId', '')
+        self.references = data.get('references', '')
+        self.imap_id = data.get('imap_id', b'')
+
+
+def start_send_dispatcher(username: str):
+    """唤醒用户的发送调度：等到限制器允许发送的时刻（已在等待时按最新的时刻重新调度）"""
+    wait, _ = get_send_queue(username).limiter.check()
+    if not timer_scheduler.reschedule(username, 'send_dispatch', wait):
+        timer_scheduler.schedule(username, 'send_dispatch', lambda: dispatch_send_queue(username),
+                                 interval=SEND_RATE_LIMIT["interval"], jitter=0, delay=wait)
+
+
+def queue_auto_send(username: str, email: dict) -> bool:
+    """
+    把可以发送的回复加入用户的待发送队列（开启自动发送且回复生成后调用）
+    
+    @param username: 用户名
+    @param email: 邮件记录（需要有 id）
+    @return: 是否新加入队列
+    """
+    added = get_send_queue(username).enqueue(email.get('id'))
+    if added:
+        print(f"📬 [发送队列] 用户 {username} 加入待发送队列: {email.get('subject', '')[:30]}")
+    start_send_dispatcher(username)
+    return added
+
+
+def enqueue_sendable_emails(username: str) -> int:
+    """
+    把缓存中已处理且有回复的邮件全部加入待发送队列（开启自动发送时调用一次）
+    
+    @param username: 用户名
+    @return: 新加入队列的邮件数
+    """
+    user_state = get_user_state(username, check_auto_start=False)
+    with get_user_lock(username):
+        email_ids = [e.get('id') for e in user_state.emails_cache.by_status('processed') if e.get('reply')]
+    send_queue = get_send_queue(username)
+    added = sum(1 for email_id in email_ids if send_queue.enqueue(email_id))
+    if len(send_queue):
+        print(f"📬 [发送队列] 用户 {username}: 新加入 {added} 封，队列中共 {len(send_queue)} 封待发送")
+        start_send_dispatcher(username)
+    return added
+
+
+def dispatch_send_queue(username: str) -> bool:
+    """
+    发送调度任务（在定时调度器中执行）：限制器允许时发送队首的邮件，
+    然后把下一次执行安排在限制器计算出的下一个可发送时刻；队列为空或关闭自动发送时停止
+    
+    @return: 是否继续调度（False 时定时调度器移除该任务）
+    """
+    send_queue = get_send_queue(username)
+    if not get_user_settings(username).get("autoSend", False):
+        print(f"⏸️ [发送队列] 用户 {username} 未开启自动发送，暂停发送（队列中 {len(send_queue)} 封）")
+        return False
+    wait, _ = send_queue.limiter.check()
+    if wait > 0:
+        timer_scheduler.reschedule(username, 'send_dispatch', wait)
+        return True
+    email_id = send_queue.peek()
+    if email_id is None:
+        return False
+    
+    user_state = get_user_state(username, check_auto_start=False)
+    with get_user_lock(username):
+        email = user_state.emails_cache.get(email_id)
+        if email is not None and email.get('status') == 'processed' and email.get('reply'):
+            email = email.copy()
+        else:
+            email = None
+    
+    failures = send_failures.setdefault(username, {})
+    if email is None:
+        # 已手动发送、被删除或不再处于可发送状态
+        send_queue.remove(email_id)
+        failures.pop(email_id, None)
+    else:
+        try:
+            email_obj = _AutoSendEmail(email)
+        except ValueError as e:
+            print(f"⚠️ [发送队列] 邮件无法自动发送，移出队列: {email.get('subject', '')} - {e}")
+            send_queue.remove(email_id)
+            email_obj = None
+        if email_obj is not None:
+            from src.nodes import Nodes
+            user_settings = get_user_settings(username)
+            nodes = Nodes(
+                signature=user_settings.get("signature"),
+                greeting=user_settings.get("greeting"),
+                closing=user_settings.get("closing")
             )
-            
+            result, message = send_reply_with_rate_limit(username, nodes.email_tools, email_obj, email['reply'], email)
+            nodes.email_tools.flush_mark_as_read()
             if result:
-                sent_count += 1
-                sender_name = email.get('sender', '').split('@')[0] if '@' in email.get('sender', '') else email.get('sender', '未知')
-                print(f"✓ [自动发送] 成功发送: {email.get('subject', '')} -> {sender_name}")
-            else:
-                # 判断是速率限制还是发送失败
-                if "限制" in message or "间隔" in message or "等待" in message:
-                    limited_count += 1
-                    print(f"⏸️ [自动发送] 达到速率限制，暂停发送: {email.get('subject', '')} - {message}")
-                    # 如果是间隔限制（每封邮件之间需要间隔），继续尝试下一封
-                    # 如果是数量限制（每小时/每半小时上限），停止发送
-                    if "间隔" in message or "等待" in message:
-                        # 间隔限制：继续尝试下一封（虽然可能也会被限制，但至少会尝试）
-                        print(f"💡 [自动发送] 间隔限制，继续尝试下一封邮件...")
-                        continue
-                    else:
-                        # 数量限制：停止发送剩余邮件（等待下次触发）
-                        print(f"💡 [自动发送] 数量限制，停止发送剩余邮件，等待下次检查...")
-                        break
+                send_queue.remove(email_id)
+                failures.pop(email_id, None)
+                print(f"✓ [自动发送] 成功发送: {email.get('subject', '')}，队列剩余 {len(send_queue)} 封")
+            elif not ("限制" in message or "间隔" in message):
+                attempts = failures.get(email_id, 0) + 1
+                if attempts >= SEND_RETRY_LIMIT:
+                    print(f"⚠️ [自动发送] 发送 {attempts} 次均失败，移出队列（可手动发送）: {email.get('subject', '')} - {message}")
+                    send_queue.remove(email_id)
+                    failures.pop(email_id, None)
                 else:
-                    failed_count += 1
-                    print(f"⚠️ [自动发送] 发送失败: {email.get('subject', '')} - {message}")
-        
-        # 计算剩余待发送的邮件数（不包括因速率限制暂停的，因为它们仍然需要发送）
-        remaining_count = len(processed_emails) - sent_count - failed_count
-        print(f"📊 [自动发送] 完成: 成功 {sent_count} 封, 失败 {failed_count} 封, 因速率限制暂停 {limited_count} 封, 剩余 {remaining_count} 封待发送")
-        
-    except Exception as e:
-        print(f"❌ [自动发送] 发送已处理邮件时出错: {e}")
-        import traceback
-        traceback.print_exc()
+                    print(f"⚠️ [自动发送] 发送失败，稍后重试（第 {attempts} 次）: {email.get('subject', '')} - {message}")
+                    failures[email_id] = attempts
+                    send_queue.requeue(email_id)
+    
+    if not len(send_queue):
+        return False
+    wait, _ = send_queue.limiter.check()
+    if failures.get(send_queue.peek()):
+        # 队首是刚失败过的邮件：至少等一个发送间隔再重试
+        wait = max(wait, SEND_RATE_LIMIT["interval"])
+    timer_scheduler.reschedule(username, 'send_dispatch', wait)
+    return True
 
 def send_reply_with_rate_limit(username: str, email_tools, email_obj, reply_text: str, email_data: dict) -> tuple[bool, str]:
     """
@@ -433,8 +457,9 @@ def send_reply_with_rate_limit(username: str, email_tools, email_obj, reply_text
             
             # 更新邮件状态和统计（确保与个人中心统计同步）
             user_state = get_user_state(username, check_auto_start=False)
-            for email in user_state.emails_cache:
-                if email.get('id') == email_data.get('id'):
+            with get_user_lock(username):
+                email = user_state.emails_cache.get(email_data.get('id'))
+                if email is not None:
                     email['status'] = 'sent'
                     email['reply'] = reply_text  # 保存回复内容
                     
@@ -442,36 +467,26 @@ def send_reply_with_rate_limit(username: str, email_tools, email_obj, reply_text
                     imap_id = email.get('imap_id')
                     if imap_id:
                         try:
-                            email_tools.mark_email_as_read(imap_id)
+                            email_tools.queue_mark_as_read(imap_id)
                         except Exception as e:
                             print(f"⚠️ [自动发送] 标记已读失败: {e}")
                     
                     # 更新历史记录（如果已存在则更新，否则添加）
+                    # 匹配条件：ID相同，或者主题和发件人都相同
                     email_id = email.get('id', '')
-                    email_subject = email.get('subject', '')
-                    email_sender = email.get('sender', '')
-                    
-                    history_updated = False
-                    for history_record in user_state.history:
-                        # 匹配条件：ID相同，或者主题和发件人都相同
-                        if (history_record.get('id') == email_id or 
-                            (history_record.get('subject') == email_subject and 
-                             history_record.get('sender') == email_sender)):
-                            # 更新历史记录
-                            history_record['reply'] = reply_text
-                            history_record['status'] = 'sent'
-                            history_record['processed_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                            history_updated = True
-                            break
-                    
-                    if not history_updated:
+                    history_record = user_state.history.find_email(email_id, email.get('subject', ''), email.get('sender', ''))
+                    if history_record is not None:
+                        history_record['reply'] = reply_text
+                        history_record['status'] = 'sent'
+                        history_record['processed_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                    else:
                         # 添加到历史记录
-                        history_record = {
+                        history_record = make_email_record({
                             **email,
                             'reply': reply_text,
                             'status': 'sent',
                             'processed_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        }
+                        })
                         if not history_record.get('id'):
                             history_record['id'] = email_id
                         user_state.history.insert(0, history_record)
@@ -485,15 +500,12 @@ def send_reply_with_rate_limit(username: str, email_tools, email_obj, reply_text
                     
                     # 保存数据
                     save_user_email_data(username, user_state)
-                    break
             
             # 获取当前发送计数（用于日志）
-            with send_rate_lock:
-                control = send_rate_control.get(username, {})
-                count_hour = control.get("send_count_hour", 0)
-                count_half_hour = control.get("send_count_half_hour", 0)
+            counts = {seconds: count for _, seconds, count in get_send_queue(username).limiter.counts()}
+            count_hour, count_half_hour = counts.get(3600, 0), counts.get(1800, 0)
             
-            print(f"✓ 自动发送回复成功: {email_data.get('subject', '')} (今日第 {count_hour} 封，半小时内第 {count_half_hour} 封)")
+            print(f"✓ 自动发送回复成功: {email_data.get('subject', '')} (一小时内第 {count_hour} 封，半小时内第 {count_half_hour} 封)")
             return True, "发送成功"
         else:
             return False, "发送失败"
@@ -640,6 +652,133 @@ def auto_classify_email(subject, body):
     # 默认为产品咨询
     return 'product_enquiry'
 
+# ==================== 会话分组 ====================
+
+# 传给回复撰写的同会话早期邮件上下文上限（字符）
+THREAD_CONTEXT_MAX_CHARS = 1500
+
+
+def get_thread_key(email: dict) -> tuple:
+    """
+    计算邮件所属会话的标识
+    
+    优先使用 References 中的第一个 Message-ID（会话的根邮件），
+    其次是 threadId（In-Reply-To）和邮件自身ID；同时按发件人区分，
+    避免不同客户回复同一封群发邮件时被合并。
+    """
+    references = (email.get('references') or '').split()
+    root = references[0] if references else (email.get('threadId') or email.get('messageId') or email.get('id', ''))
+    return (email.get('sender', ''), root)
+
+
+def group_emails_by_thread(emails: list) -> tuple[list, dict]:
+    """
+    按会话分组待处理邮件，每个会话只保留最新的一封
+    
+    @param emails: 待处理邮件列表（缓存顺序即接收顺序）
+    @return: (需要处理的邮件列表（保持原顺序）, {最新邮件ID: [同会话中更早的邮件（按时间升序）]})
+    """
+    threads = {}
+    for index, email in enumerate(emails):
+        threads.setdefault(get_thread_key(email), []).append((email.get('time', ''), index, email))
+    
+    latest_ids = set()
+    superseded = {}
+    for members in threads.values():
+        members.sort(key=lambda item: (item[0], item[1]))
+        latest = members[-1][2]
+        latest_ids.add(id(latest))
+        if len(members) > 1:
+            superseded[latest.get('id', '')] = [item[2] for item in members[:-1]]
+    
+    to_process = [email for email in emails if id(email) in latest_ids]
+    if superseded:
+        merged_count = len(emails) - len(to_process)
+        print(f"🧵 [会话分组] {len(emails)} 封待处理邮件合并为 {len(to_process)} 个会话，{merged_count} 封早期邮件将与最新邮件一并回复")
+    return to_process, superseded
+
+
+def build_thread_context(earlier_emails: list) -> str:
+    """
+    将同会话中更早的未回复邮件整理为回复撰写的上下文
+    
+    @param earlier_emails: 更早的邮件（按时间升序）
+    @return: 上下文文本（超出 THREAD_CONTEXT_MAX_CHARS 时保留最近的部分）
+    """
+    if not earlier_emails:
+        return ""
+    blocks = [
+        f"[{e.get('time', '')}] {e.get('subject', '')}\n{e.get('body', '')}"
+        for e in earlier_emails
+    ]
+    context = "\n\n".join(blocks)
+    if len(context) > THREAD_CONTEXT_MAX_CHARS:
+        context = "..." + context[-THREAD_CONTEXT_MAX_CHARS:]
+    return context
+
+
+def finish_superseded_emails(username: str, user_state, latest_email: dict, superseded: list, final_status: str, email_tools=None):
+    """
+    最新邮件处理结束后，处理同会话中被合并的早期邮件
+    
+    最新邮件成功处理（processed/sent/skipped）时，早期邮件标记为已合并回复并标记已读；
+    失败或被终止时，早期邮件恢复为待处理。
+    
+    @param username: 用户名
+    @param user_state: 用户状态
+    @param latest_email: 会话中最新的邮件
+    @param superseded: 被合并的早期邮件
+    @param final_status: 最新邮件的最终状态
+    @param email_tools: 用于标记已读的 QQEmailToolsClass（可选）
+    """
+    if not superseded:
+        return
+    user_lock = get_user_lock(username)
+    answered = final_status in ('processed', 'sent', 'skipped')
+    now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    with user_lock:
+        for email in superseded:
+            if not answered:
+                email['status'] = 'pending'
+                email['processing'] = False
+                continue
+            was_pending = email.get('status') in ('pending', 'processing')
+            email['status'] = 'skipped'
+            email['category'] = latest_email.get('category', email.get('category'))
+            email['reply'] = f"已合并到同一会话的最新邮件一并回复: {latest_email.get('subject', '')}"
+            email['merged_into'] = latest_email.get('id', '')
+            email['processing'] = False
+            if was_pending:
+                user_state.stats['pending'] = max(0, user_state.stats['pending'] - 1)
+            user_state.history.insert(0, make_email_record({**email, 'processed_time': now}))
+    
+    if answered and email_tools is not None:
+        for email in superseded:
+            imap_id = email.get('imap_id')
+            if imap_id:
+                try:
+                    email_tools.queue_mark_as_read(imap_id)
+                except Exception as e:
+                    print(f"⚠️ [会话分组] 标记已读失败: {e}")
+    print(f"🧵 [会话分组] 会话 {latest_email.get('subject', '')[:30]} 的 {len(superseded)} 封早期邮件已{'合并回复' if answered else '恢复为待处理'}")
+
+# ==================== 可取消的处理阶段 ====================
+
+def run_node_stage(token: Optional[CancellationToken], nodes, stage: str, state: dict) -> dict:
+    """
+    执行一个处理节点（分类、RAG、写回复、验证等），令牌取消时立即中断
+    
+    被取消时中断该 Nodes 实例的模型请求和邮箱连接并返回空结果，
+    调用方在随后的检查点上结束处理（与原有的终止流程一致）。
+    
+    @param token: 邮件的取消令牌
+    @param nodes: 本次处理使用的 Nodes 实例
+    @param stage: 节点方法名，如 'write_draft_email'
+    @param state: 处理状态
+    @return: 节点返回的状态更新，被取消时为 {}
+    """
+    return run_cancellable(token, getattr(nodes, stage), state, abort=nodes.abort, name=stage, default={})
+
 # ==================== 全局状态 ====================
 
 class SystemState:
@@ -649,12 +788,20 @@ class SystemState:
         self.auto_process = False  # 自动处理开关
         self.stop_processing = False  # 停止处理标志（用于终止批量处理）
         self.stopped_email_ids = set()  # 被终止的邮件ID集合
-        self.monitor_thread = None
+        self.processing_token = CancellationToken(f"{username} 邮件处理")  # 终止全部处理时取消，各邮件的令牌是它的子令牌
+        self.email_tokens = weakref.WeakValueDictionary()  # 正在处理的邮件的取消令牌: {邮件ID: 令牌}
+        self.queued_email_ids = set()  # 已提交到处理调度器、尚未处理完的邮件ID（只保存在内存中，不改变邮件状态）
+        self.mail_check_token = None  # 进行中的邮箱检查的取消令牌（停止监控时取消）
         self.last_check_time = None
         self.last_auto_send_check = None  # 上次检查自动发送的时间
         self.check_interval = 900  # 15分钟
-        self.emails_cache = []
-        self.history = []
+        self.stats_rollup = StatsRollup()  # 按天增量维护的统计汇总（订阅邮件缓存和历史记录）
+        self.change_log = ChangeLog()  # 变更版本号和变更记录（/api/changes 增量同步）
+        self.emails_cache = EmailCollection()  # 带索引的邮件缓存（按ID/状态常数时间查询）
+        self.history = HistoryCollection()  # 带查询索引的历史记录（新记录在前）
+        self.history_archive = None  # 超过保留期的历史记录归档（加载用户数据时绑定）
+        self.summary_retries = {}  # 摘要生成失败、等待重试的邮件: {邮件ID: 已重试次数}
+        self.response_slo = ResponseSLO()  # 各紧急程度的回复耗时与目标时限对比
         self.activities = []  # 最近操作记录
         self.stats = {
             "today_emails": 0,
@@ -664,6 +811,39 @@ class SystemState:
             "sent": 0  # 发送回复数
         }
     
+    @property
+    def emails_cache(self) -> EmailCollection:
+        return self._emails_cache
+    
+    @emails_cache.setter
+    def emails_cache(self, emails):
+        # 整体赋值（加载数据、批量移除等）时重新建立索引
+        if not isinstance(emails, EmailCollection):
+            old = getattr(self, '_emails_cache', None)
+            if old is not None:
+                # 让旧集合放开记录，新集合才能即时跟踪记录的修改
+                old.release()
+            emails = EmailCollection(emails)
+        self._emails_cache = emails
+        self.stats_rollup.attach('cache', emails)
+        self.change_log.attach('emails', emails)
+    
+    @property
+    def history(self) -> HistoryCollection:
+        return self._history
+    
+    @history.setter
+    def history(self, records):
+        # 整体赋值（加载数据、清理历史等）时重新建立索引
+        if not isinstance(records, HistoryCollection):
+            old = getattr(self, '_history', None)
+            if old is not None:
+                old.release()
+            records = HistoryCollection(records)
+        self._history = records
+        self.stats_rollup.attach('history', records)
+        self.change_log.attach('history', records)
+    
     def add_activity(self, activity_type: str, content: str, icon: str = None):
         """添加操作记录"""
         activity = {
@@ -676,134 +856,99 @@ class SystemState:
         # 只保留最近50条记录
         if len(self.activities) > 50:
             self.activities = self.activities[:50]
+    
+    def reset_stop_flags(self):
+        """重置停止标志（开始新的处理前调用，调用方持有用户锁）；上次终止时取消的令牌换成新令牌"""
+        self.stop_processing = False
+        self.stopped_email_ids.clear()
+        if self.processing_token.cancelled:
+            self.processing_token = CancellationToken(f"{self.username} 邮件处理")
+    
+    def email_token(self, email_id: str) -> CancellationToken:
+        """
+        为开始处理的邮件创建取消令牌（终止全部处理或终止该邮件时取消）
+        
+        @param email_id: 邮件ID
+        @return: 当前处理令牌的子令牌
+        """
+        token = self.processing_token.child(f"{self.username} 邮件 {email_id}")
+        self.email_tokens[email_id] = token
+        if email_id in self.stopped_email_ids:
+            # 排队期间已被终止
+            token.cancel("终止单封邮件处理")
+        return token
         
     def start_monitor(self):
         if not self.is_running:
             self.is_running = True
-            print(f"🚀 [监控系统] 启动监控线程，用户: {self.username}")
-            self.monitor_thread = threading.Thread(target=self._monitor_loop, daemon=True)
-            self.monitor_thread.start()
-            print(f"✅ [监控系统] 监控线程已启动")
-            
-            # 检查是否开启了自动发送，只有开启时才启动自动发送线程
+            print(f"🚀 [监控系统] 启动邮箱轮询，用户: {self.username}")
+            # 检查是否开启了自动发送，只有开启时才启动自动发送检查
             user_settings = get_user_settings(self.username)
-            if user_settings.get("autoSend", False):
-                print(f"🚀 [监控系统] 启动自动发送检查线程，用户: {self.username}")
-                self.auto_send_thread = threading.Thread(target=self._auto_send_loop, daemon=True)
-                self.auto_send_thread.start()
-                print(f"✅ [监控系统] 自动发送检查线程已启动")
-            else:
-                print(f"ℹ️ [监控系统] 自动发送未开启，跳过启动自动发送线程")
+            auto_send = user_settings.get("autoSend", False)
+            mailbox_poller.register(self.username, auto_send=auto_send)
+            print(f"✅ [监控系统] 邮箱轮询已启动（自动发送检查: {'✅ 开启' if auto_send else '❌ 关闭'}）")
         else:
             print(f"⚠️ [监控系统] 监控已在运行中，跳过启动")
             
     def stop_monitor(self):
         self.is_running = False
+        mailbox_poller.unregister(self.username)
+        # 中断进行中的邮箱检查
+        token = self.mail_check_token
+        if token is not None:
+            token.cancel("停止监控")
+        
+    def _on_mail_checked(self, new_emails_count: int):
+        """邮箱轮询服务完成一次检查后的回调：通知前端并按需触发自动处理"""
+        # 如果有新邮件，通知前端刷新
+        if new_emails_count > 0:
+            self._notify_frontend({
+                "type": "new_emails",
+                "message": f"检测到 {new_emails_count} 封新邮件",
+                "count": new_emails_count
+            })
         
-    def _monitor_loop(self):
-        print(f"🔄 [监控循环] 监控循环已启动，用户: {self.username}, 检查间隔: {self.check_interval}秒")
-        print(f"🔄 [监控循环] 初始 auto_process 状态: {self.auto_process}")
-        while self.is_running:
-            try:
-                print(f"🔍 [监控循环] 开始检查邮件（用户: {self.username}, 自动处理: {'✅ 开启' if self.auto_process else '❌ 关闭'}）")
-                new_emails_count = self._check_emails()
-                
-                # 如果有新邮件，通知前端刷新
-                if new_emails_count > 0:
-                    self._notify_frontend({
-                        "type": "new_emails",
-                        "message": f"检测到 {new_emails_count} 封新邮件",
-                        "count": new_emails_count
-                    })
-                
-                # 检查待处理邮件数量
-                pending_count = len([e for e in self.emails_cache if e.get('status') == 'pending'])
-                print(f"📊 [监控循环] 当前待处理邮件数: {pending_count}")
+        # 检查待处理邮件数量
+        pending_count = self.emails_cache.count_status('pending')
+        print(f"📊 [监控循环] 当前待处理邮件数: {pending_count}")
+        
+        # 如果开启了自动处理，处理所有待处理邮件
+        if self.auto_process:
+            print(f"✅ [监控循环] 自动处理已开启，检查待处理邮件...")
+            if pending_count > 0:
+                # 在线程池中异步执行（不阻塞轮询服务）
+                print(f"🚀 [自动处理] 发现 {pending_count} 封待处理邮件，提交到线程池异步处理")
                 
-                # 如果开启了自动处理，处理所有待处理邮件
-                if self.auto_process:
-                    print(f"✅ [监控循环] 自动处理已开启，检查待处理邮件...")
-                    if pending_count > 0:
-                        # 在线程池中异步执行（不阻塞监控循环）
-                        print(f"🚀 [自动处理] 发现 {pending_count} 封待处理邮件，提交到线程池异步处理")
-                        
-                        def auto_process_callback(future):
-                            """自动处理完成后的回调函数"""
-                            try:
-                                result = future.result()
-                                if result:
-                                    self._notify_frontend({
-                                        "type": "auto_process_complete",
-                                        "message": result['message'],
-                                        "processed": result['processed'],
-                                        "skipped": result['skipped'],
-                                        "failed": result['failed']
-                                    })
-                            except Exception as e:
-                                print(f"❌ [自动处理] 处理错误: {e}")
-                                import traceback
-                                traceback.print_exc()
-                        
-                        # 提交到线程池异步执行（不阻塞监控循环）
-                        future = thread_pool.submit(self._auto_process_emails_async)
-                        future.add_done_callback(auto_process_callback)
-                    else:
-                        # 没有待处理邮件时也输出日志（方便调试）
-                        print(f"ℹ️ [自动处理] 自动处理已开启，但当前没有待处理邮件（用户: {self.username}）")
-                else:
-                    print(f"❌ [监控循环] 自动处理已关闭，跳过自动处理（待处理邮件: {pending_count}）")
+                def auto_process_callback(future):
+                    """自动处理完成后的回调函数"""
+                    try:
+                        result = future.result()
+                        if result:
+                            self._notify_frontend({
+                                "type": "auto_process_complete",
+                                "message": result['message'],
+                                "processed": result['processed'],
+                                "skipped": result['skipped'],
+                                "failed": result['failed']
+                            })
+                    except Exception as e:
+                        print(f"❌ [自动处理] 处理错误: {e}")
+                        import traceback
+                        traceback.print_exc()
                 
-            except Exception as e:
-                print(f"监控循环错误: {e}")
-            time.sleep(self.check_interval)
-    
-    def _auto_send_loop(self):
-        """独立的自动发送检查循环，每30秒检查一次"""
-        print(f"🔄 [自动发送线程] 线程已启动，用户: {self.username}")
-        loop_count = 0
-        
-        # 立即执行第一次检查（不等待30秒）
-        try:
-            loop_count += 1
-            # 获取用户设置，检查是否开启了自动发送
-            user_settings = get_user_settings(self.username)
-            if user_settings.get("autoSend", False):
-                print(f"🔄 [自动发送线程] 第 {loop_count} 次检查 - 自动发送已开启 (用户: {self.username}, 时间: {datetime.now().strftime('%H:%M:%S')})")
-                # 检查并发送已处理的邮件（受速率限制）
-                send_processed_emails_with_rate_limit(self.username)
-            # 如果未开启，不输出日志（避免日志过多）
-        except Exception as e:
-            print(f"❌ [自动发送线程] 自动发送检查错误: {e}")
-            import traceback
-            traceback.print_exc()
-        
-        # 然后每30秒检查一次
-        while self.is_running:
-            try:
-                loop_count += 1
-                # 获取用户设置，检查是否开启了自动发送
-                user_settings = get_user_settings(self.username)
-                if user_settings.get("autoSend", False):
-                    print(f"🔄 [自动发送线程] 第 {loop_count} 次检查 - 自动发送已开启 (用户: {self.username}, 时间: {datetime.now().strftime('%H:%M:%S')})")
-                    # 检查并发送已处理的邮件（受速率限制）
-                    send_processed_emails_with_rate_limit(self.username)
-                # 如果未开启，不输出日志（避免日志过多）
-            except Exception as e:
-                print(f"❌ [自动发送线程] 自动发送检查错误: {e}")
-                import traceback
-                traceback.print_exc()
-            # 每30秒检查一次（与速率限制的间隔一致）
-            time.sleep(30)
+                # 提交到线程池异步执行（不阻塞轮询服务）
+                future = thread_pool.submit(self._auto_process_emails_async)
+                future.add_done_callback(auto_process_callback)
+            else:
+                # 没有待处理邮件时也输出日志（方便调试）
+                print(f"ℹ️ [自动处理] 自动处理已开启，但当前没有待处理邮件（用户: {self.username}）")
+        else:
+            print(f"❌ [监控循环] 自动处理已关闭，跳过自动处理（待处理邮件: {pending_count}）")
     
     def _notify_frontend(self, message: dict):
-        """通过 WebSocket 通知前端"""
+        """通过 WebSocket 通知前端（只发给本用户的连接，不等待发送完成）"""
         try:
-            # 在新的事件循环中运行异步广播
-            import asyncio
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(ws_manager.broadcast(message))
-            loop.close()
+            notification_bus.publish(self.username, message)
         except Exception as e:
             print(f"WebSocket 通知失败: {e}")
     
@@ -811,7 +956,6 @@ class SystemState:
         """自动处理所有待处理邮件（异步并发处理，与"处理全部"按钮逻辑一致）"""
         from src.nodes import Nodes
         from src.state import Email
-        from concurrent.futures import as_completed
         
         # 重新获取用户状态（确保使用最新的数据）
         task_user_state = get_user_state(self.username)
@@ -819,13 +963,26 @@ class SystemState:
         # 重置停止标志（确保之前的终止操作不会影响本次自动处理）
         user_lock = get_user_lock(self.username)
         with user_lock:
-            task_user_state.stop_processing = False
-            task_user_state.stopped_email_ids.clear()
+            task_user_state.reset_stop_flags()
             print(f"🔄 [自动处理] 重置停止标志，开始新的自动处理")
         
-        pending_emails = [e for e in task_user_state.emails_cache if e.get('status') == 'pending']
-        if not pending_emails:
-            return None
+        with user_lock:
+            # 已在排队的邮件（上一轮自动处理提交的）不再重复提交
+            queued_ids = task_user_state.queued_email_ids
+            pending_emails = [
+                e for e in task_user_state.emails_cache.by_status('pending')
+                if e.get('id') not in queued_ids
+            ]
+            if not pending_emails:
+                return None
+            
+            # 同一会话只处理最新一封，更早的邮件作为上下文并一并标记
+            pending_emails, superseded_by_id = group_emails_by_thread(pending_emails)
+            # 被合并的早期邮件保持待处理状态，同样记为已排队，由 finish_superseded_emails 给出最终状态
+            batch_ids = {e.get('id') for e in pending_emails}
+            for earlier_emails in superseded_by_id.values():
+                batch_ids.update(e.get('id') for e in earlier_emails)
+            queued_ids.update(batch_ids)
         
         print(f"🚀 [自动处理] 开始处理 {len(pending_emails)} 封邮件，使用线程池并发处理")
         
@@ -857,6 +1014,8 @@ class SystemState:
             print(f"❌ [自动处理] 获取用户配置失败: {e}")
             import traceback
             traceback.print_exc()
+            with user_lock:
+                task_user_state.queued_email_ids.difference_update(batch_ids)
             return {
                 "message": f"自动处理失败: {str(e)}",
                 "processed": 0,
@@ -867,12 +1026,14 @@ class SystemState:
         def process_single_email(email):
             """处理单封邮件的函数（在线程池中并发执行）"""
             email_id = email.get('id', '')
+            # 终止全部处理或终止该邮件时取消，进行中的模型调用会被立即中断
+            token = task_user_state.email_token(email_id)
             try:
                 email['status'] = 'processing'
                 print(f"📧 [自动处理] 开始处理邮件: {email.get('subject', '')[:50]}...")
                 
                 # 检查点1：处理开始前
-                if task_user_state.stop_processing:
+                if token.cancelled:
                     print(f"⏹️ [自动处理终止] 邮件 {email_id} 在处理开始前被终止")
                     with user_lock:
                         email['status'] = 'pending'
@@ -908,6 +1069,8 @@ class SystemState:
                     sender=email.get('sender', ''),
                     subject=email.get('subject', ''),
                     body=email.get('body', ''),
+                    quoted_context=email.get('quoted_context', ''),
+                    thread_context=build_thread_context(superseded_by_id.get(email_id, [])),
                     imap_id=email.get('imap_id', b'')
                 )
                 
@@ -925,13 +1088,13 @@ class SystemState:
                 }
                 
                 # 1. 分类邮件
-                categorize_result = nodes.categorize_email(state)
+                categorize_result = run_node_stage(token, nodes, 'categorize_email', state)
                 state.update(categorize_result)
                 category = state.get('email_category', 'product_enquiry')
                 category_label = category_names.get(category, category or '未分类')
                 
                 # 检查点2：分类后
-                if task_user_state.stop_processing:
+                if token.cancelled:
                     print(f"⏹️ [自动处理终止] 邮件 {email_id} 在分类后被终止")
                     with user_lock:
                         email['status'] = 'pending'
@@ -958,15 +1121,15 @@ class SystemState:
                             if hasattr(email_obj, 'urgency_keywords'):
                                 email['urgency_keywords'] = email_obj.urgency_keywords
                         task_user_state.stats['pending'] = max(0, task_user_state.stats['pending'] - 1)
-                        task_user_state.history.insert(0, {
+                        task_user_state.history.insert(0, make_email_record({
                             **email,
                             'processed_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        })
+                        }))
                     
                     imap_id = email.get('imap_id')
                     if imap_id:
                         try:
-                            nodes.email_tools.mark_email_as_read(imap_id)
+                            nodes.email_tools.queue_mark_as_read(imap_id)
                         except:
                             pass
                     
@@ -996,7 +1159,7 @@ class SystemState:
                 # 3. RAG查询
                 if category != 'unrelated':
                     # 检查点3：RAG查询前
-                    if task_user_state.stop_processing:
+                    if token.cancelled:
                         print(f"⏹️ [自动处理终止] 邮件 {email_id} 在RAG查询前被终止")
                         with user_lock:
                             email['status'] = 'pending'
@@ -1009,7 +1172,7 @@ class SystemState:
                         })
                         return {'status': 'cancelled'}
                     
-                    rag_query_result = nodes.construct_rag_queries(state)
+                    rag_query_result = run_node_stage(token, nodes, 'construct_rag_queries', state)
                     state.update(rag_query_result)
                     
                     # 发送通知：显示生成的 RAG 查询问题
@@ -1022,11 +1185,11 @@ class SystemState:
                             "count": len(rag_queries)
                         })
                     
-                    rag_result = nodes.retrieve_from_rag(state)
+                    rag_result = run_node_stage(token, nodes, 'retrieve_from_rag', state)
                     state.update(rag_result)
                 
                 # 检查点4：RAG查询后
-                if task_user_state.stop_processing:
+                if token.cancelled:
                     print(f"⏹️ [自动处理终止] 邮件 {email_id} 在RAG查询后被终止")
                     with user_lock:
                         email['status'] = 'pending'
@@ -1041,7 +1204,7 @@ class SystemState:
                 
                 # 4. 编写回复邮件
                 # 检查点5：开始编写回复前
-                if task_user_state.stop_processing:
+                if token.cancelled:
                     print(f"⏹️ [自动处理终止] 邮件 {email_id} 在开始编写回复前被终止")
                     with user_lock:
                         email['status'] = 'pending'
@@ -1057,7 +1220,7 @@ class SystemState:
                 max_trials = 3
                 for trial in range(max_trials):
                     # 检查点6：每次重试前
-                    if task_user_state.stop_processing:
+                    if token.cancelled:
                         print(f"⏹️ [自动处理终止] 邮件 {email_id} 在编写回复前被终止（第{trial+1}次尝试）")
                         with user_lock:
                             email['status'] = 'pending'
@@ -1070,11 +1233,11 @@ class SystemState:
                         })
                         return {'status': 'cancelled'}
                     
-                    write_result = nodes.write_draft_email(state)
+                    write_result = run_node_stage(token, nodes, 'write_draft_email', state)
                     state.update(write_result)
                     
                     # 检查点7：验证前
-                    if task_user_state.stop_processing:
+                    if token.cancelled:
                         print(f"⏹️ [自动处理终止] 邮件 {email_id} 在验证前被终止（第{trial+1}次尝试）")
                         with user_lock:
                             email['status'] = 'pending'
@@ -1087,11 +1250,11 @@ class SystemState:
                         })
                         return {'status': 'cancelled'}
                     
-                    verify_result = nodes.verify_generated_email(state)
+                    verify_result = run_node_stage(token, nodes, 'verify_generated_email', state)
                     state.update(verify_result)
                     
                     # 检查点8：验证后
-                    if task_user_state.stop_processing:
+                    if token.cancelled:
                         print(f"⏹️ [自动处理终止] 邮件 {email_id} 在验证后被终止（第{trial+1}次尝试）")
                         with user_lock:
                             email['status'] = 'pending'
@@ -1134,7 +1297,7 @@ class SystemState:
                 imap_id = email.get('imap_id')
                 if imap_id:
                     try:
-                        nodes.email_tools.mark_email_as_read(imap_id)
+                        nodes.email_tools.queue_mark_as_read(imap_id)
                     except:
                         pass
                 
@@ -1153,13 +1316,17 @@ class SystemState:
                             email['urgency_keywords'] = email_obj.urgency_keywords
                     task_user_state.stats['processed'] += 1
                     task_user_state.stats['pending'] = max(0, task_user_state.stats['pending'] - 1)
-                    task_user_state.history.insert(0, {
+                    task_user_state.history.insert(0, make_email_record({
                         **email,
                         'processed_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    })
+                    }))
                     if not auto_send or not generated_reply or final_status != 'sent':
                         task_user_state.add_activity('success', f'处理了邮件: {category_label}', 'CircleCheck')
                 
+                if auto_send and generated_reply and final_status != 'sent':
+                    # 达到速率限制或发送失败：交给发送队列在下一个可发送时刻发送
+                    queue_auto_send(self.username, email)
+                
                 print(f"✅ [自动处理] 邮件处理完成: {email.get('subject', '')[:50]}...")
                 
                 # 发送WebSocket通知
@@ -1193,11 +1360,11 @@ class SystemState:
                 with user_lock:
                     email['status'] = 'failed'
                     task_user_state.stats['failed'] += 1
-                    task_user_state.history.insert(0, {
+                    task_user_state.history.insert(0, make_email_record({
                         **email,
                         'status': 'failed',
                         'processed_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    })
+                    }))
                 
                 # 发送WebSocket通知
                 urgency_info = email.get('urgency_level', 'normal')
@@ -1218,45 +1385,55 @@ class SystemState:
         batch_size = user_settings.get("batchSize", 4)
         batch_size = max(1, min(30, int(batch_size)))
         
-        # 使用独立的批量处理线程池
-        batch_pool = get_or_create_batch_thread_pool(batch_size)
-        
-        total_batches = (len(pending_emails) + batch_size - 1) // batch_size
-        print(f"📦 [自动处理] 将 {len(pending_emails)} 封邮件分成 {total_batches} 批，每批最多 {batch_size} 封")
+        print(f"📦 [自动处理] 共 {len(pending_emails)} 封邮件，保持 {batch_size} 封同时处理，任意一封完成立即开始下一封")
         
-        # 分批并发处理
-        for batch_idx in range(total_batches):
-            start_idx = batch_idx * batch_size
-            end_idx = min(start_idx + batch_size, len(pending_emails))
-            batch_emails = pending_emails[start_idx:end_idx]
-            
-            print(f"🔄 [自动处理] 处理第 {batch_idx + 1}/{total_batches} 批，包含 {len(batch_emails)} 封邮件")
-            
-            # 提交批次内的所有邮件到线程池
-            future_to_email = {
-                batch_pool.submit(process_single_email, email): email 
-                for email in batch_emails
-            }
-            
-            # 等待批次完成并收集结果
-            for future in as_completed(future_to_email):
-                try:
-                    result = future.result()
-                    with user_lock:
-                        if result['status'] == 'processed':
-                            processed_count += 1
-                        elif result['status'] == 'skipped':
-                            skipped_count += 1
-                        elif result['status'] == 'cancelled':
-                            cancelled_count += 1
-                        elif result['status'] == 'failed':
-                            failed_count += 1
-                except Exception as e:
-                    print(f"❌ [自动处理] 获取处理结果时出错: {e}")
-                    with user_lock:
+        def on_email_done(email, future, done_count, total, in_flight):
+            nonlocal processed_count, skipped_count, cancelled_count, failed_count
+            try:
+                result = future.result()
+                with user_lock:
+                    if result['status'] == 'processed':
+                        processed_count += 1
+                    elif result['status'] == 'skipped':
+                        skipped_count += 1
+                    elif result['status'] == 'cancelled':
+                        cancelled_count += 1
+                    elif result['status'] == 'failed':
                         failed_count += 1
-            
-            print(f"✅ [自动处理] 第 {batch_idx + 1}/{total_batches} 批处理完成")
+                final_status = email.get('status') if result['status'] == 'processed' else result['status']
+            except Exception as e:
+                print(f"❌ [自动处理] 获取处理结果时出错: {e}")
+                with user_lock:
+                    failed_count += 1
+                final_status = 'failed'
+            if final_status in ('processed', 'sent'):
+                task_user_state.response_slo.record(email)
+            finish_superseded_emails(
+                self.username, task_user_state, email,
+                superseded_by_id.get(email.get('id', ''), []), final_status,
+                QQEmailToolsClass(email_address=email_address, auth_code=auth_code)
+            )
+            self._notify_frontend({
+                "type": "process_all_progress",
+                "done": done_count,
+                "total": total,
+                "in_flight": in_flight,
+                "processed": processed_count,
+                "skipped": skipped_count,
+                "cancelled": cancelled_count,
+                "failed": failed_count
+            })
+        
+        # 按回复截止时间从早到晚处理（紧急邮件优先），任意一封完成立即开始下一封
+        try:
+            run_pipeline_tasks(self.username, 'batch', pending_emails, process_single_email, batch_size,
+                               on_email_done, priority=response_deadline)
+        finally:
+            with user_lock:
+                task_user_state.queued_email_ids.difference_update(batch_ids)
+        
+        # 全部完成后统一提交已读标记（一条 UID STORE 命令）
+        QQEmailToolsClass(email_address=email_address, auth_code=auth_code).flush_mark_as_read()
         
         # 保存数据
         with user_lock:
@@ -1297,7 +1474,18 @@ class SystemState:
             email_address, auth_code = get_user_email_config(self.username)
             email_tools = QQEmailToolsClass(email_address=email_address, auth_code=auth_code)
             # 获取所有未读邮件（不限制数量，默认最多50封，但可以通过参数调整）
-            emails = email_tools.fetch_unanswered_emails(max_results=100)
+            # 停止监控时立即中断进行中的IMAP连接
+            token = CancellationToken(f"{self.username} 邮箱检查")
+            self.mail_check_token = token
+            try:
+                emails = run_cancellable(token, email_tools.fetch_unanswered_emails, max_results=100,
+                                         abort=email_tools.abort, name='fetch_unanswered_emails')
+            finally:
+                self.mail_check_token = None
+            if emails is None:
+                # 检查被中断，结果不完整，不能据此同步缓存
+                print(f"⏹️ [邮箱检查] 用户 {self.username} 的邮箱检查已中断")
+                return 0
             self.last_check_time = datetime.now().isoformat()
             
             # 获取当前未读邮件的ID列表
@@ -1306,12 +1494,11 @@ class SystemState:
             # 移除缓存中已经在QQ邮箱中被标记为已读的邮件
             # 但保留已处理、已跳过、已发送的邮件（这些是我们主动标记已读的）
             emails_to_remove = []
-            for cached_email in self.emails_cache:
+            # 只移除状态为 pending 或 read 且不在未读列表中的邮件
+            # 保留 processed、skipped、sent、failed 状态的邮件
+            for cached_email in self.emails_cache.by_status('pending') + self.emails_cache.by_status('read'):
                 cached_id = cached_email.get('id', '')
-                cached_status = cached_email.get('status', '')
-                # 只移除状态为 pending 或 read 且不在未读列表中的邮件
-                # 保留 processed、skipped、sent、failed 状态的邮件
-                if cached_id not in current_unread_ids and cached_status in ['pending', 'read']:
+                if cached_id not in current_unread_ids:
                     emails_to_remove.append(cached_email)
             
             for email_to_remove in emails_to_remove:
@@ -1324,50 +1511,56 @@ class SystemState:
             new_count = 0
             for email_data in emails:
                 email_id = email_data.get('id', '')
-                if not any(e.get('id') == email_id for e in self.emails_cache):
-                    # 自动分类邮件
-                    subject = email_data.get('subject', '')
-                    body = email_data.get('body', '')
-                    category = auto_classify_email(subject, body)
-                    
-                    # 检测邮件紧急程度
-                    try:
-                        urgency_level, urgency_keywords = analyze_email_urgency(subject, body)
-                    except Exception as e:
-                        print(f"⚠️ 紧急程度检测失败: {str(e)}")
-                        urgency_level = 'low'
-                        urgency_keywords = []
-                    
-                    # 使用邮件的实际接收时间（如果存在），否则使用当前时间
-                    email_time = email_data.get('date', '') or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    # 如果时间格式不完整，补充秒数
-                    if len(email_time) < 19:  # 'YYYY-MM-DD HH:MM:SS' 应该是19个字符
-                        email_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    
-                    self.emails_cache.append({
-                        **email_data,
-                        'time': email_time,
-                        'status': 'pending',
-                        'category': category,
-                        'reply': None,
-                        'preview': body[:100] + '...',
-                        'urgency_level': urgency_level,
-                        'urgency_keywords': urgency_keywords
-                    })
-                    
-                    # 判断是否是今天的邮件
-                    email_date = email_time[:10] if len(email_time) >= 10 else ''
-                    today = datetime.now().strftime('%Y-%m-%d')
-                    is_today = email_date == today
-                    
-                    if is_today:
-                        self.stats['today_emails'] += 1
-                        print(f"自动检查：添加新邮件（今日）: {subject[:50]}... (时间: {email_time}, 日期: {email_date})")
-                    else:
-                        print(f"自动检查：添加新邮件（非今日）: {subject[:50]}... (时间: {email_time}, 日期: {email_date}, 今天: {today})")
-                    
-                    self.stats['pending'] += 1
-                    new_count += 1
+                cached_email = self.emails_cache.get(email_id)
+                if cached_email is not None:
+                    if cached_email.get('imap_id_type') != 'uid':
+                        # 旧版本缓存的邮件：补上 UID
+                        cached_email['imap_id'] = email_data.get('imap_id')
+                        cached_email['imap_id_type'] = 'uid'
+                    continue
+                # 自动分类邮件
+                subject = email_data.get('subject', '')
+                body = email_data.get('body', '')
+                category = auto_classify_email(subject, body)
+                
+                # 检测邮件紧急程度
+                try:
+                    urgency_level, urgency_keywords = analyze_email_urgency(subject, body)
+                except Exception as e:
+                    print(f"⚠️ 紧急程度检测失败: {str(e)}")
+                    urgency_level = 'low'
+                    urgency_keywords = []
+                
+                # 使用邮件的实际接收时间（如果存在），否则使用当前时间
+                email_time = email_data.get('date', '') or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                # 如果时间格式不完整，补充秒数
+                if len(email_time) < 19:  # 'YYYY-MM-DD HH:MM:SS' 应该是19个字符
+                    email_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                
+                self.emails_cache.append(make_email_record({
+                    **email_data,
+                    'time': email_time,
+                    'status': 'pending',
+                    'category': category,
+                    'reply': None,
+                    'preview': body[:100] + '...',
+                    'urgency_level': urgency_level,
+                    'urgency_keywords': urgency_keywords
+                }))
+                
+                # 判断是否是今天的邮件
+                email_date = email_time[:10] if len(email_time) >= 10 else ''
+                today = datetime.now().strftime('%Y-%m-%d')
+                is_today = email_date == today
+                
+                if is_today:
+                    self.stats['today_emails'] += 1
+                    print(f"自动检查：添加新邮件（今日）: {subject[:50]}... (时间: {email_time}, 日期: {email_date})")
+                else:
+                    print(f"自动检查：添加新邮件（非今日）: {subject[:50]}... (时间: {email_time}, 日期: {email_date}, 今天: {today})")
+                
+                self.stats['pending'] += 1
+                new_count += 1
             
             return new_count
                     
@@ -1379,6 +1572,152 @@ class SystemState:
 # 格式: {username: SystemState实例}
 user_states: dict[str, SystemState] = {}
 
+# ==================== 邮箱轮询服务 ====================
+
+# 所有用户共享的定时任务线程数（同时进行的邮箱检查、自动发送等任务数量）
+MAILBOX_POLL_CONCURRENCY = int(os.getenv("MAILBOX_POLL_CONCURRENCY", "8"))
+# 单次邮箱检查的超时时间（秒），超时后中断该用户的IMAP连接，释放共享线程
+MAILBOX_CHECK_TIMEOUT = int(os.getenv("MAILBOX_CHECK_TIMEOUT", "180"))
+# 摘要生成失败的邮件重试间隔（秒），可通过环境变量 SUMMARY_RETRY_INTERVAL 覆盖
+SUMMARY_RETRY_INTERVAL = int(os.getenv("SUMMARY_RETRY_INTERVAL", "300"))
+# 每封邮件的摘要最多重试次数
+SUMMARY_RETRY_LIMIT = 3
+# 每轮最多重试的邮件数
+SUMMARY_RETRY_BATCH = 5
+
+# 全局定时调度器：所有用户的周期任务共用一个计时线程和一个线程池
+timer_scheduler = TimerScheduler(workers=MAILBOX_POLL_CONCURRENCY, name="scheduler")
+
+
+class MailboxPollerService:
+    """
+    邮箱轮询服务（基于全局定时调度器）
+    
+    每个开启监控的用户在调度器中注册周期任务（邮箱检查、摘要重试），
+    而不是常驻线程或协程；任务到期后在调度器的共享线程池中执行，
+    因此线程数量不随用户数量增长，一个慢邮箱也不会拖慢其他用户。
+    检查到新邮件后通过 add_listener 注册的回调发布事件。
+    """
+    
+    # 停止监控时取消的任务类型
+    MONITOR_JOBS = ('mail_check', 'summary_retry')
+    
+    def __init__(self, scheduler: TimerScheduler):
+        self._scheduler = scheduler
+        self._listeners = []
+    
+    def add_listener(self, callback):
+        """
+        注册新邮件事件回调
+        
+        @param callback: callback(username, new_count)，在调度器线程池中调用
+        """
+        self._listeners.append(callback)
+    
+    def register(self, username: str, auto_send: bool = False):
+        """
+        开始轮询指定用户的邮箱（线程安全，已在轮询时忽略）
+        
+        @param username: 用户名
+        @param auto_send: 是否同时把已处理的邮件加入待发送队列
+        """
+        started = self._scheduler.ensure(
+            username, 'mail_check', lambda: self._check_user(username),
+            interval=lambda: self._check_interval(username),
+            delay=0, timeout=MAILBOX_CHECK_TIMEOUT,
+            on_timeout=lambda: self._abort_check(username)
+        )
+        if started:
+            print(f"🔄 [邮箱轮询] 开始轮询用户 {username}，检查间隔: {self._check_interval(username)}秒")
+        self._scheduler.ensure(
+            username, 'summary_retry', lambda: self._retry_summaries(username),
+            interval=SUMMARY_RETRY_INTERVAL
+        )
+        if auto_send:
+            self.enable_auto_send(username)
+    
+    def _abort_check(self, username: str):
+        """邮箱检查超时：取消进行中的检查（中断IMAP连接），让调度器线程尽快释放"""
+        user_state = user_states.get(username)
+        token = user_state.mail_check_token if user_state is not None else None
+        if token is not None:
+            token.cancel(f"邮箱检查超过 {MAILBOX_CHECK_TIMEOUT} 秒")
+    
+    def enable_auto_send(self, username: str):
+        """开启自动发送：把已处理且有回复的邮件加入待发送队列并启动发送调度（已在队列中的忽略）"""
+        enqueue_sendable_emails(username)
+    
+    def unregister(self, username: str):
+        """停止轮询指定用户的邮箱（正在执行的检查会自然结束）"""
+        for kind in self.MONITOR_JOBS:
+            self._scheduler.cancel(username, kind)
+    
+    def is_polling(self, username: str) -> bool:
+        return self._scheduler.is_scheduled(username, 'mail_check')
+    
+    @staticmethod
+    def _running_state(username: str) -> Optional["SystemState"]:
+        user_state = user_states.get(username)
+        if user_state is None or not user_state.is_running:
+            return None
+        return user_state
+    
+    @staticmethod
+    def _check_interval(username: str) -> float:
+        user_state = user_states.get(username)
+        return getattr(user_state, 'check_interval', 900) or 900
+    
+    def _check_user(self, username: str):
+        """邮箱检查任务：检查 -> 发布事件（监控已停止时返回 False，不再调度）"""
+        user_state = self._running_state(username)
+        if user_state is None:
+            return False
+        try:
+            print(f"🔍 [邮箱轮询] 开始检查邮件（用户: {username}, 自动处理: {'✅ 开启' if user_state.auto_process else '❌ 关闭'}）")
+            new_count = user_state._check_emails()
+            for listener in self._listeners:
+                listener(username, new_count)
+        except Exception as e:
+            print(f"监控循环错误: {e}")
+    
+    def _retry_summaries(self, username: str):
+        """摘要重试任务：为首次生成失败的新邮件重新生成原始邮件摘要"""
+        user_state = self._running_state(username)
+        if user_state is None:
+            return False
+        if not user_state.summary_retries:
+            return
+        success_count = 0
+        for email_id in list(user_state.summary_retries)[:SUMMARY_RETRY_BATCH]:
+            email = user_state.emails_cache.get(email_id)
+            if email is None or email.get('body_summary'):
+                user_state.summary_retries.pop(email_id, None)
+                continue
+            attempts = user_state.summary_retries.get(email_id, 0) + 1
+            user_state.summary_retries[email_id] = attempts
+            if generate_body_summary_only(email, user_state, username, batch_mode=True):
+                user_state.summary_retries.pop(email_id, None)
+                success_count += 1
+            elif attempts >= SUMMARY_RETRY_LIMIT:
+                user_state.summary_retries.pop(email_id, None)
+                print(f"⚠️ [摘要生成] 邮件 {email_id} 已重试 {attempts} 次仍失败，不再重试")
+        if success_count:
+            with get_user_lock(username):
+                save_user_email_data(username, user_state)
+            print(f"✅ [摘要生成] 重试成功 {success_count} 封，剩余待重试 {len(user_state.summary_retries)} 封（用户: {username}）")
+
+
+def _dispatch_new_mail_event(username: str, new_count: int):
+    """轮询服务的默认监听器：把检查结果交给对应用户的 SystemState"""
+    user_state = user_states.get(username)
+    if user_state is not None:
+        user_state._on_mail_checked(new_count)
+
+
+mailbox_poller = MailboxPollerService(timer_scheduler)
+mailbox_poller.add_listener(_dispatch_new_mail_event)
+
+
 def get_user_email_data_file(username: str, reload: bool = False) -> str:
     """获取用户邮件数据文件路径（使用user_id而不是username）
     
@@ -1391,8 +1730,35 @@ def get_user_email_data_file(username: str, reload: bool = False) -> str:
     # 兼容旧数据：如果找不到user_id，使用username（向后兼容）
     return os.path.join(USER_DATA_DIR, f"user_email_data_{username}.json")
 
+def get_user_email_db_file(username: str, reload: bool = False) -> str:
+    """获取用户邮件数据库文件路径（与JSON文件同名，扩展名为 .db）
+    
+    @param username: 用户名
+    @param reload: 是否强制重新加载数据（默认False，使用内存中的数据）
+    """
+    return os.path.splitext(get_user_email_data_file(username, reload=reload))[0] + ".db"
+
+def _format_user_email_data(data: dict) -> dict:
+    """把加载到的原始数据整理为统一的结构（补齐缺失字段的默认值）"""
+    return {
+        "emails_cache": data.get("emails_cache", []),
+        "history": data.get("history", []),
+        "activities": data.get("activities", []),
+        "stats": data.get("stats", {
+            "today_emails": 0,
+            "processed": 0,
+            "pending": 0,
+            "failed": 0
+        }),
+        "last_check_time": data.get("last_check_time"),
+        "is_running": data.get("is_running", False),
+        "auto_process": data.get("auto_process", False),
+        "check_interval": data.get("check_interval", 900)
+    }
+
 def load_user_email_data(username: str) -> dict:
-    """从文件加载用户的邮件数据（emails_cache, history, activities, stats）
+    """从数据库加载用户的邮件数据（emails_cache, history, activities, stats）
+    如果只有旧的JSON数据文件，会先一次性迁移到数据库
     
     注意：此函数会先尝试通过映射关系找到实际用户名，然后使用user_id加载数据文件
     这样确保即使用户名改变，只要user_id不变，数据就能正确加载
@@ -1406,29 +1772,21 @@ def load_user_email_data(username: str) -> dict:
     # 首先尝试使用user_id命名的文件（新格式）
     # 注意：这里使用 reload=False，优先使用内存中的数据，避免覆盖正在进行的修改
     data_file = get_user_email_data_file(username, reload=False)
-    print(f"🔍 [加载数据] 用户 {username}，尝试加载文件: {data_file}")
+    db_file = get_user_email_db_file(username, reload=False)
+    store = get_user_store(db_file)
+    print(f"🔍 [加载数据] 用户 {username}，尝试加载数据库: {db_file}")
     
-    if os.path.exists(data_file):
+    if store.exists() or os.path.exists(data_file):
         try:
-            with open(data_file, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            print(f"✓ [加载数据] 成功加载用户 {username} 的数据文件: {data_file}")
+            if store.exists():
+                data = store.load()
+            else:
+                # 一次性迁移：JSON 文件导入数据库后重命名为 .migrated 备份
+                print(f"🔍 [加载数据] 检测到JSON数据文件 {data_file}，正在迁移到数据库...")
+                data = store.migrate_from_json(data_file)
+            print(f"✓ [加载数据] 成功加载用户 {username} 的数据: {db_file}")
             print(f"   邮件数: {len(data.get('emails_cache', []))}, 历史记录数: {len(data.get('history', []))}")
-            return {
-                "emails_cache": data.get("emails_cache", []),
-                "history": data.get("history", []),
-                "activities": data.get("activities", []),
-                "stats": data.get("stats", {
-                    "today_emails": 0,
-                    "processed": 0,
-                    "pending": 0,
-                    "failed": 0
-                }),
-                "last_check_time": data.get("last_check_time"),
-                "is_running": data.get("is_running", False),
-                "auto_process": data.get("auto_process", False),
-                "check_interval": data.get("check_interval", 900)
-            }
+            return _format_user_email_data(data)
         except Exception as e:
             print(f"❌ [加载数据] 加载用户 {username} 邮件数据失败: {e}")
             import traceback
@@ -1462,43 +1820,78 @@ def load_user_email_data(username: str) -> dict:
                 # 获取user_id并迁移到新格式
                 user_id = get_user_id_by_username(username, reload=True)  # 迁移时需要重新加载
                 if user_id:
-                    new_data_file = os.path.join(USER_DATA_DIR, f"user_email_data_{user_id}.json")
-                    # 保存到新格式文件
-                    with open(new_data_file, 'w', encoding='utf-8') as f:
-                        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
-                    # 删除旧文件
-                    try:
-                        os.remove(old_data_file)
-                        print(f"✓ [加载数据] 数据文件已从旧格式迁移到新格式: {old_data_file} -> {new_data_file}")
-                    except Exception as e:
-                        print(f"⚠️ [加载数据] 删除旧数据文件失败: {e}")
+                    new_db_file = os.path.join(USER_DATA_DIR, f"user_email_data_{user_id}.db")
+                    # 直接迁移到数据库（原文件重命名为 .migrated 备份）
+                    data = get_user_store(new_db_file).migrate_from_json(old_data_file)
+                    print(f"✓ [加载数据] 数据文件已从旧格式迁移到新格式: {old_data_file} -> {new_db_file}")
                 
-                return {
-                    "emails_cache": data.get("emails_cache", []),
-                    "history": data.get("history", []),
-                    "activities": data.get("activities", []),
-                    "stats": data.get("stats", {
-                        "today_emails": 0,
-                        "processed": 0,
-                        "pending": 0,
-                        "failed": 0
-                    }),
-                    "last_check_time": data.get("last_check_time"),
-                    "is_running": data.get("is_running", False),
-                    "auto_process": data.get("auto_process", False),
-                    "check_interval": data.get("check_interval", 900)
-                }
+                return _format_user_email_data(data)
             except Exception as e:
                 print(f"❌ [加载数据] 加载用户 {username} 旧格式邮件数据失败: {e}")
                 continue
     
-    print(f"⚠️ [加载数据] 用户 {username} 的数据文件不存在")
-    return None
+    print(f"⚠️ [加载数据] 用户 {username} 的数据文件不存在")
+    return None
+
+def get_user_history_archive_dir(username: str) -> str:
+    """获取用户历史记录归档目录（与数据库文件同名，后缀 _archive）"""
+    return os.path.splitext(get_user_email_db_file(username, reload=False))[0] + "_archive"
+
+
+# 历史记录保留天数，更早的记录移入压缩归档，可通过环境变量 HISTORY_ARCHIVE_DAYS 覆盖（0 表示不归档）
+HISTORY_ARCHIVE_DAYS = int(os.getenv("HISTORY_ARCHIVE_DAYS", "90"))
+
+# 历史归档任务的执行间隔（秒），可通过环境变量 HISTORY_ARCHIVE_INTERVAL 覆盖
+HISTORY_ARCHIVE_INTERVAL = float(os.getenv("HISTORY_ARCHIVE_INTERVAL", str(6 * 3600)))
+
+
+def archive_user_history(username: str, user_state: SystemState) -> int:
+    """把超过保留期的历史记录移入归档（调用方需持有用户锁，或状态尚未被其他线程使用）
+    
+    先写入并落盘归档分段，再从热数据中移除；随后的保存会删除数据库中对应的行。
+    
+    @param username: 用户名
+    @param user_state: 用户状态对象
+    @return: 归档的记录数
+    """
+    archive = user_state.history_archive
+    if HISTORY_ARCHIVE_DAYS <= 0 or archive is None:
+        return 0
+    
+    cutoff = (datetime.now() - timedelta(days=HISTORY_ARCHIVE_DAYS)).replace(hour=0, minute=0, second=0, microsecond=0)
+    old_records = user_state.history.records_before(cutoff.timestamp())
+    if not old_records:
+        return 0
+    try:
+        archived = archive.archive(old_records)
+    except Exception as e:
+        print(f"❌ [历史归档] 用户 {username} 归档失败: {e}")
+        import traceback
+        traceback.print_exc()
+        return 0
+    
+    old_ids = {id(record) for record in old_records}
+    user_state.history = [record for record in user_state.history if id(record) not in old_ids]
+    user_state.stats_rollup.load_static('archive', archive.contributions())
+    print(f"🗄️ [历史归档] 用户 {username}: {archived} 条 {cutoff.strftime('%Y-%m-%d')} 之前的记录已归档，热数据剩余 {len(user_state.history)} 条")
+    return archived
 
-def save_user_email_data(username: str, user_state: SystemState):
-    """保存用户的邮件数据到文件
+
+def _run_history_archive_job(username: str):
+    """定时调度的历史归档任务：在用户锁内归档，有记录移出时保存（同时删除数据库中对应的行）"""
+    user_state = user_states.get(username)
+    if user_state is None:
+        return False
+    with get_user_lock(username):
+        if archive_user_history(username, user_state):
+            save_user_email_data(username, user_state)
+
+
+def _write_user_email_data(username: str, user_state: SystemState):
+    """立即把用户的邮件数据写入数据库（只写入自上次保存以来变化的行）
     注意：此函数会通过用户名找到对应的user_id，然后使用user_id命名文件
     这样确保即使用户名改变，只要user_id不变，数据文件就不会改变
+    写入失败时抛出异常，由 EmailDataPersister.flush 重新标记为待保存
     """
     # 先获取实际用户名（处理用户名映射）
     actual_username = get_current_username(username, reload=True)
@@ -1506,25 +1899,144 @@ def save_user_email_data(username: str, user_state: SystemState):
         print(f"信息: save_user_email_data 检测到用户名 {username} 已迁移到 {actual_username}，使用新用户名")
         username = actual_username
     
-    data_file = get_user_email_data_file(username, reload=False)
-    print(f"💾 [保存数据] 用户 {username}，保存到文件: {data_file}")
+    db_file = get_user_email_db_file(username, reload=False)
     try:
-        # 准备要保存的数据（排除不能序列化的对象，如线程）
-        data = {
-            "emails_cache": user_state.emails_cache,
-            "history": user_state.history,
-            "activities": user_state.activities,
-            "stats": user_state.stats,
-            "last_check_time": user_state.last_check_time,
-            "is_running": False,  # 不保存运行状态，重启后需要重新启动
-            "auto_process": user_state.auto_process,
-            "check_interval": user_state.check_interval,
-            "last_save_time": datetime.now().isoformat()
-        }
-        with open(data_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+        # 只写入变化的行（不保存运行状态，重启后需要重新启动）
+        # 每次保存在一个事务中提交，中途失败不会留下写了一半的数据
+        written = get_user_store(db_file).save(
+            user_state,
+            is_running=False,
+            last_save_time=datetime.now().isoformat()
+        )
+        print(f"💾 [保存数据] 用户 {username}，写入 {written} 行: {db_file}")
     except Exception as e:
         print(f"保存用户 {username} 邮件数据失败: {e}")
+        raise
+
+
+# 合并写入的时间窗口（秒），窗口内的多次保存只写一次，可通过环境变量 EMAIL_DATA_FLUSH_DELAY 覆盖
+EMAIL_DATA_FLUSH_DELAY = float(os.getenv("EMAIL_DATA_FLUSH_DELAY", "2"))
+
+# 刷新时等待用户锁的最长时间（秒），超时后下个窗口重试
+EMAIL_DATA_FLUSH_LOCK_TIMEOUT = 5
+
+
+class EmailDataPersister:
+    """
+    用户邮件数据的延迟写入器
+    
+    save_user_email_data 只把用户标记为脏，由后台定时器在窗口结束时统一写入，
+    无论窗口内发生多少次更新，每个用户最多写一次。
+    """
+    
+    def __init__(self, delay: float = EMAIL_DATA_FLUSH_DELAY):
+        """
+        @param delay: 合并写入的时间窗口（秒），<=0 时每次保存立即写入
+        """
+        self.delay = delay
+        self._dirty: Dict[str, SystemState] = {}
+        self._lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self.write_count = 0
+    
+    def mark_dirty(self, username: str, user_state: SystemState):
+        """
+        标记用户数据需要保存，并在需要时启动刷新定时器
+        
+        @param username: 用户名
+        @param user_state: 用户状态对象
+        """
+        with self._lock:
+            self._dirty[username] = user_state
+            if self._timer is None:
+                self._timer = threading.Timer(self.delay, self._on_timer)
+                self._timer.daemon = True
+                self._timer.start()
+    
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+        self.flush_all(wait_for_lock=True)
+    
+    def flush(self, username: str, wait_for_lock: bool = True) -> bool:
+        """
+        立即写入某个用户的待保存数据
+        
+        @param username: 用户名
+        @param wait_for_lock: 是否获取用户锁后再写入（在已持有用户锁的线程中调用时必须为False）
+        @return: 是否写入（没有待保存数据或写入失败时返回False；失败时重新标记为待保存，下个窗口重试）
+        """
+        with self._lock:
+            user_state = self._dirty.pop(username, None)
+        if user_state is None:
+            return False
+        
+        user_lock = get_user_lock(username) if wait_for_lock else None
+        if user_lock is not None and not user_lock.acquire(timeout=EMAIL_DATA_FLUSH_LOCK_TIMEOUT):
+            # 锁被长时间占用（批处理中），留到下个窗口再写
+            print(f"⚠️ [保存数据] 用户 {username} 的锁被占用，推迟写入")
+            self.mark_dirty(username, user_state)
+            return False
+        try:
+            _write_user_email_data(username, user_state)
+            self.write_count += 1
+        except Exception:
+            # 数据没有写入：重新标记为待保存，下个窗口重试
+            self.mark_dirty(username, user_state)
+            return False
+        finally:
+            if user_lock is not None:
+                user_lock.release()
+        return True
+    
+    def flush_all(self, wait_for_lock: bool = True):
+        """
+        写入所有用户的待保存数据（应用关闭时调用）
+        
+        @param wait_for_lock: 是否获取用户锁后再写入
+        """
+        with self._lock:
+            usernames = list(self._dirty.keys())
+        for username in usernames:
+            try:
+                self.flush(username, wait_for_lock=wait_for_lock)
+            except Exception as e:
+                print(f"❌ [保存数据] 写入用户 {username} 数据失败: {e}")
+    
+    def shutdown(self):
+        """停止定时器并写入所有待保存数据"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        self.flush_all()
+        # 第一次刷新时锁被占用的用户会重新入队，关闭前不再等待锁
+        self.flush_all(wait_for_lock=False)
+        with self._lock:
+            timer, self._timer = self._timer, None
+            unsaved = list(self._dirty.keys())
+        if timer is not None:
+            timer.cancel()
+        if unsaved:
+            print(f"❌ [保存数据] 关闭前仍有用户数据写入失败，未保存: {', '.join(unsaved)}")
+
+
+email_data_persister = EmailDataPersister()
+
+
+def save_user_email_data(username: str, user_state: SystemState, immediate: bool = False):
+    """保存用户的邮件数据
+    默认只标记为脏，由 email_data_persister 在合并窗口结束时统一写入
+    
+    @param username: 用户名
+    @param user_state: 用户状态对象
+    @param immediate: 是否立即写入（调用方可能持有用户锁，因此不会再获取锁）
+    """
+    if immediate or email_data_persister.delay <= 0:
+        email_data_persister.mark_dirty(username, user_state)
+        email_data_persister.flush(username, wait_for_lock=False)
+        return
+    email_data_persister.mark_dirty(username, user_state)
 
 # 自动保存装饰器（用于在关键操作后自动保存）
 def auto_save_email_data(func):
@@ -1566,6 +2078,15 @@ def get_user_state(username: str, check_auto_start: bool = True) -> SystemState:
         saved_data = load_user_email_data(username)
         if saved_data:
             user_state.emails_cache = saved_data.get("emails_cache", [])
+            # 上次运行中断时处于处理中/正在终止的邮件恢复为待处理
+            for email in (user_state.emails_cache.by_status('processing')
+                          + user_state.emails_cache.by_status('stopping')):
+                email['status'] = 'pending'
+                email['processing'] = False
+            # 旧版本缓存的 imap_id 是序号，按 UID 标记已读会标错邮件：清除后由下一次邮箱检查重新取得 UID
+            for email in user_state.emails_cache:
+                if email.get('imap_id') and email.get('imap_id_type') != 'uid':
+                    email['imap_id'] = None
             user_state.history = saved_data.get("history", [])
             user_state.activities = saved_data.get("activities", [])
             user_state.stats = saved_data.get("stats", {
@@ -1584,7 +2105,19 @@ def get_user_state(username: str, check_auto_start: bool = True) -> SystemState:
             print(f"已加载用户 {username} 的邮件数据: {len(user_state.emails_cache)} 封邮件, {len(user_state.history)} 条历史记录")
         else:
             print(f"警告: 用户 {username} 的邮件数据文件不存在或为空，使用空数据")
+        # 绑定历史归档：统计只读取各记录的计数贡献，记录本身在查询需要时才解压
+        user_state.history_archive = get_history_archive(get_user_history_archive_dir(username))
+        user_state.stats_rollup.load_static('archive', user_state.history_archive.contributions())
+        if archive_user_history(username, user_state):
+            save_user_email_data(username, user_state, immediate=True)
         user_states[username] = user_state
+        if HISTORY_ARCHIVE_DAYS > 0:
+            # 之后由定时调度器周期性归档
+            timer_scheduler.schedule(username, 'history_archive', lambda: _run_history_archive_job(username),
+                                     interval=HISTORY_ARCHIVE_INTERVAL)
+        # 恢复上次未发送完的待发送队列（发送调度会检查自动发送是否开启）
+        if len(get_send_queue(username)):
+            start_send_dispatcher(username)
     
     return user_states[username]
 
@@ -1710,8 +2243,79 @@ def get_username_by_user_id(user_id: str) -> Optional[str]:
     
     return None
 
+class UserDataRepository:
+    """
+    user_data.json 的内存缓存
+    
+    解析并校验后的数据保存在内存中，每次读取只检查文件的 mtime/大小/inode，
+    文件未变化时直接返回缓存；通过 save_user_data 写入时同步更新缓存。
+    注意：返回的是共享对象，修改后必须调用 save_user_data 保存。
+    """
+    
+    def __init__(self, data_file: str):
+        """
+        @param data_file: 用户数据文件路径
+        """
+        self.data_file = data_file
+        self._lock = threading.RLock()
+        self._data = None
+        self._signature = None
+        self.version = 0  # 每次缓存更新（重新加载或保存）时递增
+    
+    def _stat_signature(self):
+        """文件签名：(mtime_ns, size, inode)，文件不存在时返回 None"""
+        try:
+            st = os.stat(self.data_file)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    
+    def load(self) -> dict:
+        """
+        获取用户数据（文件变化时重新加载）
+        
+        @return: 用户数据字典
+        """
+        signature = self._stat_signature()
+        if signature is not None and self._data is not None and signature == self._signature:
+            return self._data
+        with self._lock:
+            signature = self._stat_signature()
+            if signature is not None and self._data is not None and signature == self._signature:
+                return self._data
+            data = _read_user_data_file()
+            if signature is None:
+                # 文件不存在时返回默认数据，不缓存
+                return data
+            # 读取过程中可能触发修复保存（已通过 update 更新缓存）；
+            # 否则使用读取前的签名，读取期间文件再被修改时下次会重新加载
+            if self._data is not data:
+                self._data = data
+                self._signature = signature
+                self.version += 1
+            return self._data
+    
+    def update(self, data: dict):
+        """写入文件成功后更新缓存"""
+        with self._lock:
+            self._data = data
+            self._signature = self._stat_signature()
+            self.version += 1
+    
+    def invalidate(self):
+        """使缓存失效，下次读取时重新加载文件"""
+        with self._lock:
+            self._data = None
+            self._signature = None
+            self.version += 1
+
+
 def load_user_data():
-    """从文件加载用户数据"""
+    """加载用户数据（使用内存缓存，文件被修改后自动重新加载）"""
+    return user_data_repository.load()
+
+def _read_user_data_file():
+    """从文件读取并校验用户数据"""
     if os.path.exists(USER_DATA_FILE):
         try:
             with open(USER_DATA_FILE, 'r', encoding='utf-8') as f:
@@ -1809,8 +2413,11 @@ def save_user_data(data):
             os.replace(temp_file, USER_DATA_FILE)
         else:
             os.rename(temp_file, USER_DATA_FILE)
+        user_data_repository.update(data)
         print(f"✓ 用户数据已成功保存到 {USER_DATA_FILE}")
     except Exception as e:
+        # 内存中的数据可能已被修改但未写入，丢弃缓存
+        user_data_repository.invalidate()
         print(f"❌ 保存用户数据失败: {e}")
         import traceback
         traceback.print_exc()
@@ -1823,6 +2430,8 @@ def save_user_data(data):
                 pass
         raise  # 重新抛出异常，让调用者知道保存失败
 
+user_data_repository = UserDataRepository(USER_DATA_FILE)
+
 def load_username_mapping():
     """加载用户名映射关系"""
     if os.path.exists(USERNAME_MAPPING_FILE):
@@ -1927,13 +2536,173 @@ def get_username_from_request(authorization: Optional[str] = Header(None, alias=
 import asyncio
 from fastapi import WebSocket, WebSocketDisconnect, Query
 from typing import Optional, Dict, Set
+from collections import OrderedDict
+
+# 每个连接发送队列的容量，超过后直接断开该连接
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+# 高水位：发送队列长度持续超过该值 WS_HIGH_WATER_GRACE 秒后断开连接
+WS_HIGH_WATER = int(os.getenv("WS_HIGH_WATER", "128"))
+WS_HIGH_WATER_GRACE = float(os.getenv("WS_HIGH_WATER_GRACE", "5"))
+# 单条消息发送超时（秒），超时视为连接已失效
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+
+# 单封邮件的状态事件：尚未发出的过渡状态会被同一邮件的后续状态事件取代
+WS_EMAIL_STATE_EVENTS = ('email_process_started', 'email_process_stopping', 'email_process_stopped', 'email_process_complete')
+# 批量处理的状态事件
+WS_PROCESS_ALL_EVENTS = ('process_all_stopping', 'process_all_stopped', 'process_all_complete')
+# 可以被同一合并键的后续消息取代的消息类型（完成/终止等结果事件不会被取代）
+WS_SUPERSEDABLE_EVENTS = (
+    'email_process_started', 'email_process_stopping', 'process_all_stopping',
+    'process_all_progress', 'rag_queries_generated', 'summary_saved'
+)
+
+
+def _ws_coalesce_key(message: dict) -> Optional[tuple]:
+    """消息的合并键：同一合并键下只需要保留最新的状态"""
+    msg_type = message.get('type')
+    email_id = message.get('email_id')
+    if msg_type in WS_EMAIL_STATE_EVENTS and email_id:
+        return ('email_state', email_id)
+    if msg_type in ('rag_queries_generated', 'summary_saved') and email_id:
+        return (msg_type, email_id)
+    if msg_type in WS_PROCESS_ALL_EVENTS:
+        return ('process_all',)
+    if msg_type == 'process_all_progress':
+        return (msg_type,)
+    return None
+
+
+class _ConnectionSender:
+    """
+    单个 WebSocket 连接的发送队列和写任务
+    
+    入队只在主事件循环上进行且不等待发送；写任务逐条发送，慢连接只会积压自己的队列。
+    """
+    
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket, username: str):
+        self.manager = manager
+        self.websocket = websocket
+        self.username = username
+        # 序号 -> (合并键, 消息)，按入队顺序发送
+        self._queue: "OrderedDict[int, tuple]" = OrderedDict()
+        # 合并键 -> 队列中可被取代的消息序号
+        self._pending_keys: Dict[tuple, int] = {}
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._over_since: Optional[float] = None
+        self.closed = False
+        self._task = asyncio.get_running_loop().create_task(self._run())
+    
+    def enqueue(self, message: dict) -> bool:
+        """
+        把消息放入发送队列（主事件循环上调用）
+        
+        @return: 是否入队（连接已关闭或因积压被断开时返回 False）
+        """
+        if self.closed:
+            return False
+        key = _ws_coalesce_key(message)
+        if key is not None:
+            old_seq = self._pending_keys.pop(key, None)
+            if old_seq is not None and self._queue.pop(old_seq, None) is not None:
+                self.manager.count(self.username, 'coalesced')
+        
+        self._seq += 1
+        self._queue[self._seq] = (key, message)
+        if key is not None and message.get('type') in WS_SUPERSEDABLE_EVENTS:
+            self._pending_keys[key] = self._seq
+        self.manager.count(self.username, 'queued')
+        self._wakeup.set()
+        
+        # 背压：队列满，或持续超过高水位，断开该连接
+        size = len(self._queue)
+        if size >= WS_SEND_QUEUE_SIZE:
+            self.manager.drop_connection(self, f"发送队列已满（{size} 条）")
+            return False
+        if size > WS_HIGH_WATER:
+            now = time.monotonic()
+            if self._over_since is None:
+                self._over_since = now
+            elif now - self._over_since > WS_HIGH_WATER_GRACE:
+                self.manager.drop_connection(self, f"发送队列持续超过高水位（{size} 条）")
+                return False
+        return True
+    
+    async def _run(self):
+        try:
+            while not self.closed:
+                if not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                seq, (key, message) = self._queue.popitem(last=False)
+                if key is not None and self._pending_keys.get(key) == seq:
+                    del self._pending_keys[key]
+                try:
+                    await asyncio.wait_for(self.websocket.send_json(message), timeout=WS_SEND_TIMEOUT)
+                except Exception as e:
+                    self.manager.drop_connection(self, f"发送失败: {e!r}")
+                    return
+                self.manager.count(self.username, 'sent')
+                if len(self._queue) <= WS_HIGH_WATER:
+                    self._over_since = None
+        except asyncio.CancelledError:
+            pass
+    
+    def close(self) -> int:
+        """
+        停止写任务并丢弃未发送的消息
+        
+        @return: 丢弃的消息数
+        """
+        if self.closed:
+            return 0
+        self.closed = True
+        dropped = len(self._queue)
+        self._queue.clear()
+        self._pending_keys.clear()
+        try:
+            current = asyncio.current_task()
+        except RuntimeError:
+            current = None
+        if self._task is not current:
+            self._task.cancel()
+        return dropped
+
 
 # WebSocket 连接管理器（按用户名分组连接）
 class ConnectionManager:
     def __init__(self):
         # username -> set(WebSocket)
         self.active_connections: Dict[str, Set[WebSocket]] = {}
+        self._senders: Dict[WebSocket, _ConnectionSender] = {}
         self._lock = threading.Lock()
+        # 计数：入队、已发送、被合并、被丢弃的消息，以及因积压/发送失败被断开的连接
+        self.counters = {
+            'queued': 0,
+            'sent': 0,
+            'coalesced': 0,
+            'dropped': 0,
+            'dropped_connections': 0,
+        }
+        # 按用户名分开的同一组计数（统计接口只返回当前用户的）
+        self.user_counters: Dict[str, Dict[str, int]] = {}
+
+    def count(self, username: str, name: str, n: int = 1):
+        """
+        累加一项计数（全局和所属用户各一份）
+        
+        @param username: 连接所属的用户名
+        @param name: 计数名（counters 中的键）
+        @param n: 增量
+        """
+        if n <= 0:
+            return
+        self.counters[name] += n
+        per_user = self.user_counters.get(username)
+        if per_user is None:
+            per_user = self.user_counters[username] = dict.fromkeys(self.counters, 0)
+        per_user[name] += n
 
     async def connect(self, websocket: WebSocket, token: Optional[str] = None) -> str:
         # 接受连接后解析用户名并加入映射
@@ -1943,65 +2712,209 @@ class ConnectionManager:
         except Exception:
             # 回退为默认用户名（避免抛出错误阻断连接）
             username = "admin"
+        sender = _ConnectionSender(self, websocket, username)
         with self._lock:
             conns = self.active_connections.setdefault(username, set())
             conns.add(websocket)
+            self._senders[websocket] = sender
         print(f"🔌 [WS] 用户 {username} 已连接 (当前连接数: {len(self.active_connections.get(username, []))})")
         return username
 
-    def disconnect(self, websocket: WebSocket):
+    def _remove(self, websocket: WebSocket) -> Optional[_ConnectionSender]:
         with self._lock:
+            sender = self._senders.pop(websocket, None)
             for user, conns in list(self.active_connections.items()):
                 if websocket in conns:
                     conns.remove(websocket)
                     if len(conns) == 0:
                         del self.active_connections[user]
-                    print(f"🔌 [WS] 断开连接: {user}")
-                    return
+                    break
+        if sender is not None:
+            self.count(sender.username, 'dropped', sender.close())
+        return sender
+
+    def disconnect(self, websocket: WebSocket):
+        sender = self._remove(websocket)
+        if sender is not None:
+            print(f"🔌 [WS] 断开连接: {sender.username}")
+
+    def drop_connection(self, sender: _ConnectionSender, reason: str):
+        """
+        断开积压或发送失败的连接（主事件循环上调用），前端会自动重连并重新拉取数据
+        
+        @param sender: 连接的发送器
+        @param reason: 断开原因（日志）
+        """
+        if self._remove(sender.websocket) is None:
+            return
+        self.count(sender.username, 'dropped_connections')
+        print(f"⚠️ [WS] 断开用户 {sender.username} 的慢连接: {reason}")
+        
+        async def close_socket():
+            try:
+                # 1013: Try Again Later
+                await sender.websocket.close(code=1013)
+            except Exception:
+                pass
+        asyncio.get_running_loop().create_task(close_socket())
+
+    def _enqueue(self, websockets: List[WebSocket], message: dict) -> int:
+        with self._lock:
+            senders = [self._senders[ws] for ws in websockets if ws in self._senders]
+        return sum(1 for sender in senders if sender.enqueue(message))
 
     async def send_message_to_user(self, username: str, message: dict):
-        """向指定用户的所有连接发送 JSON 消息"""
-        conns = []
+        """向指定用户的所有连接发送 JSON 消息（放入各连接的发送队列后立即返回）"""
         with self._lock:
-            if username in self.active_connections:
-                conns = list(self.active_connections[username])
+            conns = list(self.active_connections.get(username, ()))
         
         if not conns:
             print(f"⚠️ [WS] 用户 {username} 没有活跃的 WebSocket 连接")
             return
         
-        sent_count = 0
-        for ws in conns:
-            try:
-                await ws.send_json(message)
-                sent_count += 1
-            except Exception as e:
-                print(f"⚠️ [WS] 发送消息失败给 {username}: {e}")
-        
-        print(f"✅ [WS] 已向用户 {username} 的 {sent_count}/{len(conns)} 个连接发送消息: {message.get('type', 'unknown')}")
+        self._enqueue(conns, message)
     
     async def broadcast(self, message: dict):
-        """向所有连接的客户端广播消息（兼容旧代码）"""
-        print(f"[WebSocket广播] 开始广播消息: {message.get('type', 'unknown')}")
-        all_conns = []
+        """向所有连接的客户端广播消息（兼容旧代码，放入各连接的发送队列后立即返回）"""
         with self._lock:
-            for conns in self.active_connections.values():
-                all_conns.extend(list(conns))
-        
-        print(f"  - 当前连接数: {len(all_conns)}")
-        sent_count = 0
-        for ws in all_conns:
-            try:
-                await ws.send_json(message)
-                sent_count += 1
-            except Exception as e:
-                print(f"[WebSocket广播] 发送失败: {e}")
+            all_conns = [ws for conns in self.active_connections.values() for ws in conns]
+        queued = self._enqueue(all_conns, message)
+        print(f"[WebSocket广播] {message.get('type', 'unknown')} 已加入 {queued}/{len(all_conns)} 个连接的发送队列")
+    
+    def get_stats(self, username: Optional[str] = None) -> dict:
+        """
+        连接数、各连接的队列长度和消息计数
         
-        print(f"[WebSocket广播] 广播完成: 成功发送到 {sent_count}/{len(all_conns)} 个连接")
+        @param username: 只统计该用户的连接，None 表示全部连接
+        """
+        with self._lock:
+            senders = [s for s in self._senders.values() if username is None or s.username == username]
+        if username is None:
+            counters = self.counters
+        else:
+            counters = self.user_counters.get(username) or dict.fromkeys(self.counters, 0)
+        return {
+            **counters,
+            'connections': len(senders),
+            'queue_lengths': sorted((len(s._queue) for s in senders), reverse=True)[:10],
+        }
 
 
 # 全局 manager，用于在其他模块/线程中推送
 ws_manager = ConnectionManager()
+
+
+class NotificationBus:
+    """
+    WebSocket 通知总线
+    
+    任何线程调用 publish 都只是把 (用户名, 消息) 放入主事件循环上的队列并立即返回；
+    主事件循环上的分发任务按入队顺序把消息发给该用户自己的连接。
+    处理线程不会等待 WebSocket I/O，也不会在不属于这些连接的事件循环上发送。
+    """
+    
+    def __init__(self, manager: ConnectionManager):
+        self.manager = manager
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.published = 0
+        self.dropped = 0
+        # 用户名 -> [已入队, 已丢弃]
+        self._user_counts: Dict[str, List[int]] = {}
+    
+    def _count(self, username: str, index: int):
+        counts = self._user_counts.get(username)
+        if counts is None:
+            counts = self._user_counts[username] = [0, 0]
+        counts[index] += 1
+    
+    def get_stats(self, username: Optional[str] = None) -> dict:
+        """
+        已发布和已丢弃的消息数
+        
+        @param username: 只统计发给该用户的消息，None 表示全部
+        """
+        if username is None:
+            return {"published": self.published, "dropped": self.dropped}
+        published, dropped = self._user_counts.get(username, (0, 0))
+        return {"published": published, "dropped": dropped}
+    
+    def start(self, loop: asyncio.AbstractEventLoop):
+        """
+        在主事件循环中启动分发任务（应用启动时调用）
+        
+        @param loop: 持有 WebSocket 连接的事件循环
+        """
+        self._loop = loop
+        self._queue = asyncio.Queue()
+        self._task = loop.create_task(self._dispatch())
+        print("📢 [通知总线] 已启动")
+    
+    async def stop(self):
+        """发送完已入队的消息后停止分发任务（应用关闭时调用）"""
+        task, self._task = self._task, None
+        if task is None:
+            return
+        # 先让其他线程已提交的入队回调执行完
+        await asyncio.sleep(0)
+        if self._queue is not None and not self._queue.empty():
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=2)
+            except asyncio.TimeoutError:
+                print(f"⚠️ [通知总线] 关闭时仍有 {self._queue.qsize()} 条消息未发送")
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        self._loop = None
+    
+    def publish(self, username: Optional[str], message: dict) -> bool:
+        """
+        发布一条发给指定用户的消息（线程安全，不阻塞）
+        
+        @param username: 接收消息的用户名
+        @param message: JSON 消息
+        @return: 是否已入队
+        """
+        loop, queue = self._loop, self._queue
+        if not username:
+            print(f"⚠️ [通知总线] 消息没有指定用户，已丢弃: {message.get('type', 'unknown')}")
+            self.dropped += 1
+            return False
+        if loop is None or queue is None or loop.is_closed():
+            print(f"⚠️ [通知总线] 事件循环未就绪，已丢弃消息: {message.get('type', 'unknown')}")
+            self.dropped += 1
+            self._count(username, 1)
+            return False
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, (username, message))
+        except RuntimeError as e:
+            # 事件循环已关闭
+            print(f"⚠️ [通知总线] 消息入队失败: {e}")
+            self.dropped += 1
+            self._count(username, 1)
+            return False
+        self.published += 1
+        self._count(username, 0)
+        return True
+    
+    async def _dispatch(self):
+        while True:
+            username, message = await self._queue.get()
+            try:
+                await self.manager.send_message_to_user(username, message)
+            except Exception as e:
+                print(f"⚠️ [通知总线] 发送消息给 {username} 失败: {e}")
+            finally:
+                self._queue.task_done()
+            # 入队不会让出事件循环，每条消息后让各连接的写任务有机会发送
+            await asyncio.sleep(0)
+
+
+# 全局通知总线：工作线程和接口都通过它向指定用户推送消息
+notification_bus = NotificationBus(ws_manager)
 # ==================== WebSocket 连接 ====================
 
 @app.websocket("/api/ws")
@@ -2488,7 +3401,7 @@ async def update_profile(request: UpdateProfileRequest, current_username: str =
             del user_states[username]
             # 保存状态到文件（使用user_id，文件名不变）
             # 注意：此时user_data已保存，get_user_id_by_username会从文件加载，但新用户名已经在文件中了
-            save_user_email_data(new_username, user_state)
+            save_user_email_data(new_username, user_state, immediate=True)
             print(f"✓ 系统状态已更新")
     
     # 验证保存是否成功（重新加载数据）
@@ -2681,11 +3594,51 @@ async def logout_device(device_id: int, current_username: str = Depends(get_user
 
 # ==================== 邮件API ====================
 
+# 邮件列表视图（view=list）返回的字段，正文、回复、RAG查询、摘要等通过 /api/emails/{email_id} 获取
+EMAIL_LIST_FIELDS = ('id', 'subject', 'sender', 'time', 'status', 'category', 'urgency_level', 'preview', 'processing')
+
+
+def _parse_email_fields(fields: Optional[str], view: Optional[str]) -> Optional[tuple]:
+    """解析字段投影参数，返回需要的字段（None 表示返回完整记录）"""
+    if fields:
+        names = tuple(dict.fromkeys(f.strip() for f in fields.split(',') if f.strip()))
+        # id 总是返回，方便前端按ID获取详情
+        return names if 'id' in names else ('id',) + names
+    if view == 'list':
+        return EMAIL_LIST_FIELDS
+    return None
+
+
 @app.get("/api/emails")
-async def get_emails(status: Optional[str] = None, category: Optional[str] = None, current_username: str = Depends(get_username_from_request)):
-    """获取邮件列表（即使没有配置邮箱也返回空列表，不阻止用户查看页面）"""
+async def get_emails(
+    request: Request,
+    status: Optional[str] = None,
+    category: Optional[str] = None,
+    fields: Optional[str] = None,
+    view: Optional[str] = None,
+    current_username: str = Depends(get_username_from_request)
+):
+    """获取邮件列表（即使没有配置邮箱也返回空列表，不阻止用户查看页面）
+    
+    @param fields: 逗号分隔的字段列表，只返回这些字段（如 fields=id,subject,status）
+    @param view: view=list 时返回列表展示所需的精简字段（EMAIL_LIST_FIELDS）
+    
+    响应带 ETag（用户数据版本 + 查询参数），请求头 If-None-Match 匹配时返回 304
+    """
     try:
         user_state = get_user_state(current_username)
+        projection = _parse_email_fields(fields, view)
+        
+        # 数据未变化时直接返回 304，不再复制和序列化邮件
+        etag = 'W/"emails-{}-{}"'.format(
+            user_state.change_log.etag_token(),
+            format(hash((status, category, projection)) & 0xffffffff, 'x')
+        )
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return Response(status_code=304, headers=headers)
+        
         emails = user_state.emails_cache.copy()
         
         # 筛选
@@ -2698,10 +3651,13 @@ async def get_emails(status: Optional[str] = None, category: Optional[str] = Non
         if category:
             emails = [e for e in emails if e.get('category') == category]
         
+        if projection is not None:
+            emails = [{name: e.get(name) for name in projection} for e in emails]
+        
         # 只返回真实数据，不使用模拟数据
         # 如果缓存为空，返回空数组
         
-        return {"emails": emails, "total": len(emails)}
+        return JSONResponse(jsonable_encoder({"emails": emails, "total": len(emails)}), headers=headers)
     except Exception as e:
         # 即使出错也返回空列表，不阻止用户查看页面
         print(f"获取邮件列表失败: {e}")
@@ -2712,9 +3668,9 @@ async def get_email_detail(email_id: str, current_username: str = Depends(get_us
     """获取邮件详情"""
     email_id = unquote(email_id)
     user_state = get_user_state(current_username)
-    for email in user_state.emails_cache:
-        if email.get('id') == email_id:
-            return email
+    email = user_state.emails_cache.get(email_id)
+    if email is not None:
+        return email
     raise HTTPException(status_code=404, detail="邮件不存在")
 
 @app.post("/api/emails/{email_id:path}/process")
@@ -2724,11 +3680,7 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
     user_state = get_user_state(current_username)
     
     # 查找邮件
-    email = None
-    for e in user_state.emails_cache:
-        if e.get('id') == email_id:
-            email = e
-            break
+    email = user_state.emails_cache.get(email_id)
     
     if not email:
         raise HTTPException(status_code=404, detail="邮件不存在")
@@ -2755,7 +3707,7 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
             pass
     
     # 通过WebSocket通知前端邮件开始处理
-    await ws_manager.broadcast({
+    notification_bus.publish(current_username, {
         "type": "email_process_started",
         "email_id": email_id,
         "message": "开始处理邮件"
@@ -2772,6 +3724,8 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
         # 重新获取用户状态（确保使用最新的数据）
         task_user_state = get_user_state(current_username)
         user_lock = get_user_lock(current_username)
+        # 终止时立即中断进行中的模型调用，随后由检查点恢复邮件状态
+        task_token = task_user_state.email_token(task_email_id)
         
         # 辅助函数：检查并处理终止
         def check_and_handle_stop(checkpoint_name):
@@ -2784,23 +3738,19 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
                 print(f"⏹️ [批量处理终止] 邮件 {task_email_id} 在{checkpoint_name}被终止（全局停止标志）")
                 with user_lock:
                     # 查找邮件并恢复状态
-                    for e in task_user_state.emails_cache:
-                        if e.get('id') == task_email_id:
-                            e['status'] = 'pending'
-                            e['processing'] = False
-                            break
+                    e = task_user_state.emails_cache.get(task_email_id)
+                    if e is not None:
+                        e['status'] = 'pending'
+                        e['processing'] = False
                     save_user_email_data(current_username, task_user_state)
                 print(f"⏹️ [批量处理终止] 已恢复邮件 {task_email_id} 的状态")
                 
                 # 发送WebSocket通知（真正终止成功）
-                asyncio.run_coroutine_threadsafe(
-                    ws_manager.broadcast({
-                        "type": "email_process_stopped",
-                        "email_id": task_email_id,
-                        "message": "已终止处理"
-                    }),
-                    websocket_event_loop
-                )
+                notification_bus.publish(current_username, {
+                    "type": "email_process_stopped",
+                    "email_id": task_email_id,
+                    "message": "已终止处理"
+                })
                 
                 return True
             
@@ -2809,25 +3759,21 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
                 print(f"⏹️ [单封邮件处理] 邮件 {task_email_id} 在{checkpoint_name}被终止")
                 with user_lock:
                     # 查找邮件并恢复状态
-                    for e in task_user_state.emails_cache:
-                        if e.get('id') == task_email_id:
-                            e['status'] = 'pending'
-                            e['processing'] = False
-                            break
+                    e = task_user_state.emails_cache.get(task_email_id)
+                    if e is not None:
+                        e['status'] = 'pending'
+                        e['processing'] = False
                     # 主动清除终止标记
                     task_user_state.stopped_email_ids.discard(task_email_id)
                     save_user_email_data(current_username, task_user_state)
                 print(f"⏹️ [单封邮件处理] 已清除邮件 {task_email_id} 的终止标记")
                 
                 # 发送WebSocket通知（真正终止成功）
-                asyncio.run_coroutine_threadsafe(
-                    ws_manager.broadcast({
-                        "type": "email_process_stopped",
-                        "email_id": task_email_id,
-                        "message": "已终止处理"
-                    }),
-                    websocket_event_loop
-                )
+                notification_bus.publish(current_username, {
+                    "type": "email_process_stopped",
+                    "email_id": task_email_id,
+                    "message": "已终止处理"
+                })
                 
                 return True
             
@@ -2838,11 +3784,7 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
             return {'status': 'cancelled', 'message': '处理已终止', 'reply': None}
         
         # 根据ID重新查找邮件
-        task_email = None
-        for e in task_user_state.emails_cache:
-            if e.get('id') == task_email_id:
-                task_email = e
-                break
+        task_email = task_user_state.emails_cache.get(task_email_id)
         
         if not task_email:
             print(f"邮件不存在: {task_email_id}")
@@ -2884,6 +3826,7 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
                 sender=task_email.get('sender', ''),
                 subject=task_email.get('subject', ''),
                 body=task_email.get('body', ''),
+                quoted_context=task_email.get('quoted_context', ''),
                 imap_id=task_email.get('imap_id', b'')
             )
             
@@ -2914,7 +3857,7 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
             print(f"  - 发件人: {task_email.get('sender', '')}")
             print(f"  - 内容预览: {task_email.get('body', '')[:200]}...")
             
-            categorize_result = nodes.categorize_email(state)
+            categorize_result = run_node_stage(task_token, nodes, 'categorize_email', state)
             state.update(categorize_result)
             category = state.get('email_category', 'product_enquiry')
             task_email['category'] = category
@@ -2954,7 +3897,7 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
                 imap_id = task_email.get('imap_id')
                 if imap_id:
                     try:
-                        nodes.email_tools.mark_email_as_read(imap_id)
+                        nodes.email_tools.queue_mark_as_read(imap_id)
                     except:
                         pass
                 
@@ -2967,10 +3910,10 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
                 task_user_state.stats['pending'] = max(0, task_user_state.stats['pending'] - 1)
                 
                 # 添加到历史记录
-                task_user_state.history.insert(0, {
+                task_user_state.history.insert(0, make_email_record({
                     **task_email,
                     'processed_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                })
+                }))
                 
                 # 自动保存数据
                 save_user_email_data(current_username, task_user_state)
@@ -3004,23 +3947,20 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
                     return {'status': 'cancelled', 'message': '处理已终止', 'reply': None}
                 
                 print(f"正在进行RAG查询（类型: {category}）...")
-                rag_query_result = nodes.construct_rag_queries(state)
+                rag_query_result = run_node_stage(task_token, nodes, 'construct_rag_queries', state)
                 state.update(rag_query_result)
                 
                 # 发送 WebSocket 通知：显示生成的 RAG 查询问题
                 rag_queries = state.get('rag_queries', [])
                 if rag_queries:
-                    asyncio.run_coroutine_threadsafe(
-                        ws_manager.broadcast({
-                            "type": "rag_queries_generated",
-                            "email_id": task_email_id,
-                            "queries": rag_queries,
-                            "count": len(rag_queries)
-                        }),
-                        websocket_event_loop
-                    )
+                    notification_bus.publish(current_username, {
+                        "type": "rag_queries_generated",
+                        "email_id": task_email_id,
+                        "queries": rag_queries,
+                        "count": len(rag_queries)
+                    })
                 
-                rag_result = nodes.retrieve_from_rag(state)
+                rag_result = run_node_stage(task_token, nodes, 'retrieve_from_rag', state)
                 state.update(rag_result)
             else:
                 state['retrieved_documents'] = ""
@@ -3042,7 +3982,7 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
                 if check_and_handle_stop(f"编写回复循环中（第{trial+1}次尝试）"):
                     return {'status': 'cancelled', 'message': '处理已终止', 'reply': None}
                 
-                write_result = nodes.write_draft_email(state)
+                write_result = run_node_stage(task_token, nodes, 'write_draft_email', state)
                 state.update(write_result)
                 
                 # 检查点7：验证前
@@ -3050,7 +3990,7 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
                     return {'status': 'cancelled', 'message': '处理已终止', 'reply': None}
                 
                 # 5. 验证邮件（同步阻塞操作）
-                verify_result = nodes.verify_generated_email(state)
+                verify_result = run_node_stage(task_token, nodes, 'verify_generated_email', state)
                 state.update(verify_result)
                 
                 # 检查点7.5：验证后
@@ -3096,12 +4036,15 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
                     print(f"❌ 自动发送回复时出错: {send_err}")
                     # 发送失败，保持 processed 状态，用户可以手动发送
                     task_email['status'] = 'processed'
+                if task_email.get('status') == 'processed':
+                    # 达到速率限制或发送失败：交给发送队列在下一个可发送时刻发送
+                    queue_auto_send(current_username, task_email)
             
             # 8. 标记QQ邮箱中的邮件为已读
             imap_id = task_email.get('imap_id')
             if imap_id:
                 try:
-                    nodes.email_tools.mark_email_as_read(imap_id)
+                    nodes.email_tools.queue_mark_as_read(imap_id)
                     print(f"邮件已标记为已读: {task_email.get('subject', '')}")
                 except Exception as mark_err:
                     print(f"标记已读失败: {mark_err}")
@@ -3111,10 +4054,10 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
             task_user_state.stats['pending'] = max(0, task_user_state.stats['pending'] - 1)
             
             # 10. 添加到历史记录
-            task_user_state.history.insert(0, {
+            task_user_state.history.insert(0, make_email_record({
                 **task_email,
                 'processed_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            })
+            }))
             
             # 11. 记录操作（如果还没有记录）
             if not auto_send or not generated_reply or task_email.get('status') != 'sent':
@@ -3169,11 +4112,11 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
             traceback.print_exc()
             
             # 处理失败时，也添加到历史记录中，这样即使从缓存中删除，统计数据也不会丢失
-            task_user_state.history.insert(0, {
+            task_user_state.history.insert(0, make_email_record({
                 **task_email,
                 'status': 'failed',  # 明确设置为 'failed'
                 'processed_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            })
+            }))
             print(f"DEBUG [process_email_sync]: 处理失败，已添加到历史记录，ID: {task_email.get('id')}, Status: failed")
             
             # 自动保存数据
@@ -3194,13 +4137,11 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
             # 限制在合理范围内（2-20）
             single_email_concurrency = max(2, min(20, int(single_email_concurrency)))
             
-            # 获取或创建单封邮件处理线程池
-            email_pool = get_or_create_single_email_thread_pool(single_email_concurrency)
-            
-            # 在线程池中执行同步阻塞的AI操作，避免阻塞事件循环
-            # 使用单封邮件处理线程池，避免占用主线程池
-            loop = asyncio.get_event_loop()
-            result = await loop.run_in_executor(email_pool, process_email_sync)
+            # 交给邮件处理调度器执行同步阻塞的AI操作，避免阻塞事件循环
+            # 同一用户同时处理的单封邮件不超过 singleEmailConcurrency
+            result = await asyncio.wrap_future(pipeline_scheduler.submit(
+                current_username, 'single', process_email_sync, cap=single_email_concurrency
+            ))
             
             if result:
                 # 如果状态是 cancelled，说明已被终止，不发送完成通知
@@ -3208,6 +4149,9 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
                     print(f"[WebSocket发送] 邮件 {email_id} 已被终止，跳过发送完成通知")
                     return
                 
+                if result.get('status') in ('processed', 'sent'):
+                    user_state.response_slo.record(email)
+                
                 # 通过 WebSocket 通知前端
                 ws_message = {
                     "type": "email_process_complete",
@@ -3226,14 +4170,14 @@ async def process_email(email_id: str, current_username: str = Depends(get_usern
                 print(f"  - RAG查询: {len(result.get('rag_queries', []))} 个")
                 print(f"  - 当前连接数: {len(ws_manager.active_connections)}")
                 
-                await ws_manager.broadcast(ws_message)
+                notification_bus.publish(current_username, ws_message)
                 print(f"[WebSocket发送] 已发送 email_process_complete 消息")
         except Exception as e:
             print(f"异步任务错误: {e}")
             import traceback
             traceback.print_exc()
             # 通知前端处理失败
-            await ws_manager.broadcast({
+            notification_bus.publish(current_username, {
                 "type": "email_process_complete",
                 "email_id": email_id,
                 "message": f"处理失败: {str(e)}",
@@ -3271,12 +4215,8 @@ async def re_retrieve_email(
     user_lock = get_user_lock(current_username)
     
     # 查找邮件
-    email = None
     with user_lock:
-        for e in user_state.emails_cache:
-            if e.get('id') == email_id:
-                email = e
-                break
+        email = user_state.emails_cache.get(email_id)
     
     if not email:
         raise HTTPException(status_code=404, detail="邮件不存在")
@@ -3337,6 +4277,7 @@ async def re_retrieve_email(
                 sender=email.get('sender', ''),
                 subject=email.get('subject', ''),
                 body=email.get('body', ''),
+                quoted_context=email.get('quoted_context', ''),
                 imap_id=email.get('imap_id', b'')
             )
             
@@ -3411,14 +4352,13 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
     user_lock = get_user_lock(current_username)
     with user_lock:
         # 重置停止标志（确保之前的终止操作不会影响本次处理）
-        user_state.stop_processing = False
-        user_state.stopped_email_ids.clear()
+        user_state.reset_stop_flags()
         print(f"🔄 [批量处理] 重置停止标志，开始新的批量处理")
         
         # 获取待处理邮件列表（排除已经在处理中的邮件，避免重复处理）
         pending_emails = [
-            e for e in user_state.emails_cache 
-            if e.get('status') == 'pending'
+            e for e in user_state.emails_cache.by_status('pending')
+            if e.get('id') not in user_state.queued_email_ids
         ]
     
     if not pending_emails:
@@ -3442,10 +4382,9 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
         # 根据ID重新查找待处理的邮件（因为状态可能已经变化）
         emails_to_process = []
         for email_id in pending_email_ids:
-            for e in task_user_state.emails_cache:
-                if e.get('id') == email_id and e.get('status') == 'processing':
-                    emails_to_process.append(e)
-                    break
+            e = task_user_state.emails_cache.get(email_id)
+            if e is not None and e.get('status') == 'processing':
+                emails_to_process.append(e)
         
         if not emails_to_process:
             print("没有需要处理的邮件（可能已被其他操作处理）")
@@ -3456,6 +4395,9 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                 "email_results": []
             }
         
+        # 同一会话只处理最新一封，更早的邮件作为上下文并一并标记
+        emails_to_process, superseded_by_id = group_emails_by_thread(emails_to_process)
+        
         print(f"🚀 [并发处理] 开始处理 {len(emails_to_process)} 封邮件，使用线程池并发处理")
         
         # 分类名称映射
@@ -3491,10 +4433,9 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
             # 标记所有邮件为失败
             with user_lock:
                 for email_id in pending_email_ids:
-                    for e in task_user_state.emails_cache:
-                        if e.get('id') == email_id and e.get('status') == 'processing':
-                            e['status'] = 'failed'
-                            break
+                    e = task_user_state.emails_cache.get(email_id)
+                    if e is not None and e.get('status') == 'processing':
+                        e['status'] = 'failed'
             return {
                 "processed": 0,
                 "skipped": 0,
@@ -3505,6 +4446,8 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
         def process_single_email(email):
             """处理单封邮件的函数（在线程池中并发执行）"""
             email_id = email.get('id', '')
+            # 终止全部处理或终止该邮件时取消，进行中的模型调用会被立即中断
+            token = task_user_state.email_token(email_id)
             
             # 检查是否被终止
             if email_id in task_user_state.stopped_email_ids:
@@ -3520,21 +4463,18 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                 }
             
             # 检查全局停止标志
-            if task_user_state.stop_processing:
+            if token.cancelled:
                 print(f"⏹️ [并发处理] 检测到全局停止标志，跳过邮件 {email_id}")
                 with user_lock:
                     email['status'] = 'pending'
                     email['processing'] = False
                 
                 # 发送WebSocket通知（单封邮件终止成功）
-                asyncio.run_coroutine_threadsafe(
-                    ws_manager.broadcast({
-                        "type": "email_process_stopped",
-                        "email_id": email_id,
-                        "message": "已终止处理"
-                    }),
-                    websocket_event_loop
-                )
+                notification_bus.publish(current_username, {
+                    "type": "email_process_stopped",
+                    "email_id": email_id,
+                    "message": "已终止处理"
+                })
                 
                 return {
                     'email_id': email_id,
@@ -3569,6 +4509,8 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                     sender=email.get('sender', ''),
                     subject=email.get('subject', ''),
                     body=email.get('body', ''),
+                    quoted_context=email.get('quoted_context', ''),
+                    thread_context=build_thread_context(superseded_by_id.get(email_id, [])),
                     imap_id=email.get('imap_id', b'')
                 )
                 
@@ -3586,7 +4528,7 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                 }
                 
                 # 1. 分类邮件
-                categorize_result = nodes.categorize_email(state)
+                categorize_result = run_node_stage(token, nodes, 'categorize_email', state)
                 state.update(categorize_result)
                 category = state.get('email_category', 'product_enquiry')
                 
@@ -3605,7 +4547,7 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                         imap_id = email.get('imap_id')
                         if imap_id:
                             try:
-                                nodes.email_tools.mark_email_as_read(imap_id)
+                                nodes.email_tools.queue_mark_as_read(imap_id)
                             except:
                                 pass
                     
@@ -3635,19 +4577,16 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                 # 3. RAG查询
                 if category != 'unrelated':
                     # 检查点：RAG查询前
-                    if task_user_state.stop_processing:
+                    if token.cancelled:
                         print(f"⏹️ [批量处理终止] 邮件 {email_id} 在RAG查询前被终止")
                         with user_lock:
                             email['status'] = 'pending'
                             email['processing'] = False
-                        asyncio.run_coroutine_threadsafe(
-                            ws_manager.broadcast({
-                                "type": "email_process_stopped",
-                                "email_id": email_id,
-                                "message": "已终止处理"
-                            }),
-                            websocket_event_loop
-                        )
+                        notification_bus.publish(current_username, {
+                            "type": "email_process_stopped",
+                            "email_id": email_id,
+                            "message": "已终止处理"
+                        })
                         return {
                             'email_id': email_id,
                             'status': 'cancelled',
@@ -3656,41 +4595,35 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                         }
                     
                     print(f"🔍 [并发处理] 正在进行RAG查询（类型: {category}）...")
-                    rag_query_result = nodes.construct_rag_queries(state)
+                    rag_query_result = run_node_stage(token, nodes, 'construct_rag_queries', state)
                     state.update(rag_query_result)
                     
                     # 发送通知：显示生成的 RAG 查询问题
                     rag_queries = state.get('rag_queries', [])
                     if rag_queries:
-                        asyncio.run_coroutine_threadsafe(
-                            ws_manager.broadcast({
-                                "type": "rag_queries_generated",
-                                "email_id": email_id,
-                                "queries": rag_queries,
-                                "count": len(rag_queries)
-                            }),
-                            websocket_event_loop
-                        )
+                        notification_bus.publish(current_username, {
+                            "type": "rag_queries_generated",
+                            "email_id": email_id,
+                            "queries": rag_queries,
+                            "count": len(rag_queries)
+                        })
                     
-                    rag_result = nodes.retrieve_from_rag(state)
+                    rag_result = run_node_stage(token, nodes, 'retrieve_from_rag', state)
                     state.update(rag_result)
                 else:
                     state['retrieved_documents'] = ""
                 
                 # 检查点：RAG查询后
-                if task_user_state.stop_processing:
+                if token.cancelled:
                     print(f"⏹️ [批量处理终止] 邮件 {email_id} 在RAG查询后被终止")
                     with user_lock:
                         email['status'] = 'pending'
                         email['processing'] = False
-                    asyncio.run_coroutine_threadsafe(
-                        ws_manager.broadcast({
-                            "type": "email_process_stopped",
-                            "email_id": email_id,
-                            "message": "已终止处理"
-                        }),
-                        websocket_event_loop
-                    )
+                    notification_bus.publish(current_username, {
+                        "type": "email_process_stopped",
+                        "email_id": email_id,
+                        "message": "已终止处理"
+                    })
                     return {
                         'email_id': email_id,
                         'status': 'cancelled',
@@ -3702,19 +4635,16 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                 max_trials = 3
                 for trial in range(max_trials):
                     # 检查点：每次重试前
-                    if task_user_state.stop_processing:
+                    if token.cancelled:
                         print(f"⏹️ [批量处理终止] 邮件 {email_id} 在编写回复前被终止（第{trial+1}次尝试）")
                         with user_lock:
                             email['status'] = 'pending'
                             email['processing'] = False
-                        asyncio.run_coroutine_threadsafe(
-                            ws_manager.broadcast({
-                                "type": "email_process_stopped",
-                                "email_id": email_id,
-                                "message": "已终止处理"
-                            }),
-                            websocket_event_loop
-                        )
+                        notification_bus.publish(current_username, {
+                            "type": "email_process_stopped",
+                            "email_id": email_id,
+                            "message": "已终止处理"
+                        })
                         return {
                             'email_id': email_id,
                             'status': 'cancelled',
@@ -3722,23 +4652,20 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                             'reply': None
                         }
                     
-                    write_result = nodes.write_draft_email(state)
+                    write_result = run_node_stage(token, nodes, 'write_draft_email', state)
                     state.update(write_result)
                     
                     # 检查点：验证前
-                    if task_user_state.stop_processing:
+                    if token.cancelled:
                         print(f"⏹️ [批量处理终止] 邮件 {email_id} 在验证前被终止（第{trial+1}次尝试）")
                         with user_lock:
                             email['status'] = 'pending'
                             email['processing'] = False
-                        asyncio.run_coroutine_threadsafe(
-                            ws_manager.broadcast({
-                                "type": "email_process_stopped",
-                                "email_id": email_id,
-                                "message": "已终止处理"
-                            }),
-                            websocket_event_loop
-                        )
+                        notification_bus.publish(current_username, {
+                            "type": "email_process_stopped",
+                            "email_id": email_id,
+                            "message": "已终止处理"
+                        })
                         return {
                             'email_id': email_id,
                             'status': 'cancelled',
@@ -3746,23 +4673,20 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                             'reply': None
                         }
                     
-                    verify_result = nodes.verify_generated_email(state)
+                    verify_result = run_node_stage(token, nodes, 'verify_generated_email', state)
                     state.update(verify_result)
                     
                     # 检查点：验证后
-                    if task_user_state.stop_processing:
+                    if token.cancelled:
                         print(f"⏹️ [批量处理终止] 邮件 {email_id} 在验证后被终止（第{trial+1}次尝试）")
                         with user_lock:
                             email['status'] = 'pending'
                             email['processing'] = False
-                        asyncio.run_coroutine_threadsafe(
-                            ws_manager.broadcast({
-                                "type": "email_process_stopped",
-                                "email_id": email_id,
-                                "message": "已终止处理"
-                            }),
-                            websocket_event_loop
-                        )
+                        notification_bus.publish(current_username, {
+                            "type": "email_process_stopped",
+                            "email_id": email_id,
+                            "message": "已终止处理"
+                        })
                         return {
                             'email_id': email_id,
                             'status': 'cancelled',
@@ -3810,7 +4734,7 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                 imap_id = email.get('imap_id')
                 if imap_id:
                     try:
-                        nodes.email_tools.mark_email_as_read(imap_id)
+                        nodes.email_tools.queue_mark_as_read(imap_id)
                     except:
                         pass
                 
@@ -3821,12 +4745,15 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                     email['status'] = final_status
                     task_user_state.stats['processed'] += 1
                     task_user_state.stats['pending'] = max(0, task_user_state.stats['pending'] - 1)
-                    task_user_state.history.insert(0, {
+                    task_user_state.history.insert(0, make_email_record({
                         **email,
                         'processed_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    })
+                    }))
                     if not auto_send or not generated_reply or final_status != 'sent':
                         task_user_state.add_activity('success', f'处理了邮件: {category_label}', 'CircleCheck')
+                    if auto_send and generated_reply and final_status != 'sent':
+                        # 达到速率限制或发送失败：交给发送队列在下一个可发送时刻发送
+                        queue_auto_send(current_username, email)
                     
                     # 异步生成摘要（不阻塞主流程）
                     email_id = email.get('id')
@@ -3865,11 +4792,11 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                 with user_lock:
                     email['status'] = 'failed'
                     task_user_state.stats['failed'] += 1
-                    task_user_state.history.insert(0, {
+                    task_user_state.history.insert(0, make_email_record({
                         **email,
                         'status': 'failed',
                         'processed_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    })
+                    }))
                 return {
                     'email_id': email_id,
                         'status': 'failed',
@@ -3883,59 +4810,62 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
         # 限制 batch_size 在合理范围内（1-30，允许更高的并发）
         batch_size = max(1, min(30, int(batch_size)))
         
-        # 使用独立的批量处理线程池（不会影响其他API请求）
-        batch_pool = get_or_create_batch_thread_pool(batch_size)
+        print(f"📦 [并发处理] 共 {len(emails_to_process)} 封邮件，保持 {batch_size} 封同时处理（处理调度器线程数: {pipeline_scheduler.workers}，主线程池大小: {thread_pool._max_workers}）")
         
-        total_batches = (len(emails_to_process) + batch_size - 1) // batch_size
-        
-        print(f"📦 [并发处理] 将 {len(emails_to_process)} 封邮件分成 {total_batches} 批，每批最多 {batch_size} 封（批量线程池大小: {batch_pool._max_workers}，主线程池大小: {thread_pool._max_workers}）")
-        
-        # 分批并发处理
-        for batch_idx in range(total_batches):
-            start_idx = batch_idx * batch_size
-            end_idx = min(start_idx + batch_size, len(emails_to_process))
-            batch_emails = emails_to_process[start_idx:end_idx]
-            
-            print(f"🔄 [并发处理] 处理第 {batch_idx + 1}/{total_batches} 批，包含 {len(batch_emails)} 封邮件")
-            
-            # 提交批次内的所有邮件到批量处理线程池（独立线程池，不影响其他操作）
-            future_to_email = {
-                batch_pool.submit(process_single_email, email): email 
-                for email in batch_emails
-            }
-            
-            # 等待批次完成并收集结果
-            for future in as_completed(future_to_email):
-                email = future_to_email[future]
-                try:
-                    result = future.result()
-                    email_results.append(result)
-                    
-                    # 更新计数器（使用锁保护）
-                    with user_lock:
-                        if result['status'] == 'processed':
-                            processed_count += 1
-                        elif result['status'] == 'skipped':
-                            skipped_count += 1
-                        elif result['status'] == 'failed':
-                            failed_count += 1
-                except Exception as e:
-                    print(f"❌ [并发处理] 获取处理结果时出错: {e}")
-                    import traceback
-                    traceback.print_exc()
-                    # 使用锁保护状态更新
-                    with user_lock:
-                        email['status'] = 'failed'
-                        task_user_state.stats['failed'] += 1
+        def on_email_done(email, future, done_count, total, in_flight):
+            nonlocal processed_count, skipped_count, failed_count
+            final_status = 'failed'
+            try:
+                result = future.result()
+                email_results.append(result)
+                final_status = email.get('status') if result['status'] == 'processed' else result['status']
+                
+                # 更新计数器（使用锁保护）
+                with user_lock:
+                    if result['status'] == 'processed':
+                        processed_count += 1
+                    elif result['status'] == 'skipped':
+                        skipped_count += 1
+                    elif result['status'] == 'failed':
                         failed_count += 1
-                    email_results.append({
-                        'email_id': email.get('id'),
-                        'status': 'failed',
-                        'message': f"处理异常: {str(e)}",
-                        'reply': None  # 失败时没有回复内容
-                    })
-            
-            print(f"✅ [并发处理] 第 {batch_idx + 1}/{total_batches} 批处理完成")
+            except Exception as e:
+                print(f"❌ [并发处理] 获取处理结果时出错: {e}")
+                import traceback
+                traceback.print_exc()
+                # 使用锁保护状态更新
+                with user_lock:
+                    email['status'] = 'failed'
+                    task_user_state.stats['failed'] += 1
+                    failed_count += 1
+                email_results.append({
+                    'email_id': email.get('id'),
+                    'status': 'failed',
+                    'message': f"处理异常: {str(e)}",
+                    'reply': None  # 失败时没有回复内容
+                })
+            if final_status in ('processed', 'sent'):
+                task_user_state.response_slo.record(email)
+            finish_superseded_emails(
+                current_username, task_user_state, email,
+                superseded_by_id.get(email.get('id', ''), []), final_status,
+                QQEmailToolsClass(email_address=email_address, auth_code=auth_code)
+            )
+            notification_bus.publish(current_username, {
+                "type": "process_all_progress",
+                "done": done_count,
+                "total": total,
+                "in_flight": in_flight,
+                "processed": processed_count,
+                "skipped": skipped_count,
+                "failed": failed_count
+            })
+        
+        # 按回复截止时间从早到晚处理（紧急邮件优先），任意一封完成立即开始下一封
+        run_pipeline_tasks(current_username, 'batch', emails_to_process, process_single_email, batch_size,
+                           on_email_done, priority=response_deadline)
+        
+        # 全部完成后统一提交已读标记（一条 UID STORE 命令）
+        QQEmailToolsClass(email_address=email_address, auth_code=auth_code).flush_mark_as_read()
         
         # 自动保存数据（处理全部邮件完成后）
         with user_lock:
@@ -3970,7 +4900,7 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
             if cancelled_count > 0:
                 message = f"已终止批量处理: {result['processed']} 封成功, {result['skipped']} 封跳过, {cancelled_count} 封已终止, {result['failed']} 封失败"
                 
-                await ws_manager.broadcast({
+                notification_bus.publish(current_username, {
                     "type": "process_all_stopped",
                     "message": message,
                     "processed": result['processed'],
@@ -3982,7 +4912,7 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
                 # 正常完成，发送 process_all_complete 消息
                 message = f"处理完成: {result['processed']} 封成功, {result['skipped']} 封跳过, {result['failed']} 封失败"
                 
-                await ws_manager.broadcast({
+                notification_bus.publish(current_username, {
                     "type": "process_all_complete",
                     "message": message,
                     "processed": result['processed'],
@@ -3994,7 +4924,7 @@ async def process_all_emails(background_tasks: BackgroundTasks, current_username
             import traceback
             traceback.print_exc()
             # 通知前端处理失败
-            await ws_manager.broadcast({
+            notification_bus.publish(current_username, {
                 "type": "process_all_complete",
                 "message": f"处理失败: {str(e)}",
                 "processed": 0,
@@ -4017,12 +4947,14 @@ async def stop_process_all(current_username: str = Depends(get_username_from_req
     user_lock = get_user_lock(current_username)
     
     with user_lock:
-        # 设置停止标志
+        # 设置停止标志，并取消处理令牌：进行中的模型调用立即中断
         user_state.stop_processing = True
+        cancelled_token = user_state.processing_token
+        cancelled_token.cancel("终止全部处理")
         
         # 将所有processing状态的邮件设置为stopping（正在终止）
         stopping_count = 0
-        for email in user_state.emails_cache:
+        for email in user_state.emails_cache.by_status('processing'):
             if email.get('status') == 'processing':
                 email['status'] = 'stopping'
                 # processing 保持为 True，让按钮继续显示禁用状态
@@ -4032,7 +4964,7 @@ async def stop_process_all(current_username: str = Depends(get_username_from_req
         save_user_email_data(current_username, user_state)
     
     # 通过WebSocket通知前端（状态为 stopping）
-    await ws_manager.broadcast({
+    notification_bus.publish(current_username, {
         "type": "process_all_stopping",
         "message": f"正在终止批量处理，{stopping_count} 封邮件正在终止...",
         "count": stopping_count
@@ -4043,9 +4975,10 @@ async def stop_process_all(current_username: str = Depends(get_username_from_req
     async def reset_stop_flag():
         await asyncio.sleep(300)  # 5分钟
         with user_lock:
-            user_state.stop_processing = False
-            user_state.stopped_email_ids.clear()
-            print(f"⏹️ [终止处理] 已重置全局停止标志（5分钟后）")
+            # 期间已开始新的处理（令牌已更换）时不再重置，避免清除之后的终止
+            if user_state.processing_token is cancelled_token:
+                user_state.reset_stop_flags()
+                print(f"⏹️ [终止处理] 已重置全局停止标志（5分钟后）")
     
     asyncio.create_task(reset_stop_flag())
     
@@ -4065,17 +4998,20 @@ async def stop_process_email(email_id: str, current_username: str = Depends(get_
     with user_lock:
         # 添加到终止列表
         user_state.stopped_email_ids.add(email_id)
+        # 取消该邮件的令牌：进行中的模型调用立即中断
+        token = user_state.email_tokens.get(email_id)
+        if token is not None:
+            token.cancel("终止单封邮件处理")
         
         # 查找邮件，检查是否正在处理
         email_found = False
-        for email in user_state.emails_cache:
-            if email.get('id') == email_id:
-                if email.get('status') == 'processing':
-                    # 不立即更新状态为 pending，而是设置为 stopping（正在终止）
-                    email['status'] = 'stopping'
-                    # processing 保持为 True，让按钮继续显示禁用状态
-                    email_found = True
-                break
+        email = user_state.emails_cache.get(email_id)
+        if email is not None:
+            if email.get('status') == 'processing':
+                # 不立即更新状态为 pending，而是设置为 stopping（正在终止）
+                email['status'] = 'stopping'
+                # processing 保持为 True，让按钮继续显示禁用状态
+                email_found = True
         
         if not email_found:
             return {"message": "邮件未找到或未在处理中", "success": False}
@@ -4084,7 +5020,7 @@ async def stop_process_email(email_id: str, current_username: str = Depends(get_
         save_user_email_data(current_username, user_state)
     
     # 通过WebSocket通知前端（状态为 stopping）
-    await ws_manager.broadcast({
+    notification_bus.publish(current_username, {
         "type": "email_process_stopping",
         "email_id": email_id,
         "message": "正在终止处理..."
@@ -4113,26 +5049,27 @@ async def send_reply(request: SendReplyRequest, current_username: str = Depends(
     """发送邮件回复"""
     email_id = request.email_id
     user_state = get_user_state(current_username)
-    for email in user_state.emails_cache:
-        if email.get('id') == email_id:
-            try:
-                # 获取当前用户的邮箱配置
-                email_address, auth_code = get_user_email_config(current_username)
-                email_tools = QQEmailToolsClass(email_address=email_address, auth_code=auth_code)
-                
-                # 创建邮件对象
-                class EmailObj:
-                    def __init__(self, data):
-                        self.sender = data.get('sender', '')
-                        self.subject = data.get('subject', '')
-                        self.messageId = data.get('messageId', '')
-                        self.references = data.get('references', '')
-                        self.imap_id = data.get('imap_id', b'')
-                
-                email_obj = EmailObj(email)
-                result = email_tools.send_reply(email_obj, request.reply)
-                
-                if result:
+    email = user_state.emails_cache.get(email_id)
+    if email is not None:
+        try:
+            # 获取当前用户的邮箱配置
+            email_address, auth_code = get_user_email_config(current_username)
+            email_tools = QQEmailToolsClass(email_address=email_address, auth_code=auth_code)
+            
+            # 创建邮件对象
+            class EmailObj:
+                def __init__(self, data):
+                    self.sender = data.get('sender', '')
+                    self.subject = data.get('subject', '')
+                    self.messageId = data.get('messageId', '')
+                    self.references = data.get('references', '')
+                    self.imap_id = data.get('imap_id', b'')
+            
+            email_obj = EmailObj(email)
+            result = email_tools.send_reply(email_obj, request.reply)
+            
+            if result:
+                with get_user_lock(current_username):
                     email['reply'] = request.reply  # 更新为修改后的回复
                     email['status'] = 'sent'
                     
@@ -4140,7 +5077,7 @@ async def send_reply(request: SendReplyRequest, current_username: str = Depends(
                     imap_id = email.get('imap_id')
                     if imap_id:
                         try:
-                            email_tools.mark_email_as_read(imap_id)
+                            email_tools.queue_mark_as_read(imap_id)
                         except:
                             pass
                     
@@ -4154,34 +5091,27 @@ async def send_reply(request: SendReplyRequest, current_username: str = Depends(
                     print(f"DEBUG [send_reply]: 发送前 stats['sent'] = {user_state.stats.get('sent', 0)}")
                     print(f"DEBUG [send_reply]: history 中当前有 {len(user_state.history)} 条记录")
                     
-                    history_updated = False
-                    for history_record in user_state.history:
-                        # 匹配条件：ID相同，或者主题和发件人都相同
-                        if (history_record.get('id') == email_id or 
-                            (history_record.get('subject') == email_subject and 
-                             history_record.get('sender') == email_sender)):
-                            # 更新历史记录中的回复内容为修改后的内容
-                            print(f"DEBUG [send_reply]: 找到已存在的历史记录，ID: {history_record.get('id')}, 原Status: {history_record.get('status')}")
-                            history_record['reply'] = request.reply
-                            history_record['status'] = 'sent'
-                            print(f"DEBUG [send_reply]: 更新历史记录，新Status: {history_record.get('status')}, ID: {history_record.get('id')}")
-                            history_updated = True
-                            break
+                    history_record = user_state.history.find_email(email_id, email_subject, email_sender)
+                    if history_record is not None:
+                        # 更新历史记录中的回复内容为修改后的内容
+                        print(f"DEBUG [send_reply]: 找到已存在的历史记录，ID: {history_record.get('id')}, 原Status: {history_record.get('status')}")
+                        history_record['reply'] = request.reply
+                        history_record['status'] = 'sent'
+                        print(f"DEBUG [send_reply]: 更新历史记录，新Status: {history_record.get('status')}, ID: {history_record.get('id')}")
                     else:
                         # 如果历史记录中不存在，则添加到历史记录（使用修改后的回复）
                         # 确保包含所有必要的字段，特别是 id 和 status
-                        history_record = {
+                        history_record = make_email_record({
                             **email,
                             'reply': request.reply,  # 使用修改后的回复
                             'status': 'sent',  # 明确设置为 'sent'
                             'processed_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        }
+                        })
                         # 确保 id 字段存在
                         if not history_record.get('id'):
                             history_record['id'] = email_id
                         user_state.history.insert(0, history_record)
                         print(f"DEBUG [send_reply]: 添加新历史记录，ID: {history_record.get('id')}, Status: {history_record.get('status')}, 主题: {history_record.get('subject', '')[:50]}")
-                        history_updated = True
                     
                     user_state.emails_cache.remove(email)
                     print(f"DEBUG [send_reply]: 已从 emails_cache 中移除邮件，当前缓存中有 {len(user_state.emails_cache)} 封邮件")
@@ -4198,14 +5128,13 @@ async def send_reply(request: SendReplyRequest, current_username: str = Depends(
                     # 自动保存数据
                     save_user_email_data(current_username, user_state)
                     print(f"DEBUG [send_reply]: 数据已保存，保存后 history 中有 {len(user_state.history)} 条记录")
-                    print(f"DEBUG [send_reply]: 保存后，history 中 status='sent' 的记录数: {sum(1 for r in user_state.history if r.get('status') == 'sent')}")
-                    
-                    return {"message": "回复已发送", "success": True}
-                else:
-                    raise HTTPException(status_code=500, detail="发送失败")
-                    
-            except Exception as e:
-                raise HTTPException(status_code=500, detail=f"发送失败: {str(e)}")
+                
+                return {"message": "回复已发送", "success": True}
+            else:
+                raise HTTPException(status_code=500, detail="发送失败")
+                
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"发送失败: {str(e)}")
     
     raise HTTPException(status_code=404, detail="邮件不存在")
 
@@ -4215,29 +5144,24 @@ async def update_reply(request: UpdateReplyRequest, current_username: str = Depe
     email_id = request.email_id
     user_state = get_user_state(current_username)
     
-    # 更新邮件缓存中的回复内容
-    email_subject = None
-    email_sender = None
-    for email in user_state.emails_cache:
-        if email.get('id') == email_id:
+    with get_user_lock(current_username):
+        # 更新邮件缓存中的回复内容
+        email = user_state.emails_cache.get(email_id)
+        if email is not None:
             email['reply'] = request.reply
+            
+            # 更新历史记录中对应邮件的回复内容（如果已存在）
+            # 匹配条件：ID相同，或者主题和发件人都相同
             email_subject = email.get('subject', '')
             email_sender = email.get('sender', '')
-            break
-    
-    # 更新历史记录中对应邮件的回复内容（如果已存在）
-    if email_subject and email_sender:
-        for history_record in user_state.history:
-            # 匹配条件：ID相同，或者主题和发件人都相同
-            if (history_record.get('id') == email_id or 
-                (history_record.get('subject') == email_subject and 
-                 history_record.get('sender') == email_sender)):
-                # 更新历史记录中的回复内容为修改后的内容
-                history_record['reply'] = request.reply
-                break
-    
-    # 自动保存数据
-    save_user_email_data(current_username, user_state)
+            if email_subject and email_sender:
+                history_record = user_state.history.find_email(email_id, email_subject, email_sender)
+                if history_record is not None:
+                    # 更新历史记录中的回复内容为修改后的内容
+                    history_record['reply'] = request.reply
+        
+        # 自动保存数据
+        save_user_email_data(current_username, user_state)
     
     return {"message": "回复已更新", "success": True}
 
@@ -4249,23 +5173,22 @@ async def delete_email(email_id: str, current_username: str = Depends(get_userna
     
     # 从邮件缓存中查找并删除
     email_found = False
-    for email in user_state.emails_cache:
-        if email.get('id') == email_id:
-            email_status = email.get('status', '')
-            email_subject = email.get('subject', '')
-            user_state.emails_cache.remove(email)
-            email_found = True
-            
-            # 更新统计（如果删除的是待处理邮件，减少待处理数）
-            if email_status == 'pending':
-                user_state.stats['pending'] = max(0, user_state.stats.get('pending', 0) - 1)
-            
-            print(f"DEBUG [delete_email]: 删除邮件，ID: {email_id}, Status: {email_status}, 主题: {email_subject[:50]}")
-            print(f"DEBUG [delete_email]: 删除后，history 中 status='failed' 的记录数: {sum(1 for r in user_state.history if r.get('status') == 'failed')}")
-            
-            # 自动保存数据
-            save_user_email_data(current_username, user_state)
-            break
+    email = user_state.emails_cache.get(email_id)
+    if email is not None:
+        email_status = email.get('status', '')
+        email_subject = email.get('subject', '')
+        user_state.emails_cache.remove(email)
+        email_found = True
+        
+        # 更新统计（如果删除的是待处理邮件，减少待处理数）
+        if email_status == 'pending':
+            user_state.stats['pending'] = max(0, user_state.stats.get('pending', 0) - 1)
+        
+        print(f"DEBUG [delete_email]: 删除邮件，ID: {email_id}, Status: {email_status}, 主题: {email_subject[:50]}")
+        print(f"DEBUG [delete_email]: 删除后，history 中 status='failed' 的记录数: {sum(1 for r in user_state.history if r.get('status') == 'failed')}")
+        
+        # 自动保存数据
+        save_user_email_data(current_username, user_state)
     
     if email_found:
         return {"message": "邮件已删除", "success": True}
@@ -4324,28 +5247,28 @@ async def mark_email_read(request: MarkReadRequest, current_username: str = Depe
     """标记邮件为已读（同步到QQ邮箱）"""
     email_id = request.email_id
     user_state = get_user_state(current_username)
-    for email in user_state.emails_cache:
-        if email.get('id') == email_id:
-            # 同步到QQ邮箱服务器
-            imap_id = email.get('imap_id')
-            if imap_id:
-                try:
-                    # 获取当前用户的邮箱配置
-                    email_address, auth_code = get_user_email_config(current_username)
-                    email_tools = QQEmailToolsClass(email_address=email_address, auth_code=auth_code)
-                    email_tools.mark_email_as_read(imap_id)
-                except Exception as e:
-                    print(f"同步QQ邮箱已读状态失败: {e}")
-            
-            # 更新本地状态为已读，不立即移除
-            # 等用户点击刷新时统一移除，这样可以看到移除了几封已读邮件
-            email['status'] = 'read'
-            user_state.stats['pending'] = max(0, user_state.stats['pending'] - 1)
-            
-            # 自动保存数据
-            save_user_email_data(current_username, user_state)
-            
-            return {"message": "已标记为已读（已同步到QQ邮箱）", "success": True}
+    email = user_state.emails_cache.get(email_id)
+    if email is not None:
+        # 同步到QQ邮箱服务器
+        imap_id = email.get('imap_id')
+        if imap_id:
+            try:
+                # 获取当前用户的邮箱配置
+                email_address, auth_code = get_user_email_config(current_username)
+                email_tools = QQEmailToolsClass(email_address=email_address, auth_code=auth_code)
+                email_tools.mark_email_as_read(imap_id)
+            except Exception as e:
+                print(f"同步QQ邮箱已读状态失败: {e}")
+        
+        # 更新本地状态为已读，不立即移除
+        # 等用户点击刷新时统一移除，这样可以看到移除了几封已读邮件
+        email['status'] = 'read'
+        user_state.stats['pending'] = max(0, user_state.stats['pending'] - 1)
+        
+        # 自动保存数据
+        save_user_email_data(current_username, user_state)
+        
+        return {"message": "已标记为已读（已同步到QQ邮箱）", "success": True}
     raise HTTPException(status_code=404, detail="邮件不存在")
 
 # ==================== 系统控制API ====================
@@ -4361,9 +5284,29 @@ async def get_system_status(current_username: str = Depends(get_username_from_re
         "lastCheckTime": user_state.last_check_time,
         "checkInterval": user_state.check_interval,
         "emailCount": len(user_state.emails_cache),
-        "pendingCount": len([e for e in user_state.emails_cache if e.get('status') == 'pending'])
+        "pendingCount": user_state.emails_cache.count_status('pending')
+    }
+
+@app.get("/api/system/ws-stats")
+async def get_ws_stats(current_username: str = Depends(get_username_from_request)):
+    """获取当前用户的 WebSocket 发送队列统计（入队/已发送/合并/丢弃的消息数、慢连接断开次数）"""
+    return {
+        **ws_manager.get_stats(current_username),
+        "bus": notification_bus.get_stats(current_username)
     }
 
+@app.get("/api/system/pipeline-stats")
+async def get_pipeline_stats(current_username: str = Depends(get_username_from_request)):
+    """获取邮件处理调度器状态（线程数、排队和执行中的任务数），队列明细只返回当前用户的"""
+    return pipeline_scheduler.get_stats(current_username)
+
+@app.get("/api/system/cancel-stats")
+async def get_cancel_stats(current_username: str = Depends(get_username_from_request)):
+    """获取终止处理的统计（中断的模型调用、跳过的阶段、估算节省的时间、终止延迟），最近记录只返回当前用户的"""
+    stats = cancellation_metrics.get_stats()
+    stats["recent"] = [r for r in stats["recent"] if (r.get("label") or "").startswith(f"{current_username} ")]
+    return stats
+
 @app.post("/api/system/start")
 async def start_system(current_username: str = Depends(get_username_from_request)):
     """启动邮件监控"""
@@ -4471,10 +5414,16 @@ async def refresh_emails(current_username: str = Depends(get_username_from_reque
         new_count = 0
         new_emails_for_summary = []  # 收集需要生成摘要的新邮件
         # 获取缓存中所有邮件的ID集合（用于快速查找）
-        cached_ids = {e.get('id', '') for e in user_state.emails_cache}
+        cached_ids = user_state.emails_cache.ids()
         
         for email_data in emails:
             email_id = email_data.get('id', '')
+            if email_id in cached_ids:
+                cached_email = user_state.emails_cache.get(email_id)
+                if cached_email is not None and cached_email.get('imap_id_type') != 'uid':
+                    # 旧版本缓存的邮件：补上 UID
+                    cached_email['imap_id'] = email_data.get('imap_id')
+                    cached_email['imap_id_type'] = 'uid'
             # 检查邮件是否已经在缓存中（通过ID匹配）
             if email_id and email_id not in cached_ids:
                 # 自动分类邮件
@@ -4496,7 +5445,7 @@ async def refresh_emails(current_username: str = Depends(get_username_from_reque
                 if len(email_time) < 19:  # 'YYYY-MM-DD HH:MM:SS' 应该是19个字符
                     email_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
                 
-                new_email = {
+                new_email = make_email_record({
                     **email_data,
                     'time': email_time,
                     'status': 'pending',
@@ -4505,7 +5454,7 @@ async def refresh_emails(current_username: str = Depends(get_username_from_reque
                     'preview': body[:100] + '...' if body else '',
                     'urgency_level': urgency_level,
                     'urgency_keywords': urgency_keywords
-                }
+                })
                 
                 user_state.emails_cache.append(new_email)
                 new_count += 1
@@ -4527,14 +5476,13 @@ async def refresh_emails(current_username: str = Depends(get_username_from_reque
                 user_state.stats['pending'] += 1
             elif email_id:
                 # 邮件已存在，但可能需要更新状态（如果之前是已读状态，现在QQ邮箱中又变成未读了）
-                for cached_email in user_state.emails_cache:
-                    if cached_email.get('id') == email_id:
-                        # 如果缓存中的邮件状态是read，但QQ邮箱中还是未读，恢复为pending
-                        if cached_email.get('status') == 'read':
-                            cached_email['status'] = 'pending'
-                            user_state.stats['pending'] += 1
-                            print(f"恢复邮件状态为待处理: {cached_email.get('subject', '')[:50]}...")
-                        break
+                cached_email = user_state.emails_cache.get(email_id)
+                if cached_email is not None:
+                    # 如果缓存中的邮件状态是read，但QQ邮箱中还是未读，恢复为pending
+                    if cached_email.get('status') == 'read':
+                        cached_email['status'] = 'pending'
+                        user_state.stats['pending'] += 1
+                        print(f"恢复邮件状态为待处理: {cached_email.get('subject', '')[:50]}...")
         
         # 为新邮件生成原始邮件摘要（异步，不阻塞）
         if new_emails_for_summary:
@@ -4559,16 +5507,21 @@ async def refresh_emails(current_username: str = Depends(get_username_from_reque
                     timeout_count = 0
                     error_count = 0
                     
-                    for i, future in enumerate(futures, 1):
+                    for i, (email, future) in enumerate(zip(new_emails_for_summary, futures), 1):
+                        succeeded = False
                         try:
                             if future.result(timeout=150):  # 每个任务最多等待2.5分钟
                                 success_count += 1
+                                succeeded = True
                         except TimeoutError:
                             timeout_count += 1
                             print(f"⏱️ [摘要生成] 批量任务 {i}/{len(futures)} 超时")
                         except Exception as e:
                             error_count += 1
                             print(f"⚠️ [摘要生成] 批量任务 {i}/{len(futures)} 失败: {type(e).__name__}")
+                        if not succeeded and email.get('body') and email.get('id'):
+                            # 交给定时调度的摘要重试任务
+                            user_state.summary_retries.setdefault(email['id'], 0)
                     
                     # 统一保存一次（即使有部分失败，只要有成功的就保存）
                     if success_count > 0:
@@ -4632,195 +5585,27 @@ async def refresh_emails(current_username: str = Depends(get_username_from_reque
 
 # ==================== 统计API ====================
 
-@app.get("/api/stats")
-async def get_stats(current_username: str = Depends(get_username_from_request)):
-    """获取统计数据 - 基于真实数据计算，确保准确性"""
-    user_state = get_user_state(current_username)
+def _build_stats_payload(user_state: SystemState) -> dict:
+    """根据统计汇总生成 /api/stats 的返回数据（邮件缓存和历史记录按邮件ID去重）"""
+    rollup = user_state.stats_rollup
     
-    # 计算今日邮件数（使用邮件ID去重，避免重复计算）
-    today = datetime.now().strftime('%Y-%m-%d')
-    today_email_ids = set()  # 使用集合去重
-    
-    print(f"DEBUG [get_stats]: 开始计算今日邮件数，今天日期: {today}")
-    print(f"DEBUG [get_stats]: emails_cache 中有 {len(user_state.emails_cache)} 封邮件")
-    print(f"DEBUG [get_stats]: history 中有 {len(user_state.history)} 条记录")
+    now = datetime.now()
+    today = now.strftime('%Y-%m-%d')
     
-    # 从邮件缓存中统计今天的邮件
-    emails_cache_today_count = 0
-    emails_cache_today_ids = []
-    for email in user_state.emails_cache:
-        email_time = email.get('time', '')
-        email_id = email.get('id', '')
-        if email_id:
-            # 使用精确的日期比较：检查时间字符串的前10个字符（YYYY-MM-DD）是否等于今天
-            # 这样可以避免 "2024-01-1" 匹配到 "2024-01-10" 的问题
-            email_date = email_time[:10] if len(email_time) >= 10 else ''
-            if email_date == today:
-                today_email_ids.add(email_id)
-                emails_cache_today_count += 1
-                emails_cache_today_ids.append(email_id[:20] if len(email_id) > 20 else email_id)
-                print(f"DEBUG [get_stats]: 邮件缓存中发现今日邮件 - ID: {email_id[:20]}..., 时间: {email_time}, 日期: {email_date}")
-            elif email_time:
-                # 记录非今日邮件的时间，用于调试
-                if emails_cache_today_count < 3:  # 只记录前3个，避免日志过多
-                    print(f"DEBUG [get_stats]: 邮件缓存中非今日邮件 - ID: {email_id[:20]}..., 时间: {email_time}, 日期: {email_date}")
-    
-    print(f"DEBUG [get_stats]: 从 emails_cache 中找到 {emails_cache_today_count} 封今日邮件")
-    if emails_cache_today_ids:
-        print(f"DEBUG [get_stats]: emails_cache 中今日邮件的 ID 列表（前10个）: {emails_cache_today_ids[:10]}")
-    
-    # 从历史记录中统计今天的邮件（去重）
-    history_today_count = 0
-    history_today_ids = []
-    for record in user_state.history:
-        record_time = record.get('time', '') or record.get('processed_time', '')
-        record_id = record.get('id', '')
-        if record_id and record_time:
-            # 使用精确的日期比较
-            record_date = record_time[:10] if len(record_time) >= 10 else ''
-            if record_date == today:
-                if record_id not in today_email_ids:  # 避免重复计算
-                    today_email_ids.add(record_id)
-                    history_today_count += 1
-                    history_today_ids.append(record_id[:20] if len(record_id) > 20 else record_id)
-                    print(f"DEBUG [get_stats]: 历史记录中发现今日邮件 - ID: {record_id[:20]}..., 时间: {record_time}, 日期: {record_date}")
-            elif record_time:
-                # 记录非今日记录的时间，用于调试
-                if history_today_count < 3:  # 只记录前3个，避免日志过多
-                    print(f"DEBUG [get_stats]: 历史记录中非今日记录 - ID: {record_id[:20]}..., 时间: {record_time}, 日期: {record_date}")
-    
-    print(f"DEBUG [get_stats]: 从 history 中找到 {history_today_count} 条今日记录（去重后新增）")
-    if history_today_ids:
-        print(f"DEBUG [get_stats]: history 中今日记录的 ID 列表（前10个）: {history_today_ids[:10]}")
-    
-    today_emails_count = len(today_email_ids)
-    print(f"DEBUG [get_stats]: 今日邮件总数（去重后）: {today_emails_count} (emails_cache: {emails_cache_today_count}, history新增: {history_today_count})")
-    
-    # 计算已处理数（同时从邮件缓存和历史记录中统计，去重）
+    # 今日邮件数：收信时间（历史记录为 time 或 processed_time）是今天的邮件
+    today_emails_count = rollup.count('received', today)
     # 已处理包括：processed（已生成回复）、sent（已发送）、skipped（无关邮件已跳过）
-    processed_email_ids = set()
-    
-    # 从邮件缓存中统计已处理的邮件
-    for email in user_state.emails_cache:
-        email_id = email.get('id', '')
-        email_status = email.get('status', '')
-        if email_id and email_status in ['processed', 'sent', 'skipped']:
-            processed_email_ids.add(email_id)
-    
-    # 从历史记录中统计已处理的邮件（去重）
-    for record in user_state.history:
-        record_id = record.get('id', '')
-        record_status = record.get('status', '')
-        if record_id and record_status in ['success', 'processed', 'sent', 'skipped']:
-            processed_email_ids.add(record_id)
-    
-    processed_count = len(processed_email_ids)
-    
-    # 计算待处理数（从邮件缓存中统计待处理的邮件）
-    pending_count = len([e for e in user_state.emails_cache if e.get('status') == 'pending'])
-    
-    # 计算失败数（同时从邮件缓存和历史记录中统计，去重）
-    failed_email_ids = set()
-    
-    # 从邮件缓存中统计失败的邮件
-    for email in user_state.emails_cache:
-        email_id = email.get('id', '')
-        email_status = email.get('status', '')
-        if email_id and email_status == 'failed':
-            failed_email_ids.add(email_id)
-    
-    # 从历史记录中统计失败的邮件（去重）
-    for record in user_state.history:
-        record_id = record.get('id', '')
-        record_status = record.get('status', '')
-        if record_id and record_status == 'failed':
-            failed_email_ids.add(record_id)
-    
-    failed_count = len(failed_email_ids)
-    print(f"DEBUG [get_stats]: 计算失败数: emails_cache中有 {sum(1 for e in user_state.emails_cache if e.get('status') == 'failed')} 封, history中有 {sum(1 for r in user_state.history if r.get('status') == 'failed')} 封, 去重后共 {failed_count} 封")
-    
-    # 计算发送回复数（只统计实际发送的邮件，status为'sent'）
-    print(f"DEBUG [get_stats]: 开始计算发送回复数")
-    print(f"DEBUG [get_stats]: 当前内存中 stats['sent'] = {user_state.stats.get('sent', 0)}")
-    print(f"DEBUG [get_stats]: emails_cache 中有 {len(user_state.emails_cache)} 封邮件")
-    print(f"DEBUG [get_stats]: history 中有 {len(user_state.history)} 条记录")
-    
-    sent_email_ids = set()
-    
-    # 从邮件缓存中统计已发送的邮件
-    emails_cache_sent_count = 0
-    for email in user_state.emails_cache:
-        email_id = email.get('id', '')
-        email_status = email.get('status', '')
-        if email_id and email_status == 'sent':
-            sent_email_ids.add(email_id)
-            emails_cache_sent_count += 1
-    print(f"DEBUG [get_stats]: emails_cache 中 status='sent' 的邮件: {emails_cache_sent_count} 封")
-    
-    # 从历史记录中统计已发送的邮件（去重）
-    history_sent_count = 0
-    history_sent_ids = []
-    for record in user_state.history:
-        record_id = record.get('id', '')
-        record_status = record.get('status', '')
-        if record_id and record_status == 'sent':
-            sent_email_ids.add(record_id)
-            history_sent_count += 1
-            history_sent_ids.append(record_id[:20] if len(record_id) > 20 else record_id)
-        elif record_status == 'sent':
-            # 如果 status 是 'sent' 但 id 为空，记录警告
-            print(f"DEBUG [get_stats]: 警告：发现 status='sent' 但 id 为空的记录: {record.get('subject', '')[:50]}")
-    
-    print(f"DEBUG [get_stats]: history 中 status='sent' 的记录: {history_sent_count} 条")
-    if history_sent_ids:
-        print(f"DEBUG [get_stats]: history 中 sent 记录的 ID 列表（前10个）: {history_sent_ids[:10]}")
-    
-    sent_count = len(sent_email_ids)
-    print(f"DEBUG [get_stats]: 去重后的发送回复数: {sent_count} (emails_cache: {emails_cache_sent_count}, history: {history_sent_count})")
+    processed_count = rollup.count('processed')
+    # 待处理数只看邮件缓存
+    pending_count = user_state.emails_cache.count_status('pending')
+    failed_count = rollup.count('failed')
+    # 发送回复数（只统计实际发送的邮件，status为'sent'）
+    sent_count = rollup.count('sent')
+    # 本月处理数（本月1号到今天的所有已处理邮件）
+    this_month_processed_count = rollup.count('processed_month', now.strftime('%Y-%m'))
     
     # 如果内存中的 stats['sent'] 更大，说明有刚刚发送的邮件还没被统计到，使用内存中的值
-    sent_count_memory = user_state.stats.get('sent', 0)
-    if sent_count_memory > sent_count:
-        print(f"DEBUG [get_stats]: 使用内存中的 stats['sent'] = {sent_count_memory}（大于计算值 {sent_count}）")
-        sent_count = sent_count_memory
-    elif sent_count_memory < sent_count:
-        print(f"DEBUG [get_stats]: 计算值 {sent_count} 大于内存值 {sent_count_memory}，使用计算值")
-    else:
-        print(f"DEBUG [get_stats]: 计算值与内存值一致: {sent_count}")
-    
-    # 计算本月处理数（从本月1号到今天的所有已处理邮件）
-    # 已处理包括：processed（已生成回复）、sent（已发送）、skipped（无关邮件已跳过）
-    now = datetime.now()
-    current_month_start = datetime(now.year, now.month, 1).strftime('%Y-%m-%d')
-    this_month_processed_ids = set()
-    
-    print(f"DEBUG [get_stats]: 开始计算本月处理数，本月起始日期: {current_month_start}")
-    
-    # 从邮件缓存中统计本月的已处理邮件
-    for email in user_state.emails_cache:
-        email_id = email.get('id', '')
-        email_time = email.get('time', '')
-        email_status = email.get('status', '')
-        if email_id and email_status in ['processed', 'sent', 'skipped']:
-            email_date = email_time[:10] if len(email_time) >= 10 else ''
-            # 检查是否在本月（日期 >= 本月1号）
-            if email_date >= current_month_start:
-                this_month_processed_ids.add(email_id)
-    
-    # 从历史记录中统计本月的已处理邮件（去重）
-    for record in user_state.history:
-        record_id = record.get('id', '')
-        record_time = record.get('time', '') or record.get('processed_time', '')
-        record_status = record.get('status', '')
-        if record_id and record_status in ['success', 'processed', 'sent', 'skipped']:
-            record_date = record_time[:10] if len(record_time) >= 10 else ''
-            # 检查是否在本月（日期 >= 本月1号）
-            if record_date >= current_month_start:
-                if record_id not in this_month_processed_ids:
-                    this_month_processed_ids.add(record_id)
-    
-    this_month_processed_count = len(this_month_processed_ids)
-    print(f"DEBUG [get_stats]: 本月处理数: {this_month_processed_count} (本月起始: {current_month_start})")
+    sent_count = max(sent_count, user_state.stats.get('sent', 0))
     
     # 同时更新内存中的统计数据，保持一致性
     user_state.stats['today_emails'] = today_emails_count
@@ -4828,7 +5613,6 @@ async def get_stats(current_username: str = Depends(get_username_from_request)):
     user_state.stats['pending'] = pending_count
     user_state.stats['failed'] = failed_count
     user_state.stats['sent'] = sent_count
-    print(f"DEBUG [get_stats]: 最终更新 stats['sent'] = {sent_count}")
     
     return {
         "todayEmails": today_emails_count,
@@ -4839,88 +5623,72 @@ async def get_stats(current_username: str = Depends(get_username_from_request)):
         "thisMonthProcessed": this_month_processed_count  # 返回本月处理数
     }
 
+@app.get("/api/stats")
+async def get_stats(current_username: str = Depends(get_username_from_request)):
+    """获取统计数据 - 读取增量维护的统计汇总（邮件缓存和历史记录按邮件ID去重）"""
+    user_state = get_user_state(current_username)
+    return _build_stats_payload(user_state)
+
+@app.get("/api/stats/slo")
+async def get_slo_stats(current_username: str = Depends(get_username_from_request)):
+    """获取各紧急程度的回复时限达成情况（实际回复耗时与目标时限对比，服务启动以来）"""
+    user_state = get_user_state(current_username)
+    return {"urgency": user_state.response_slo.report()}
+
 @app.get("/api/stats/category")
 async def get_category_stats(current_username: str = Depends(get_username_from_request)):
     """获取分类统计 - 只统计今天的数据，确保用户隔离"""
     user_state = get_user_state(current_username)
-    categories = {}
-    
-    # 获取今天的日期字符串
     today = datetime.now().strftime('%Y-%m-%d')
-    
-    # 统计邮件缓存中的分类（使用邮件ID去重，只统计今天的）
-    processed_email_ids = set()  # 用于去重
-    
-    # 统计邮件缓存中今天的分类
-    for email in user_state.emails_cache:
-        email_id = email.get('id', '')
-        email_time = email.get('time', '')
-        cat = email.get('category', 'unknown')
-        # 只统计今天的邮件
-        email_date = email_time[:10] if len(email_time) >= 10 else ''
-        if email_id and cat and cat != 'unknown' and email_date == today:
-            if email_id not in processed_email_ids:
-                processed_email_ids.add(email_id)
-                categories[cat] = categories.get(cat, 0) + 1
-    
-    # 统计历史记录中今天的分类（去重）
-    for record in user_state.history:
-        record_id = record.get('id', '')
-        record_time = record.get('time', '') or record.get('processed_time', '')
-        cat = record.get('category', 'unknown')
-        # 只统计今天的记录
-        record_date = record_time[:10] if len(record_time) >= 10 else ''
-        if record_id and cat and cat != 'unknown' and record_date == today:
-            if record_id not in processed_email_ids:
-                processed_email_ids.add(record_id)
-                categories[cat] = categories.get(cat, 0) + 1
-    
-    # 只返回今天的数据
-    return {"categories": categories}
+    return {"categories": user_state.stats_rollup.breakdown('category', today)}
 
 @app.get("/api/stats/trend")
 async def get_trend_stats(days: int = 7, current_username: str = Depends(get_username_from_request)):
-    """获取趋势数据 - 使用真实数据，确保用户隔离"""
+    """获取趋势数据 - 读取按天的统计汇总，确保用户隔离"""
     user_state = get_user_state(current_username)
+    rollup = user_state.stats_rollup
     
-    # 从用户历史记录和邮件缓存中生成趋势数据（使用邮件ID去重）
-    trend_data = []
-    for i in range(days - 1, -1, -1):
-        date = (datetime.now() - timedelta(days=i)).strftime('%m-%d')
-        date_str = (datetime.now() - timedelta(days=i)).strftime('%Y-%m-%d')
-        
-        # 统计当天的邮件（使用集合去重）
-        received_email_ids = set()
-        processed_email_ids = set()
-        
-        # 统计邮件缓存中当天的邮件
-        for email in user_state.emails_cache:
-            email_id = email.get('id', '')
-            email_time = email.get('time', '')
-            if email_id and date_str in email_time:
-                received_email_ids.add(email_id)
-                if email.get('status') in ['processed', 'sent']:
-                    processed_email_ids.add(email_id)
-        
-        # 统计历史记录中当天的邮件（去重）
-        for record in user_state.history:
-            record_id = record.get('id', '')
-            record_time = record.get('time', '') or record.get('processed_time', '')
-            if record_id and date_str in record_time:
-                if record_id not in received_email_ids:
-                    received_email_ids.add(record_id)
-                if record.get('status') in ['success', 'processed', 'sent']:
-                    processed_email_ids.add(record_id)
-        
-        # 只返回真实数据，不使用模拟数据
-        trend_data.append({
-            "date": date,
-            "received": len(received_email_ids),
-            "processed": len(processed_email_ids)
-        })
-    
+    now = datetime.now()
+    dates = [now - timedelta(days=i) for i in range(days - 1, -1, -1)]
+    date_strs = [d.strftime('%Y-%m-%d') for d in dates]
+    received = rollup.daily('received', date_strs)
+    processed = rollup.daily('trend_processed', date_strs)
+    
+    trend_data = [
+        {
+            "date": d.strftime('%m-%d'),
+            "received": received[i],
+            "processed": processed[i]
+        }
+        for i, d in enumerate(dates)
+    ]
     return {"trend": trend_data}
 
+# ==================== 增量同步API ====================
+
+@app.get("/api/changes")
+async def get_changes(
+    since: Optional[str] = None,
+    current_username: str = Depends(get_username_from_request)
+):
+    """获取某个版本之后变化的邮件和历史记录（轮询时代替重新下载全部数据）
+    
+    @param since: 上次返回的 version（'<实例标识>-<版本号>'）；不传、落后太多或服务重启后返回 resync=true，前端需重新拉取全部数据
+    @return: version（版本标识，下次原样带回）、resync、emails/history（upserted 为变化后的完整记录，removed 为被移除记录的ID）、
+             stats（有变化时附带最新统计）
+    """
+    user_state = get_user_state(current_username)
+    result = user_state.change_log.changes_since(since)
+    empty = {"upserted": [], "removed": []}
+    changes = result["changes"]
+    return {
+        "version": result["version"],
+        "resync": result["resync"],
+        "emails": changes.get("emails", empty),
+        "history": changes.get("history", empty),
+        "stats": _build_stats_payload(user_state) if changes else None
+    }
+
 # ==================== 历史记录API ====================
 
 @app.get("/api/history")
@@ -4931,262 +5699,254 @@ async def get_history(
     status: Optional[str] = None,
     page: int = 1,
     page_size: int = 10,
+    cursor: Optional[str] = None,
     current_username: str = Depends(get_username_from_request)
 ):
-    """获取处理记录 - 使用真实数据，确保用户隔离"""
+    """获取处理记录 - 使用真实数据，确保用户隔离
+    
+    支持两种分页方式：
+    - page/page_size：按页码分页
+    - cursor：传入上一页返回的 nextCursor，直接从该位置继续（不需要先生成前面的页）
+    """
     user_state = get_user_state(current_username)
-    records = user_state.history.copy()
-    
-    # 只返回真实数据，不使用模拟数据
-    # 如果没有记录，返回空数组
-    
-    # 日期筛选（只比较日期部分，忽略时间）
-    if start_date:
-        records = [r for r in records if (r.get('time', '') and r.get('time', '')[:10] >= start_date) or 
-                                          (r.get('processed_time', '') and r.get('processed_time', '')[:10] >= start_date)]
-    if end_date:
-        # 结束日期需要包含当天，所以比较日期部分
-        records = [r for r in records if (r.get('time', '') and r.get('time', '')[:10] <= end_date) or 
-                                          (r.get('processed_time', '') and r.get('processed_time', '')[:10] <= end_date)]
-    
-    # 分类筛选
-    if category:
-        records = [r for r in records if r.get('category') == category]
-    
-    # 状态筛选
-    if status:
-        # 状态映射：success/processed/sent -> success, failed -> failed, skipped -> skipped
-        if status == 'success':
-            records = [r for r in records if r.get('status') in ['success', 'processed', 'sent']]
-        elif status == 'failed':
-            records = [r for r in records if r.get('status') == 'failed']
-        elif status == 'skipped':
-            records = [r for r in records if r.get('status') == 'skipped']
-        elif status == 'pending':
-            records = [r for r in records if r.get('status') not in ['success', 'processed', 'sent', 'failed', 'skipped']]
-    
-    # 按时间倒序排序（最新的在前）
-    records.sort(key=lambda x: x.get('time', '') or x.get('processed_time', ''), reverse=True)
-    
-    # 分页
-    total = len(records)
-    start = (page - 1) * page_size
-    end = start + page_size
-    records = records[start:end]
+    
+    # 日期（只比较日期部分）、分类、状态筛选均走索引，结果按时间倒序（最新的在前）
+    # 热数据取完后再读取归档，只有日期范围与归档分段重叠时才会解压
+    query = HistoryQuery(start_date=start_date, end_date=end_date, category=category, status=status)
+    offset = 0 if cursor else max(0, (page - 1) * page_size)
+    records, total, next_cursor = query_tiered(
+        user_state.history, user_state.history_archive, query,
+        limit=page_size, offset=offset, cursor=cursor
+    )
     
     return {
         "records": records,
         "total": total,
         "page": page,
-        "pageSize": page_size
+        "pageSize": page_size,
+        "nextCursor": next_cursor
     }
 
+# 导出表头与映射（XLSX/CSV 共用）
+EXPORT_HEADERS = ['时间', '发件人', '主题', '分类', '状态', '回复内容']
+EXPORT_COLUMN_WIDTHS = [20, 25, 40, 15, 10, 60]  # 时间、发件人、主题、分类、状态、回复内容
+EXPORT_CATEGORY_NAMES = {
+    'product_enquiry': '产品咨询',
+    'customer_complaint': '客户投诉',
+    'customer_feedback': '客户反馈',
+    'unrelated': '无关邮件'
+}
+EXPORT_STATUS_NAMES = {
+    'success': '成功',
+    'processed': '成功',
+    'sent': '成功',
+    'failed': '失败',
+    'skipped': '跳过'
+}
+EXPORT_TIME_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y/%m/%d %H:%M:%S', '%Y/%m/%d %H:%M', '%Y/%m/%d']
+
+# 流式导出每次输出的行数（CSV/NDJSON），以及 XLSX 写出时队列中最多缓存的数据块数
+EXPORT_FLUSH_ROWS = 200
+EXPORT_QUEUE_CHUNKS = 16
+
+
+def _export_row(record: dict) -> tuple:
+    """
+    把一条历史记录转换为导出行
+    
+    @return: (解析后的时间或None, 原始时间字符串, 发件人, 主题, 分类, 状态, 回复内容)
+    """
+    time_str = record.get('time') or record.get('processed_time', '')
+    time_value = None
+    if time_str:
+        time_str = str(time_str).strip()
+        for fmt in EXPORT_TIME_FORMATS:
+            try:
+                time_value = datetime.strptime(time_str, fmt)
+                break
+            except ValueError:
+                continue
+    category_val = record.get('category', '')
+    status_val = record.get('status', '')
+    return (
+        time_value,
+        time_str,
+        record.get('sender') or record.get('sender_email', ''),
+        record.get('subject', ''),
+        EXPORT_CATEGORY_NAMES.get(category_val, category_val or '未分类'),
+        EXPORT_STATUS_NAMES.get(status_val, status_val or '未知'),
+        record.get('reply', '')
+    )
+
+
+def _iter_csv_export(records):
+    """逐批生成 CSV 内容（UTF-8 BOM，Excel 可直接打开）"""
+    output = io.StringIO()
+    writer = csv.writer(output)
+    output.write('\ufeff')
+    writer.writerow(EXPORT_HEADERS)
+    row_count = 0
+    for record in records:
+        _, time_str, *fields = _export_row(record)
+        writer.writerow([time_str, *fields])
+        row_count += 1
+        if row_count % EXPORT_FLUSH_ROWS == 0:
+            yield output.getvalue().encode('utf-8')
+            output.seek(0)
+            output.truncate()
+    yield output.getvalue().encode('utf-8')
+    print(f"📊 [导出CSV] 已写入 {row_count} 行数据（不包括表头）")
+
+
+def _iter_ndjson_export(records):
+    """逐批生成 NDJSON 内容（每行一条完整的历史记录）"""
+    lines = []
+    row_count = 0
+    for record in records:
+        lines.append(json.dumps(record, ensure_ascii=False, default=str))
+        row_count += 1
+        if len(lines) >= EXPORT_FLUSH_ROWS:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+    print(f"📊 [导出NDJSON] 已写入 {row_count} 条记录")
+
+
+def _iter_xlsx_export(records):
+    """
+    使用 openpyxl 只写模式生成 XLSX，并在写出 zip 的同时把字节流交给响应
+    
+    行数据由 openpyxl 写入临时文件，内存占用与记录数无关；
+    写出线程和响应之间通过有界队列传递数据块，客户端断开时写出线程会停止。
+    """
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_CHUNKS)
+    cancelled = threading.Event()
+    
+    class _QueueWriter:
+        """只支持顺序写入的文件对象（zipfile 会自动使用数据描述符）"""
+        def write(self, data):
+            data = bytes(data)
+            while not cancelled.is_set():
+                try:
+                    chunks.put(data, timeout=1)
+                    return len(data)
+                except queue.Full:
+                    continue
+            raise IOError("导出已取消")
+        
+        def flush(self):
+            pass
+    
+    def build():
+        try:
+            wb = Workbook(write_only=True)
+            ws = wb.create_sheet("处理记录")
+            for col_num, width in enumerate(EXPORT_COLUMN_WIDTHS, 1):
+                ws.column_dimensions[get_column_letter(col_num)].width = width
+            
+            # 表头样式
+            header_font = Font(bold=True, size=12)
+            header_alignment = Alignment(horizontal='center', vertical='center')
+            header_row = []
+            for header in EXPORT_HEADERS:
+                cell = WriteOnlyCell(ws, value=header)
+                cell.font = header_font
+                cell.alignment = header_alignment
+                header_row.append(cell)
+            ws.append(header_row)
+            
+            # 回复内容列自动换行
+            reply_alignment = Alignment(wrap_text=True, vertical='top')
+            row_count = 0
+            for record in records:
+                if cancelled.is_set():
+                    return
+                time_value, time_str, *fields = _export_row(record)
+                time_cell = WriteOnlyCell(ws, value=time_value if time_value else time_str)
+                if time_value:
+                    time_cell.number_format = 'yyyy-mm-dd hh:mm:ss'
+                reply_cell = WriteOnlyCell(ws, value=fields[-1])
+                reply_cell.alignment = reply_alignment
+                ws.append([time_cell, *fields[:-1], reply_cell])
+                row_count += 1
+            
+            wb.save(_QueueWriter())
+            print(f"📊 [导出XLSX] 已写入 {row_count} 行数据（不包括表头）")
+        except Exception as e:
+            if not cancelled.is_set():
+                print(f"❌ [导出XLSX] 生成失败: {e}")
+                import traceback
+                traceback.print_exc()
+                chunks.put(e)
+        finally:
+            if not cancelled.is_set():
+                chunks.put(None)
+    
+    threading.Thread(target=build, daemon=True, name="history_export_xlsx").start()
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        cancelled.set()
+
+
 @app.get("/api/history/export")
 async def export_history(
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     category: Optional[str] = None,
     status: Optional[str] = None,
+    export_format: str = Query("xlsx", alias="format"),
     current_username: str = Depends(get_username_from_request)
 ):
-    """导出处理记录为XLSX文件"""
-    user_state = get_user_state(current_username)
-    records = user_state.history.copy()
-    
-    print(f"📊 [导出XLSX] 开始导出，原始记录数: {len(records)}")
-    print(f"📊 [导出XLSX] 筛选条件: start_date={start_date}, end_date={end_date}, category={category}, status={status}")
-    
-    # 应用相同的筛选逻辑（与get_history保持一致）
-    # 日期筛选（只比较日期部分，忽略时间）
-    if start_date:
-        original_count = len(records)
-        records = [r for r in records if (r.get('time', '') and r.get('time', '')[:10] >= start_date) or 
-                                          (r.get('processed_time', '') and r.get('processed_time', '')[:10] >= start_date)]
-        print(f"📊 [导出XLSX] 开始日期筛选后: {original_count} -> {len(records)}")
-    if end_date:
-        original_count = len(records)
-        records = [r for r in records if (r.get('time', '') and r.get('time', '')[:10] <= end_date) or 
-                                          (r.get('processed_time', '') and r.get('processed_time', '')[:10] <= end_date)]
-        print(f"📊 [导出XLSX] 结束日期筛选后: {original_count} -> {len(records)}")
-    
-    # 分类筛选
-    if category:
-        original_count = len(records)
-        records = [r for r in records if r.get('category') == category]
-        print(f"📊 [导出XLSX] 分类筛选后: {original_count} -> {len(records)}")
-    
-    # 状态筛选
-    if status:
-        original_count = len(records)
-        if status == 'success':
-            records = [r for r in records if r.get('status') in ['success', 'processed', 'sent']]
-        elif status == 'failed':
-            records = [r for r in records if r.get('status') == 'failed']
-        elif status == 'skipped':
-            records = [r for r in records if r.get('status') == 'skipped']
-        elif status == 'pending':
-            records = [r for r in records if r.get('status') not in ['success', 'processed', 'sent', 'failed', 'skipped']]
-        print(f"📊 [导出XLSX] 状态筛选后: {original_count} -> {len(records)}")
-    
-    # 按时间倒序排序（最新的在前）
-    records.sort(key=lambda x: x.get('time', '') or x.get('processed_time', ''), reverse=True)
-    
-    print(f"📊 [导出XLSX] 最终记录数: {len(records)}")
-    
-    # 分类和状态映射
-    category_names = {
-        'product_enquiry': '产品咨询',
-        'customer_complaint': '客户投诉',
-        'customer_feedback': '客户反馈',
-        'unrelated': '无关邮件'
-    }
+    """导出处理记录（流式响应）
     
-    status_names = {
-        'success': '成功',
-        'processed': '成功',
-        'sent': '成功',
-        'failed': '失败',
-        'skipped': '跳过'
-    }
+    @param export_format: xlsx（默认，未安装openpyxl时回退为csv）、csv 或 ndjson
+    """
+    user_state = get_user_state(current_username)
     
-    # 使用openpyxl生成XLSX文件
-    if OPENPYXL_AVAILABLE:
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "处理记录"
-        
-        # 设置表头
-        headers = ['时间', '发件人', '主题', '分类', '状态', '回复内容']
-        ws.append(headers)
-        
-        # 设置表头样式
-        header_font = Font(bold=True, size=12)
-        header_alignment = Alignment(horizontal='center', vertical='center')
-        for col_num, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col_num)
-            cell.font = header_font
-            cell.alignment = header_alignment
-        
-        # 写入数据
-        row_count = 0
-        for record in records:
-            # 解析时间字符串为datetime对象
-            time_value = None
-            time_str = record.get('time') or record.get('processed_time', '')
-            if time_str:
-                try:
-                    time_str = str(time_str).strip()
-                    # 尝试多种格式解析
-                    parsed = False
-                    for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d', '%Y/%m/%d %H:%M:%S', '%Y/%m/%d %H:%M', '%Y/%m/%d']:
-                        try:
-                            time_value = datetime.strptime(time_str, fmt)
-                            parsed = True
-                            break
-                        except:
-                            continue
-                    if not parsed:
-                        time_value = None
-                except Exception as e:
-                    print(f"⚠️ [导出XLSX] 时间解析失败: {time_str}, 错误: {e}")
-                    time_value = None
-            
-            sender = record.get('sender') or record.get('sender_email', '')
-            subject = record.get('subject', '')
-            category_val = record.get('category', '')
-            category_label = category_names.get(category_val, category_val or '未分类')
-            status_val = record.get('status', '')
-            status_label = status_names.get(status_val, status_val or '未知')
-            reply = record.get('reply', '')
-            
-            # 写入行数据
-            row_data = [
-                time_value if time_value else time_str,  # 如果是datetime对象，直接使用；否则使用字符串
-                sender,
-                subject,
-                category_label,
-                status_label,
-                reply
-            ]
-            ws.append(row_data)
-            
-            # 设置时间列的格式（如果是datetime对象）
-            if time_value:
-                time_cell = ws.cell(row=row_count + 2, column=1)  # +2因为第一行是表头
-                time_cell.number_format = 'yyyy-mm-dd hh:mm:ss'
-            
-            row_count += 1
-        
-        # 自动调整列宽
-        column_widths = [20, 25, 40, 15, 10, 60]  # 时间、发件人、主题、分类、状态、回复内容
-        for col_num, width in enumerate(column_widths, 1):
-            ws.column_dimensions[get_column_letter(col_num)].width = width
-        
-        # 设置文本自动换行（回复内容列）
-        reply_col = ws.column_dimensions[get_column_letter(6)]  # 回复内容在第6列
-        for row in range(2, row_count + 2):  # 从第2行开始（跳过表头）
-            cell = ws.cell(row=row, column=6)
-            cell.alignment = Alignment(wrap_text=True, vertical='top')
-        
-        # 保存到内存
-        output = io.BytesIO()
-        wb.save(output)
-        output.seek(0)
-        xlsx_content = output.getvalue()
-        output.close()
-        
-        print(f"📊 [导出XLSX] 已写入 {row_count} 行数据（不包括表头）")
-        
-        # 生成文件名
-        filename = f"processing_records_{datetime.now().strftime('%Y%m%d')}.xlsx"
-        filename_utf8 = f"处理记录_{datetime.now().strftime('%Y%m%d')}.xlsx"
-        filename_encoded = quote(filename_utf8.encode('utf-8'))
-        
-        # 返回XLSX文件
-        return Response(
-            content=xlsx_content,
-            media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            headers={
-                'Content-Disposition': f'attachment; filename="{filename}"; filename*=UTF-8\'\'{filename_encoded}'
-            }
-        )
+    export_format = (export_format or "xlsx").lower()
+    if export_format not in ("xlsx", "csv", "ndjson"):
+        raise HTTPException(status_code=400, detail=f"不支持的导出格式: {export_format}")
+    if export_format == "xlsx" and not OPENPYXL_AVAILABLE:
+        export_format = "csv"
+    
+    print(f"📊 [导出] 开始导出（{export_format}），原始记录数: {len(user_state.history)}")
+    print(f"📊 [导出] 筛选条件: start_date={start_date}, end_date={end_date}, category={category}, status={status}")
+    
+    # 使用与 get_history 相同的查询引擎（筛选条件和排序保持一致），逐批读取热数据和归档
+    query = HistoryQuery(start_date=start_date, end_date=end_date, category=category, status=status)
+    records = iter_tiered(user_state.history, user_state.history_archive, query)
+    
+    if export_format == "xlsx":
+        content = _iter_xlsx_export(records)
+        media_type = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    elif export_format == "csv":
+        content = _iter_csv_export(records)
+        media_type = 'text/csv; charset=utf-8'
     else:
-        # 如果没有openpyxl，回退到CSV格式
-        output = io.StringIO()
-        writer = csv.writer(output)
-        
-        # 写入表头
-        writer.writerow(['时间', '发件人', '主题', '分类', '状态', '回复内容'])
-        
-        # 写入数据
-        row_count = 0
-        for record in records:
-            time_str = record.get('time') or record.get('processed_time', '')
-            sender = record.get('sender') or record.get('sender_email', '')
-            subject = record.get('subject', '')
-            category_val = record.get('category', '')
-            category_label = category_names.get(category_val, category_val or '未分类')
-            status_val = record.get('status', '')
-            status_label = status_names.get(status_val, status_val or '未知')
-            reply = record.get('reply', '')
-            
-            writer.writerow([time_str, sender, subject, category_label, status_label, reply])
-            row_count += 1
-        
-        csv_content = output.getvalue()
-        output.close()
-        
-        filename = f"processing_records_{datetime.now().strftime('%Y%m%d')}.csv"
-        filename_utf8 = f"处理记录_{datetime.now().strftime('%Y%m%d')}.csv"
-        filename_encoded = quote(filename_utf8.encode('utf-8'))
-        
-        return Response(
-            content=csv_content.encode('utf-8-sig'),
-            media_type='text/csv; charset=utf-8',
-            headers={
-                'Content-Disposition': f'attachment; filename="{filename}"; filename*=UTF-8\'\'{filename_encoded}'
-            }
-        )
+        content = _iter_ndjson_export(records)
+        media_type = 'application/x-ndjson; charset=utf-8'
+    
+    # 生成文件名
+    date_suffix = datetime.now().strftime('%Y%m%d')
+    filename = f"processing_records_{date_suffix}.{export_format}"
+    filename_encoded = quote(f"处理记录_{date_suffix}.{export_format}".encode('utf-8'))
+    
+    # 同步生成器由 StreamingResponse 在线程池中迭代，不阻塞事件循环
+    return StreamingResponse(
+        content,
+        media_type=media_type,
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"; filename*=UTF-8\'\'{filename_encoded}'
+        }
+    )
 
 @app.post("/api/history/clear")
 async def clear_history(
@@ -5204,9 +5964,11 @@ async def clear_history(
     """
     try:
         user_state = get_user_state(current_username)
+        archive = user_state.history_archive
+        archived_count = len(archive) if archive is not None else 0
         original_count = len(user_state.history)
         
-        if original_count == 0:
+        if original_count == 0 and archived_count == 0:
             return {
                 "success": True,
                 "message": "没有历史记录",
@@ -5229,15 +5991,22 @@ async def clear_history(
                     filtered_history.append(record)
             
             user_state.history = filtered_history
+            if archive is not None:
+                deleted_count += archive.delete_before(before_date)
         else:
             # 删除所有记录
             deleted_count = original_count
             user_state.history = []
+            if archive is not None:
+                deleted_count += archive.clear()
+        
+        if archive is not None:
+            user_state.stats_rollup.load_static('archive', archive.contributions())
         
         # 保存数据
         save_user_email_data(current_username, user_state)
         
-        remaining_count = len(user_state.history)
+        remaining_count = len(user_state.history) + (len(archive) if archive is not None else 0)
         
         print(f"✅ [历史记录清理] 用户 {current_username}: 删除 {deleted_count} 条记录，保留 {remaining_count} 条")
         
@@ -5537,6 +6306,9 @@ async def cancel_rag_test(current_username: str = Depends(get_username_from_requ
     """取消正在进行的RAG测试"""
     cancel_flag = get_rag_cancel_flag(current_username)
     cancel_flag.set()
+    token = rag_test_tokens.get(current_username)
+    if token is not None:
+        token.cancel("取消RAG测试")
     print(f"🚫 [RAG测试] 用户 {current_username} 请求取消检索")
     return {"success": True, "message": "取消请求已发送"}
 
@@ -5554,6 +6326,8 @@ async def test_rag(
     # 获取取消标志（按用户）
     cancel_flag = get_rag_cancel_flag(current_username)
     cancel_flag.clear()  # 开始新的检索前，清除之前的取消标志
+    rag_token = CancellationToken(f"{current_username} RAG测试")
+    rag_test_tokens[current_username] = rag_token
     
     def run_rag_test_sync():
         """同步执行RAG测试的函数（在线程池中执行，避免阻塞事件循环）"""
@@ -5575,11 +6349,7 @@ async def test_rag(
                         "success": False,
                         "cancelled": True
                     }
-                    import asyncio
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    loop.run_until_complete(ws_manager.broadcast(message))
-                    loop.close()
+                    notification_bus.publish(current_username, message)
                     print(f"📢 [RAG测试] 已通过 WebSocket 通知前端检索已取消")
                 except Exception as ws_error:
                     print(f"⚠️ [RAG测试] WebSocket 通知失败: {ws_error}")
@@ -5637,7 +6407,7 @@ async def test_rag(
             
             # 先分类邮件（用于选择不同的检索策略）
             # 使用nodes.categorize_email方法，需要传入state
-            category_state = nodes.categorize_email(state)
+            category_state = run_node_stage(rag_token, nodes, 'categorize_email', state)
             state.update(category_state)
             category = state.get("email_category", "product_enquiry")
             
@@ -5658,11 +6428,7 @@ async def test_rag(
                         "success": False,
                         "cancelled": True
                     }
-                    import asyncio
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    loop.run_until_complete(ws_manager.broadcast(message))
-                    loop.close()
+                    notification_bus.publish(current_username, message)
                 except Exception as ws_error:
                     print(f"⚠️ [RAG测试] WebSocket 通知失败: {ws_error}")
                 return cancel_result
@@ -5673,7 +6439,7 @@ async def test_rag(
             print(f"📋 [RAG测试] 邮件分类: {category}")
             
             # 构建RAG查询（与处理邮件时相同）
-            rag_query_result = nodes.construct_rag_queries(state)
+            rag_query_result = run_node_stage(rag_token, nodes, 'construct_rag_queries', state)
             state.update(rag_query_result)
             print(f"🔍 [RAG测试] 生成的查询: {state.get('rag_queries', [])}")
             
@@ -5694,19 +6460,37 @@ async def test_rag(
                         "success": False,
                         "cancelled": True
                     }
-                    import asyncio
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    loop.run_until_complete(ws_manager.broadcast(message))
-                    loop.close()
+                    notification_bus.publish(current_username, message)
                 except Exception as ws_error:
                     print(f"⚠️ [RAG测试] WebSocket 通知失败: {ws_error}")
                 return cancel_result
             
             # 从RAG检索信息（与处理邮件时相同）
-            rag_result = nodes.retrieve_from_rag(state)
+            rag_result = run_node_stage(rag_token, nodes, 'retrieve_from_rag', state)
             state.update(rag_result)
             
+            # 检查是否已取消（检索被中断时结果为空）
+            if cancel_flag.is_set():
+                print(f"🚫 [RAG测试] 在检索过程中检测到取消信号，停止检索")
+                cancel_result = {
+                    "question": request.question,
+                    "answer": "检索已取消",
+                    "success": False
+                }
+                # 通过 WebSocket 通知前端检索已取消
+                try:
+                    message = {
+                        "type": "rag_test_complete",
+                        "question": request.question,
+                        "answer": "检索已取消",
+                        "success": False,
+                        "cancelled": True
+                    }
+                    notification_bus.publish(current_username, message)
+                except Exception as ws_error:
+                    print(f"⚠️ [RAG测试] WebSocket 通知失败: {ws_error}")
+                return cancel_result
+            
             # 获取检索结果
             retrieved_docs = state.get('retrieved_documents', '')
             print(f"✅ [RAG测试] 检索成功，结果长度: {len(retrieved_docs) if retrieved_docs else 0}")
@@ -5733,12 +6517,7 @@ async def test_rag(
                     "answer": result,
                     "success": True
                 }
-                # 在新的事件循环中发送（因为当前在线程池中）
-                import asyncio
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                loop.run_until_complete(ws_manager.broadcast(message))
-                loop.close()
+                notification_bus.publish(current_username, message)
                 print(f"📢 [RAG测试] 已通过 WebSocket 通知前端检索完成")
             except Exception as ws_error:
                 print(f"⚠️ [RAG测试] WebSocket 通知失败: {ws_error}")
@@ -5763,11 +6542,7 @@ async def test_rag(
                     "answer": f"检索失败: {str(e)}",
                     "success": False
                 }
-                import asyncio
-                loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(loop)
-                loop.run_until_complete(ws_manager.broadcast(message))
-                loop.close()
+                notification_bus.publish(current_username, message)
             except Exception as ws_error:
                 print(f"⚠️ [RAG测试] WebSocket 通知失败: {ws_error}")
             
@@ -5784,6 +6559,8 @@ async def test_rag(
         )
         # 检索完成，清除取消标志
         clear_rag_cancel_flag(current_username)
+        if rag_test_tokens.get(current_username) is rag_token:
+            del rag_test_tokens[current_username]
         
         # 如果同步函数中已经发送了 WebSocket 通知，这里就不需要再发送了
         # 但为了确保前端能收到，这里也发送一次（作为备用）
@@ -5792,6 +6569,7 @@ async def test_rag(
     except asyncio.CancelledError:
         # 客户端断开连接或请求被取消
         cancel_flag.set()  # 设置取消标志，让同步函数也能检测到
+        rag_token.cancel("客户端断开连接")
         print(f"🚫 [RAG测试] 客户端断开连接，停止检索")
         # 通过 WebSocket 通知前端检索已取消
         try:
@@ -5802,7 +6580,7 @@ async def test_rag(
                 "success": False,
                 "cancelled": True
             }
-            await ws_manager.broadcast(message)
+            notification_bus.publish(current_username, message)
         except Exception as ws_error:
             print(f"⚠️ [RAG测试] WebSocket 通知失败: {ws_error}")
         return {
@@ -6107,19 +6885,13 @@ async def save_settings(settings: SettingsModel, background_tasks: BackgroundTas
     # 注意：不再自动启动监控，让用户自己决定何时启动监控
     if auto_send_enabled:
         user_state = get_user_state(current_username)
-        # 只有在监控已经运行的情况下，才启动自动发送线程
+        # 只有在监控已经运行的情况下，才启动自动发送检查
         if user_state.is_running:
-            # 如果自动发送线程未启动，启动自动发送线程
-            if user_state.auto_send_thread is None or not user_state.auto_send_thread.is_alive():
-                print(f"🚀 [保存设置] 检测到自动发送已开启且监控正在运行，启动自动发送线程...")
-                user_state.auto_send_thread = threading.Thread(target=user_state._auto_send_loop, daemon=True)
-                user_state.auto_send_thread.start()
-                print(f"✅ [保存设置] 自动发送线程已启动")
-            
-            # 在后台任务中执行自动发送，避免阻塞响应
-            background_tasks.add_task(send_processed_emails_with_rate_limit, current_username)
+            # 把已处理的邮件加入待发送队列，由发送调度按速率限制依次发送
+            print(f"🚀 [保存设置] 检测到自动发送已开启且监控正在运行，加入待发送队列...")
+            mailbox_poller.enable_auto_send(current_username)
         else:
-            print(f"ℹ️ [保存设置] 自动发送已开启，但监控未运行。自动发送线程将在启动监控时自动启动。")
+            print(f"ℹ️ [保存设置] 自动发送已开启，但监控未运行。自动发送检查将在启动监控时自动启动。")
     
     return {"message": "设置已保存"}
 
@@ -6266,10 +7038,9 @@ def generate_body_summary_only(email: dict, user_state, username: str, batch_mod
                     email['body_summary'] = body_summary
                     
                     # 同时更新 history 中的记录（如果存在）
-                    for record in user_state.history:
-                        if record.get('id') == email_id:
-                            record['body_summary'] = body_summary
-                            break
+                    record = user_state.history.find_email(email_id)
+                    if record is not None:
+                        record['body_summary'] = body_summary
                     
                     # 如果不是批量模式，立即保存到文件
                     if not batch_mode:
@@ -6278,15 +7049,12 @@ def generate_body_summary_only(email: dict, user_state, username: str, batch_mod
                 
                 # 通过 WebSocket 推送摘要已保存的消息
                 try:
-                    asyncio.run(ws_manager.send_message_to_user(
-                        username,
-                        {
-                            "type": "summary_saved",
-                            "email_id": email_id,
-                            "body_summary": body_summary,
-                            "reply_summary": None  # 新邮件还没有回复内容
-                        }
-                    ))
+                    notification_bus.publish(username, {
+                        "type": "summary_saved",
+                        "email_id": email_id,
+                        "body_summary": body_summary,
+                        "reply_summary": None  # 新邮件还没有回复内容
+                    })
                     print(f"📤 [摘要生成] 已通过 WebSocket 推送原始邮件摘要: {email_id}")
                 except Exception as ws_error:
                     print(f"⚠️ [摘要生成] WebSocket 推送失败: {ws_error}")
@@ -6415,34 +7183,29 @@ def generate_email_summaries_async(username: str, email_id: str, body: str, repl
             with user_lock:
                 # 更新邮件缓存中的摘要
                 email_found_in_cache = False
-                for email in user_state.emails_cache:
-                    if email.get('id') == email_id:
-                        if body_summary:
-                            email['body_summary'] = body_summary
-                        if reply_summary:
-                            email['reply_summary'] = reply_summary
-                        email_found_in_cache = True
-                        print(f"✅ [摘要生成] 已更新邮件缓存中的摘要: {email_id}")
-                        break
+                email = user_state.emails_cache.get(email_id)
+                if email is not None:
+                    if body_summary:
+                        email['body_summary'] = body_summary
+                    if reply_summary:
+                        email['reply_summary'] = reply_summary
+                    email_found_in_cache = True
+                    print(f"✅ [摘要生成] 已更新邮件缓存中的摘要: {email_id}")
                 
                 if not email_found_in_cache:
                     print(f"⚠️ [摘要生成] 未在邮件缓存中找到邮件: {email_id}")
                 
                 # 更新历史记录中的摘要
-                history_found = False
-                for history_record in user_state.history:
-                    if history_record.get('id') == email_id:
-                        if body_summary:
-                            history_record['body_summary'] = body_summary
-                        if reply_summary:
-                            history_record['reply_summary'] = reply_summary
-                        history_found = True
-                        print(f"✅ [摘要生成] 已更新历史记录中的摘要: {email_id}")
-                        print(f"  - body_summary 长度: {len(body_summary) if body_summary else 0}")
-                        print(f"  - reply_summary 长度: {len(reply_summary) if reply_summary else 0}")
-                        break
-                
-                if not history_found:
+                history_record = user_state.history.find_email(email_id)
+                if history_record is not None:
+                    if body_summary:
+                        history_record['body_summary'] = body_summary
+                    if reply_summary:
+                        history_record['reply_summary'] = reply_summary
+                    print(f"✅ [摘要生成] 已更新历史记录中的摘要: {email_id}")
+                    print(f"  - body_summary 长度: {len(body_summary) if body_summary else 0}")
+                    print(f"  - reply_summary 长度: {len(reply_summary) if reply_summary else 0}")
+                else:
                     print(f"⚠️ [摘要生成] 未在历史记录中找到邮件: {email_id}")
                     print(f"  - 历史记录总数: {len(user_state.history)}")
                     print(f"  - 历史记录ID列表: {[h.get('id') for h in user_state.history[:5]]}")
@@ -6464,22 +7227,10 @@ def generate_email_summaries_async(username: str, email_id: str, body: str, repl
                 print(f"  - 邮件ID: {email_id}")
                 print(f"  - body_summary: {body_summary[:50] if body_summary else None}...")
                 print(f"  - reply_summary: {reply_summary[:50] if reply_summary else None}...")
-                print(f"  - websocket_event_loop 存在: {websocket_event_loop is not None}")
                 
-                if websocket_event_loop:
-                    # 在事件循环中异步发送（线程安全）
-                    future = asyncio.run_coroutine_threadsafe(
-                        ws_manager.send_message_to_user(username, payload), 
-                        websocket_event_loop
-                    )
-                    # 等待发送完成（最多等待5秒）
-                    try:
-                        future.result(timeout=5)
-                        print(f"✅ [摘要生成] WebSocket 消息已成功发送给用户: {username}")
-                    except Exception as send_err:
-                        print(f"❌ [摘要生成] WebSocket 消息发送失败: {send_err}")
-                else:
-                    print("⚠️ [摘要生成] 未初始化 websocket_event_loop，无法推送消息")
+                # 放入通知总线后立即返回，由主事件循环负责发送
+                if notification_bus.publish(username, payload):
+                    print(f"✅ [摘要生成] WebSocket 消息已加入发送队列: {username}")
             except Exception as e:
                 print(f"⚠️ [摘要生成] 推送 WS 消息失败: {e}")
                 import traceback
@@ -157,6 +157,11 @@ export const historyApi = {
   exportHistory: (params) => api.get('/history/export', { params, responseType: 'blob' })
 }
 
+export const changesApi = {
+  // 获取某个版本之后变化的邮件、历史记录和统计（since 为上次返回的版本标识，不传时只返回当前版本标识）
+  getChanges: (since) => api.get('/changes', { params: since == null ? {} : { since } })
+}
+
 export const knowledgeApi = {
   // 获取文档列表
   getDocuments: () => api.get('/knowledge/documents'),
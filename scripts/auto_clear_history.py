@@ -2,13 +2,45 @@
 自动清理历史记录（无需确认）
 """
 import os
+import sys
 import json
 
 USER_DATA_DIR = "data/users"
 
+# 允许从项目根目录导入 src 包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.history_archive import get_history_archive
+from src.user_store import get_user_store
+
+
+def load_data_file(filepath):
+    """读取用户数据文件（支持 SQLite 数据库和旧的 JSON 文件）"""
+    if filepath.endswith(".db"):
+        return get_user_store(filepath).load()
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_archive(filepath):
+    """用户的历史记录归档（与数据文件同名，后缀 _archive），没有归档时返回 None"""
+    archive_dir = os.path.splitext(filepath)[0] + "_archive"
+    if not os.path.isdir(archive_dir):
+        return None
+    return get_history_archive(archive_dir)
+
+
+def save_data_file(filepath, data):
+    """保存用户数据文件（数据库只写入变化的行）"""
+    if filepath.endswith(".db"):
+        get_user_store(filepath).save_data(data)
+        return
+    with open(filepath, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
 def auto_clear_history():
     """自动清理所有用户的历史记录"""
-    files = [f for f in os.listdir(USER_DATA_DIR) if f.startswith("user_email_data_") and f.endswith(".json")]
+    files = [f for f in os.listdir(USER_DATA_DIR) if f.startswith("user_email_data_") and f.endswith((".json", ".db"))]
     
     total_deleted = 0
     
@@ -20,17 +52,18 @@ def auto_clear_history():
         filepath = os.path.join(USER_DATA_DIR, filename)
         
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = load_data_file(filepath)
         except Exception as e:
             print(f"❌ 读取失败: {filepath} - {e}")
             continue
         
-        user = filename.replace("user_email_data_", "").replace(".json", "")
+        user = filename.replace("user_email_data_", "").rsplit(".", 1)[0]
         history = data.get('history', [])
         original_count = len(history)
+        archive = load_archive(filepath)
+        archived_count = len(archive) if archive is not None else 0
         
-        if original_count == 0:
+        if original_count == 0 and archived_count == 0:
             print(f"ℹ️ 用户 {user}: 没有历史记录")
             continue
         
@@ -39,10 +72,13 @@ def auto_clear_history():
         
         # 保存
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-            print(f"✅ 用户 {user}: 已删除 {original_count} 条记录")
+            save_data_file(filepath, data)
             total_deleted += original_count
+            # 归档中的历史记录一并删除（与 /api/history/clear 一致）
+            if archive is not None:
+                archived_count = archive.clear()
+                total_deleted += archived_count
+            print(f"✅ 用户 {user}: 已删除 {original_count} 条记录（归档 {archived_count} 条）")
         except Exception as e:
             print(f"❌ 保存失败: {filepath} - {e}")
     
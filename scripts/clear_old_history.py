@@ -3,12 +3,45 @@
 用于删除摘要功能实现之前的邮件处理记录
 """
 import os
+import sys
 import json
 from datetime import datetime
 
 # 用户数据目录
 USER_DATA_DIR = "data/users"
 
+# 允许从项目根目录导入 src 包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.history_archive import get_history_archive, record_day
+from src.history_index import HistoryQuery
+from src.user_store import get_user_store
+
+
+def load_data_file(filepath):
+    """读取用户数据文件（支持 SQLite 数据库和旧的 JSON 文件）"""
+    if filepath.endswith(".db"):
+        return get_user_store(filepath).load()
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_archive(filepath):
+    """用户的历史记录归档（与数据文件同名，后缀 _archive），没有归档时返回 None"""
+    archive_dir = os.path.splitext(filepath)[0] + "_archive"
+    if not os.path.isdir(archive_dir):
+        return None
+    return get_history_archive(archive_dir)
+
+
+def save_data_file(filepath, data):
+    """保存用户数据文件（数据库只写入变化的行）"""
+    if filepath.endswith(".db"):
+        get_user_store(filepath).save_data(data)
+        return
+    with open(filepath, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+
+
 def clear_old_history(username=None, before_date=None, dry_run=True):
     """
     清理旧的历史记录
@@ -24,9 +57,11 @@ def clear_old_history(username=None, before_date=None, dry_run=True):
     
     # 获取所有用户的数据文件
     if username:
-        files = [f"user_email_data_{username}.json"]
+        files = [f"user_email_data_{username}.db"]
+        if not os.path.exists(os.path.join(USER_DATA_DIR, files[0])):
+            files = [f"user_email_data_{username}.json"]
     else:
-        files = [f for f in os.listdir(USER_DATA_DIR) if f.startswith("user_email_data_") and f.endswith(".json")]
+        files = [f for f in os.listdir(USER_DATA_DIR) if f.startswith("user_email_data_") and f.endswith((".json", ".db"))]
     
     total_deleted = 0
     
@@ -39,20 +74,21 @@ def clear_old_history(username=None, before_date=None, dry_run=True):
         
         # 读取数据
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = load_data_file(filepath)
         except Exception as e:
             print(f"❌ 读取文件失败: {filepath} - {e}")
             continue
         
         # 提取用户名
-        user = filename.replace("user_email_data_", "").replace(".json", "")
+        user = filename.replace("user_email_data_", "").rsplit(".", 1)[0]
         
-        # 获取历史记录
+        # 获取历史记录（包括已归档的记录）
         history = data.get('history', [])
         original_count = len(history)
+        archive = load_archive(filepath)
+        archived_count = len(archive) if archive is not None else 0
         
-        if original_count == 0:
+        if original_count == 0 and archived_count == 0:
             print(f"ℹ️ 用户 {user}: 没有历史记录")
             continue
         
@@ -74,23 +110,35 @@ def clear_old_history(username=None, before_date=None, dry_run=True):
                     filtered_history.append(record)
             
             data['history'] = filtered_history
+            
+            # 归档中的记录按同样的规则统计（试运行）或删除
+            if archive is not None:
+                if dry_run:
+                    archived_deleted = sum(1 for record in archive.iter_query(HistoryQuery())
+                                           if record_day(record) and record_day(record) < before_date)
+                    if archived_deleted:
+                        print(f"  - 将删除归档中的 {archived_deleted} 条记录")
+                else:
+                    archived_deleted = archive.delete_before(before_date)
+                deleted_count += archived_deleted
         else:
-            # 删除所有记录
-            deleted_count = original_count
+            # 删除所有记录（包括归档）
+            deleted_count = original_count + archived_count
             data['history'] = []
+            if archive is not None and not dry_run:
+                archive.clear()
             
             if dry_run:
-                print(f"  - 将删除所有 {deleted_count} 条记录")
+                print(f"  - 将删除所有 {deleted_count} 条记录（其中归档 {archived_count} 条）")
         
         if deleted_count > 0:
-            print(f"📊 用户 {user}: 原有 {original_count} 条记录，将删除 {deleted_count} 条，保留 {len(data.get('history', []))} 条")
+            print(f"📊 用户 {user}: 原有 {original_count + archived_count} 条记录（其中归档 {archived_count} 条），将删除 {deleted_count} 条")
             total_deleted += deleted_count
             
             # 如果不是试运行，保存数据
             if not dry_run:
                 try:
-                    with open(filepath, 'w', encoding='utf-8') as f:
-                        json.dump(data, f, ensure_ascii=False, indent=2)
+                    save_data_file(filepath, data)
                     print(f"✅ 已保存: {filepath}")
                 except Exception as e:
                     print(f"❌ 保存文件失败: {filepath} - {e}")
@@ -3,13 +3,37 @@
 让用户确认要删除哪些记录
 """
 import os
+import sys
 import json
 
 USER_DATA_DIR = "data/users"
 
+# 允许从项目根目录导入 src 包
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from src.history_archive import get_history_archive
+from src.history_index import HistoryQuery
+from src.user_store import get_user_store
+
+
+def load_data_file(filepath):
+    """读取用户数据文件（支持 SQLite 数据库和旧的 JSON 文件）"""
+    if filepath.endswith(".db"):
+        return get_user_store(filepath).load()
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_archive(filepath):
+    """用户的历史记录归档（与数据文件同名，后缀 _archive），没有归档时返回 None"""
+    archive_dir = os.path.splitext(filepath)[0] + "_archive"
+    if not os.path.isdir(archive_dir):
+        return None
+    return get_history_archive(archive_dir)
+
+
 def show_history_details():
     """显示所有用户的历史记录详情"""
-    files = [f for f in os.listdir(USER_DATA_DIR) if f.startswith("user_email_data_") and f.endswith(".json")]
+    files = [f for f in os.listdir(USER_DATA_DIR) if f.startswith("user_email_data_") and f.endswith((".json", ".db"))]
     
     total_records = 0
     
@@ -17,21 +41,22 @@ def show_history_details():
         filepath = os.path.join(USER_DATA_DIR, filename)
         
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = load_data_file(filepath)
         except Exception as e:
             print(f"❌ 读取失败: {filepath}")
             continue
         
-        user = filename.replace("user_email_data_", "").replace(".json", "")
+        user = filename.replace("user_email_data_", "").rsplit(".", 1)[0]
         history = data.get('history', [])
+        archive = load_archive(filepath)
+        archived_count = len(archive) if archive is not None else 0
         
-        if len(history) == 0:
+        if len(history) == 0 and archived_count == 0:
             continue
         
         print(f"\n{'='*60}")
         print(f"用户: {user}")
-        print(f"历史记录数量: {len(history)} 条")
+        print(f"历史记录数量: {len(history) + archived_count} 条（其中已归档 {archived_count} 条）")
         print(f"{'='*60}")
         
         for i, record in enumerate(history, 1):
@@ -49,7 +74,14 @@ def show_history_details():
             print(f"      有原始邮件摘要: {'✅' if has_body_summary else '❌'}")
             print(f"      有回复内容摘要: {'✅' if has_reply_summary else '❌'}")
         
-        total_records += len(history)
+        if archived_count:
+            # 归档记录按月份压缩保存，只列出日期、主题和状态
+            print(f"\n  已归档的记录:")
+            for i, record in enumerate(archive.iter_query(HistoryQuery()), len(history) + 1):
+                time = record.get('time') or record.get('processed_time', '未知时间')
+                print(f"  [{i}] {time} | {record.get('subject', '无主题')[:50]} | {record.get('status', '未知状态')}")
+        
+        total_records += len(history) + archived_count
     
     print(f"\n{'='*60}")
     print(f"总计: {total_records} 条历史记录")
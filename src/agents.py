@@ -16,6 +16,147 @@ from .prompts import (
     GENERATE_RAG_ANSWER_CUSTOMER_FEEDBACK
 )
 import os
+import socket
+import weakref
+import httpcore
+import httpx
+
+
+class _TrackedStream:
+    """网络流代理：记录底层 socket（TLS 握手后记录新的 socket），以便从其他线程断开"""
+
+    def __init__(self, stream, sockets):
+        self._stream = stream
+        sock = stream.get_extra_info('socket')
+        if sock is not None:
+            sockets.add(sock)
+        self._sockets = sockets
+
+    def read(self, *args, **kwargs):
+        return self._stream.read(*args, **kwargs)
+
+    def write(self, *args, **kwargs):
+        return self._stream.write(*args, **kwargs)
+
+    def close(self):
+        return self._stream.close()
+
+    def start_tls(self, *args, **kwargs):
+        return _TrackedStream(self._stream.start_tls(*args, **kwargs), self._sockets)
+
+    def get_extra_info(self, info):
+        return self._stream.get_extra_info(info)
+
+
+class _TrackedBackend:
+    """网络后端代理：新建的连接都经过 _TrackedStream"""
+
+    def __init__(self, backend, sockets):
+        self._backend = backend
+        self._sockets = sockets
+
+    def connect_tcp(self, *args, **kwargs):
+        return _TrackedStream(self._backend.connect_tcp(*args, **kwargs), self._sockets)
+
+    def __getattr__(self, name):
+        return getattr(self._backend, name)
+
+
+def _map_httpcore_error(exc: Exception) -> Exception:
+    """把 httpcore 的异常转换为同名的 httpx 异常（openai 客户端据此判断是否重试）"""
+    error_class = getattr(httpx, type(exc).__name__, None)
+    if not (isinstance(error_class, type) and issubclass(error_class, httpx.TransportError)):
+        error_class = httpx.TransportError
+    return error_class(str(exc))
+
+
+class _ResponseStream(httpx.SyncByteStream):
+    """httpcore 响应流 -> httpx 响应流"""
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                yield chunk
+        except httpcore.TimeoutException as e:
+            raise _map_httpcore_error(e) from e
+        except (httpcore.NetworkError, httpcore.ProtocolError) as e:
+            raise _map_httpcore_error(e) from e
+
+    def close(self):
+        if hasattr(self._stream, 'close'):
+            self._stream.close()
+
+
+class _AbortableTransport(httpx.BaseTransport):
+    """
+    使用自建 httpcore 连接池的 httpx 传输层
+
+    通过 httpcore.ConnectionPool 的 network_backend 参数接入 _TrackedBackend，
+    连接池参数与 httpx 默认值一致。
+    """
+
+    def __init__(self, sockets):
+        self._pool = httpcore.ConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=100,
+            max_keepalive_connections=20,
+            keepalive_expiry=5.0,
+            network_backend=_TrackedBackend(httpcore.SyncBackend(), sockets),
+        )
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path,
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        try:
+            core_response = self._pool.handle_request(core_request)
+        except (httpcore.TimeoutException, httpcore.NetworkError, httpcore.ProtocolError,
+                httpcore.UnsupportedProtocol) as e:
+            raise _map_httpcore_error(e) from e
+        return httpx.Response(
+            status_code=core_response.status,
+            headers=core_response.headers,
+            stream=_ResponseStream(core_response.stream),
+            extensions=core_response.extensions,
+        )
+
+    def close(self):
+        self._pool.close()
+
+
+class AbortableHTTPClient:
+    """
+    可中断的模型 HTTP 客户端
+
+    abort() 对所有连接执行 shutdown：阻塞在等待响应的请求立即出错返回，
+    服务端也会看到连接断开并停止生成（仅关闭客户端无法唤醒其他线程中阻塞的读取）。
+    """
+
+    def __init__(self):
+        self._sockets = weakref.WeakSet()
+        self.client = httpx.Client(transport=_AbortableTransport(self._sockets))
+
+    def abort(self):
+        """断开所有连接并关闭客户端（之后不能再使用）"""
+        for sock in list(self._sockets):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.client.close()
+
 
 class Agents():
     def __init__(self, api_key=None, reply_model=None, embedding_model=None, signature=None, greeting=None, closing=None, reply_api_base=None, embedding_api_base=None):
@@ -36,11 +177,15 @@ class Agents():
         if embedding_api_base is None:
             embedding_api_base = "https://api.siliconflow.cn/v1"
         
+        # 每个实例独立的 HTTP 客户端，终止处理时通过 abort() 中断进行中的模型请求
+        self.http_client = AbortableHTTPClient()
+        
         self.qwen_llm = ChatOpenAI(
             model=reply_model,  # 使用传入的模型
             temperature=0.1,
             openai_api_key=api_key,
-            openai_api_base=reply_api_base
+            openai_api_base=reply_api_base,
+            http_client=self.http_client.client
         )
         qwen_llm = self.qwen_llm  # 保持向后兼容
         
@@ -54,7 +199,8 @@ class Agents():
                 model=embedding_model,  # 使用传入的嵌入模型
                 openai_api_key=api_key,
                 openai_api_base=embedding_api_base,
-                request_timeout=60  # 增加超时时间到60秒，因为嵌入模型可能需要更长时间
+                request_timeout=60,  # 增加超时时间到60秒，因为嵌入模型可能需要更长时间
+                http_client=self.http_client.client
             )
         except:
             # 使用本地嵌入模型作为备用
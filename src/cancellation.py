@@ -0,0 +1,276 @@
+"""
+协作式取消
+终止处理（全部终止、单封终止、取消RAG测试）时取消对应的 CancellationToken：
+通过 abort 回调断开底层的 HTTP / IMAP 连接，正在等待的模型调用和邮箱操作随即出错返回，
+不再等调用自然结束后才在检查点发现终止标志。每次取消节省了多少工作记录在 cancellation_metrics 中。
+"""
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Callable, Dict, List, Optional
+
+
+# 保留的最近取消记录数
+RECENT_CANCELLATIONS = 50
+
+# 用于统计终止延迟的最近样本数
+LATENCY_SAMPLES = 200
+
+
+class CancellationToken:
+    """
+    取消令牌
+
+    - 令牌可以有父令牌：父令牌取消时所有子令牌一并取消，在已取消的父令牌下创建的子令牌直接处于取消状态
+    - on_cancel 注册的回调在取消时于调用 cancel 的线程中执行（用于中断进行中的网络请求）
+    - 一次取消（含被连带取消的子令牌）共用一条统计记录
+    """
+
+    def __init__(self, label: str = '', parent: Optional["CancellationToken"] = None):
+        """
+        @param label: 令牌说明（用于日志和统计），如 '邮件 <ID>'
+        @param parent: 父令牌
+        """
+        self.label = label
+        self.reason: Optional[str] = None
+        self.cancelled_at: Optional[float] = None
+        # 本次取消的统计记录（与取消源头的令牌共用）
+        self.record: Optional[dict] = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks: List[Callable] = []
+        self._children = weakref.WeakSet()
+        if parent is not None:
+            parent._adopt(self)
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def child(self, label: str = '') -> "CancellationToken":
+        """创建子令牌"""
+        return CancellationToken(label, parent=self)
+
+    def _adopt(self, child: "CancellationToken"):
+        with self._lock:
+            if not self._event.is_set():
+                self._children.add(child)
+                return
+        # 父令牌已取消：子任务还没开始就被终止
+        child._cancel(self.reason, self.record, skipped=True)
+
+    def cancel(self, reason: str = '') -> bool:
+        """
+        取消令牌（重复取消无效）
+
+        @param reason: 取消原因
+        @return: 是否是本次调用取消的
+        """
+        return self._cancel(reason, None)
+
+    def _cancel(self, reason: Optional[str], record: Optional[dict], skipped: bool = False) -> bool:
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self.cancelled_at = time.monotonic()
+            self.record = record if record is not None else cancellation_metrics.open_record(self)
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+            children = list(self._children)
+            self._children = weakref.WeakSet()
+        # 只计入实际对应任务的令牌（批量处理的父令牌本身不是任务）
+        if skipped or not children:
+            cancellation_metrics.task_cancelled(self.record, skipped)
+        for callback in callbacks:
+            self._invoke(callback)
+        for child in children:
+            child._cancel(reason, self.record)
+        return True
+
+    def _invoke(self, callback: Callable):
+        try:
+            callback(self)
+        except Exception as e:
+            print(f"⚠️ [取消] 令牌 {self.label} 的取消回调执行失败: {e}")
+
+    def on_cancel(self, callback: Callable) -> Callable:
+        """
+        注册取消回调；令牌已取消时立即执行
+
+        @param callback: 回调 callback(token)
+        @return: callback（用于 remove_callback）
+        """
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return callback
+        self._invoke(callback)
+        return callback
+
+    def remove_callback(self, callback: Callable):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def run_cancellable(token: Optional[CancellationToken], func: Callable, *args,
+                    abort: Optional[Callable] = None, name: Optional[str] = None,
+                    default=None, **kwargs):
+    """
+    执行一个可被取消的阻塞调用
+
+    调用在当前线程中执行（不额外创建线程）；执行期间令牌被取消时，
+    在取消方的线程中调用 abort 断开底层连接，阻塞中的调用随即出错返回，
+    本函数返回 default，调用方随后在已有的检查点上结束处理流程。
+
+    @param token: 取消令牌，None 表示不可取消
+    @param func: 被调用的函数
+    @param abort: 取消时执行的中断函数（断开连接），如 Nodes.abort
+    @param name: 调用名称（用于统计），默认取函数名
+    @param default: 被取消（或开始前已取消）时的返回值
+    @return: 函数返回值或 default
+    """
+    name = name or getattr(func, '__name__', 'call')
+    if token is None:
+        return func(*args, **kwargs)
+    if token.cancelled:
+        cancellation_metrics.stage_skipped(token, name)
+        return default
+
+    def interrupt(_token):
+        if abort is not None:
+            try:
+                abort()
+            except Exception as e:
+                print(f"⚠️ [取消] 中断 {name} 失败: {e}")
+
+    started = time.monotonic()
+    listener = token.on_cancel(interrupt)
+    try:
+        result = func(*args, **kwargs)
+    except Exception:
+        if not token.cancelled:
+            raise
+        # 连接被 abort 断开导致的异常
+        result = default
+    finally:
+        token.remove_callback(listener)
+
+    elapsed = time.monotonic() - started
+    if not token.cancelled:
+        cancellation_metrics.stage_completed(name, elapsed)
+        return result
+    cancellation_metrics.call_aborted(token, name, elapsed)
+    print(f"⏹️ [取消] {token.label} 的 {name} 已中断（已执行 {elapsed:.1f} 秒）")
+    return default
+
+
+class CancellationMetrics:
+    """
+    取消统计
+
+    - 每次取消一条记录：连带取消的任务数、未开始就被跳过的任务和阶段、被中断的调用及其已耗时间
+    - 按各阶段正常完成的平均耗时估算节省的时间（被跳过的阶段按平均耗时，被中断的调用按剩余的平均耗时）
+    - 终止延迟：从取消到被中断的调用返回、处理线程拿回控制权的时间
+    """
+
+    def __init__(self, history: int = RECENT_CANCELLATIONS):
+        self._lock = threading.Lock()
+        self.counters = {
+            'cancellations': 0,
+            'tasks_cancelled': 0,
+            'tasks_skipped': 0,
+            'stages_skipped': 0,
+            'calls_aborted': 0,
+            'aborted_call_seconds': 0.0,
+            'estimated_seconds_saved': 0.0,
+        }
+        # 阶段名 -> [完成次数, 平均耗时]
+        self._stage_times: Dict[str, list] = {}
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self._recent = deque(maxlen=history)
+
+    def _average(self, name: str) -> float:
+        entry = self._stage_times.get(name)
+        return entry[1] if entry else 0.0
+
+    def open_record(self, token: CancellationToken) -> dict:
+        """为一次新的取消创建统计记录"""
+        record = {
+            'label': token.label,
+            'reason': token.reason,
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'tasks_cancelled': 0,
+            'tasks_skipped': 0,
+            'stages_skipped': 0,
+            'calls_aborted': 0,
+            'aborted_call_seconds': 0.0,
+            'estimated_seconds_saved': 0.0,
+            'stop_latency_ms': None,
+        }
+        with self._lock:
+            self.counters['cancellations'] += 1
+            self._recent.append(record)
+        return record
+
+    def task_cancelled(self, record: Optional[dict], skipped: bool):
+        key = 'tasks_skipped' if skipped else 'tasks_cancelled'
+        with self._lock:
+            self.counters[key] += 1
+            if record is not None:
+                record[key] += 1
+
+    def stage_completed(self, name: str, seconds: float):
+        with self._lock:
+            entry = self._stage_times.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += (seconds - entry[1]) / entry[0]
+
+    def stage_skipped(self, token: CancellationToken, name: str):
+        with self._lock:
+            saved = self._average(name)
+            self.counters['stages_skipped'] += 1
+            self.counters['estimated_seconds_saved'] += saved
+            record = token.record
+            if record is not None:
+                record['stages_skipped'] += 1
+                record['estimated_seconds_saved'] = round(record['estimated_seconds_saved'] + saved, 3)
+
+    def call_aborted(self, token: CancellationToken, name: str, elapsed: float):
+        latency = time.monotonic() - token.cancelled_at if token.cancelled_at else 0.0
+        with self._lock:
+            saved = max(0.0, self._average(name) - elapsed)
+            self.counters['calls_aborted'] += 1
+            self.counters['aborted_call_seconds'] += elapsed
+            self.counters['estimated_seconds_saved'] += saved
+            self._latencies.append(latency)
+            record = token.record
+            if record is not None:
+                record['calls_aborted'] += 1
+                record['aborted_call_seconds'] = round(record['aborted_call_seconds'] + elapsed, 3)
+                record['estimated_seconds_saved'] = round(record['estimated_seconds_saved'] + saved, 3)
+                latency_ms = round(latency * 1000, 1)
+                if record['stop_latency_ms'] is None or latency_ms > record['stop_latency_ms']:
+                    record['stop_latency_ms'] = latency_ms
+
+    def get_stats(self) -> dict:
+        """取消统计（计数、终止延迟、各阶段平均耗时、最近的取消记录，新记录在前）"""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = {
+                **{k: round(v, 3) if isinstance(v, float) else v for k, v in self.counters.items()},
+                'stop_latency_ms': {
+                    'samples': len(latencies),
+                    'p50': round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+                    'max': round(latencies[-1] * 1000, 1) if latencies else None,
+                },
+                'stage_avg_seconds': {name: round(avg, 3) for name, (_, avg) in self._stage_times.items()},
+                'recent': [dict(record) for record in reversed(self._recent)],
+            }
+        return stats
+
+
+# 全局取消统计
+cancellation_metrics = CancellationMetrics()
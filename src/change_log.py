@@ -0,0 +1,141 @@
+"""
+变更日志
+为每个用户维护单调递增的变更版本号：订阅邮件缓存和历史记录的变化事件，
+记录每条记录最后一次变化时的版本。客户端带上自己已同步到的版本标识
+（'<实例标识>-<版本号>'），只取回之后变化的记录，轮询的数据量与变化量相关而与全部数据量无关。
+"""
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.email_collection import IndexedRecordList
+
+
+# 保留的变更条目数（每条记录只保留最后一次变化），落后更多的客户端需要全量同步
+CHANGE_LOG_SIZE = 5000
+
+
+class ChangeLog:
+    """
+    单个用户的变更日志
+
+    - version: 当前版本号，每次记录加入/修改/移除都加一
+    - 同一条记录多次变化只保留最后一次（按版本号排序）
+    - 集合被整体替换或重建、以及条目超出容量被淘汰时，更早的版本需要全量同步
+    - 版本标识带实例标识（epoch），服务重启后旧进程的版本号一律需要全量同步
+    """
+
+    def __init__(self, capacity: int = CHANGE_LOG_SIZE):
+        """
+        @param capacity: 保留的变更条目数
+        """
+        self.capacity = capacity
+        self.version = 0
+        # 每个实例不同：服务重启后版本号从头开始，用它区分新旧版本号
+        self.epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        # 早于该版本的客户端需要全量同步
+        self._floor = 0
+        # (数据源, 记录key) -> (版本号, 'upsert'/'remove', 记录)
+        self._entries: "OrderedDict[Tuple[str, int], tuple]" = OrderedDict()
+        # 数据源 -> (集合, 回调)
+        self._sources: Dict[str, Tuple[IndexedRecordList, Callable]] = {}
+
+    # ==================== 数据源 ====================
+
+    def attach(self, source: str, collection: IndexedRecordList):
+        """
+        绑定数据源（替换同名的旧数据源）；已有客户端需要全量同步一次
+
+        @param source: 'emails' 或 'history'
+        @param collection: EmailCollection 或 HistoryCollection
+        """
+        old = self._sources.pop(source, None)
+        if old is not None:
+            old[0].remove_observer(old[1])
+        with self._lock:
+            self._drop_source(source)
+            self.version += 1
+            self._floor = self.version
+
+        # add_observer 会在当前线程中为现有记录补发 'add' 事件，这些记录已包含在全量同步中
+        attaching = {'thread': threading.get_ident()}
+
+        def observer(event, key, record):
+            if event == 'add' and attaching['thread'] == threading.get_ident():
+                return
+            self._on_event(source, event, key, record)
+
+        self._sources[source] = (collection, observer)
+        collection.add_observer(observer)
+        attaching['thread'] = None
+
+    def _drop_source(self, source: str):
+        for entry_key in [k for k in self._entries if k[0] == source]:
+            del self._entries[entry_key]
+
+    def _on_event(self, source: str, event: str, key: int, record: Optional[dict]):
+        with self._lock:
+            self.version += 1
+            if event == 'reset':
+                self._drop_source(source)
+                self._floor = self.version
+                return
+            entry_key = (source, key)
+            self._entries.pop(entry_key, None)
+            self._entries[entry_key] = (self.version, 'remove' if event == 'remove' else 'upsert', record)
+            while len(self._entries) > self.capacity:
+                _, (evicted_version, _, _) = self._entries.popitem(last=False)
+                self._floor = max(self._floor, evicted_version)
+
+    # ==================== 读取 ====================
+
+    def etag_token(self) -> str:
+        """
+        当前数据版本的标识（用于 HTTP ETag），任何记录变化后都会改变
+
+        @return: '<实例标识>-<版本号>'
+        """
+        with self._lock:
+            return f"{self.epoch}-{self.version}"
+
+    def _parse_token(self, token: Optional[str]) -> Optional[int]:
+        """
+        解析客户端带回的版本标识
+
+        @return: 版本号；标识为空、格式不对或来自其他实例（服务已重启）时返回 None
+        """
+        epoch, sep, version = (token or '').rpartition('-')
+        if not sep or epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    def changes_since(self, since: Optional[str]) -> dict:
+        """
+        读取某个版本之后的变化
+
+        @param since: 客户端已同步到的版本标识（上次返回的 version），None 表示首次同步
+        @return: {'version': 当前版本标识, 'resync', 'changes': {数据源: {'upserted': [...], 'removed': [...]}}}
+                 resync 为 True 时 changes 为空，客户端应重新拉取全部数据
+        """
+        since_version = self._parse_token(since)
+        with self._lock:
+            version = self.version
+            token = f"{self.epoch}-{version}"
+            if since_version is None or since_version < self._floor or since_version > version:
+                return {'version': token, 'resync': True, 'changes': {}}
+            changed: List[tuple] = []
+            for (source, _), (entry_version, op, record) in reversed(self._entries.items()):
+                if entry_version <= since_version:
+                    break
+                changed.append((source, op, record))
+
+        changes: Dict[str, Dict[str, list]] = {}
+        for source, op, record in reversed(changed):
+            bucket = changes.setdefault(source, {'upserted': [], 'removed': []})
+            if op == 'remove':
+                bucket['removed'].append(record.get('id'))
+            else:
+                bucket['upserted'].append(dict(record))
+        return {'version': token, 'resync': False, 'changes': changes}
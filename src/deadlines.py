@@ -0,0 +1,119 @@
+"""
+回复时限
+按紧急程度和收信时间为待处理邮件计算回复截止时间，处理队列按最早截止时间优先（EDF）取任务；
+同时统计各紧急程度实际的回复耗时与目标时限的对比（SLO 报告）。
+"""
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, Optional
+
+
+# 各紧急程度的回复时限（秒），可通过环境变量覆盖
+URGENT_RESPONSE_SECONDS = int(os.getenv("URGENT_RESPONSE_SECONDS", str(15 * 60)))
+HIGH_RESPONSE_SECONDS = int(os.getenv("HIGH_RESPONSE_SECONDS", str(60 * 60)))
+# 低紧急程度（及未识别）的回复时限；中等紧急程度为收信当天内，见 response_deadline
+LOW_RESPONSE_SECONDS = int(os.getenv("LOW_RESPONSE_SECONDS", str(24 * 60 * 60)))
+
+# 每个紧急程度保留的最近样本数
+SLO_SAMPLES = 1000
+
+
+def _received_timestamp(email: dict, now: float) -> float:
+    """邮件的收信时间戳（'YYYY-MM-DD HH:MM:SS'，缺失或格式不对时视为现在收到）"""
+    value = str(email.get('time') or '')[:19]
+    try:
+        return datetime.strptime(value, '%Y-%m-%d %H:%M:%S').timestamp()
+    except ValueError:
+        return now
+
+
+def _end_of_day(ts: float) -> float:
+    day = datetime.fromtimestamp(ts).replace(hour=23, minute=59, second=59, microsecond=0)
+    return day.timestamp()
+
+
+def response_deadline(email: dict, now: Optional[float] = None) -> float:
+    """
+    计算邮件的回复截止时间
+
+    - urgent: 收信后 URGENT_RESPONSE_SECONDS（默认15分钟）
+    - high: 收信后 HIGH_RESPONSE_SECONDS（默认1小时）
+    - medium: 收信当天结束前（至少为 high 的时限）
+    - low 及未知: 收信后 LOW_RESPONSE_SECONDS（默认24小时）
+    等待越久的邮件截止时间越早，同等紧急程度下先到先处理。
+
+    @param email: 邮件记录（使用 time 和 urgency_level 字段）
+    @param now: 当前时间戳，默认 time.time()
+    @return: 截止时间戳
+    """
+    now = time.time() if now is None else now
+    received = _received_timestamp(email, now)
+    urgency = email.get('urgency_level')
+    if urgency == 'urgent':
+        return received + URGENT_RESPONSE_SECONDS
+    if urgency == 'high':
+        return received + HIGH_RESPONSE_SECONDS
+    if urgency == 'medium':
+        return max(_end_of_day(received), received + HIGH_RESPONSE_SECONDS)
+    return max(received + LOW_RESPONSE_SECONDS, _end_of_day(received))
+
+
+class ResponseSLO:
+    """
+    回复时限达成情况统计（单个用户，只保存在内存中）
+
+    每封处理完成的邮件记录一次：实际回复耗时（完成时间 - 收信时间）、目标时限（截止时间 - 收信时间）、是否按时。
+    """
+
+    def __init__(self, samples: int = SLO_SAMPLES):
+        self._lock = threading.Lock()
+        self._samples = samples
+        # 紧急程度 -> deque[(实际耗时, 目标时限, 是否按时)]
+        self._records: Dict[str, deque] = {}
+
+    def record(self, email: dict, finished_at: Optional[float] = None):
+        """
+        记录一封邮件的回复完成
+
+        @param email: 邮件记录
+        @param finished_at: 完成时间戳，默认 time.time()
+        """
+        finished_at = time.time() if finished_at is None else finished_at
+        received = _received_timestamp(email, finished_at)
+        deadline = response_deadline(email, finished_at)
+        urgency = email.get('urgency_level') or 'low'
+        with self._lock:
+            bucket = self._records.get(urgency)
+            if bucket is None:
+                bucket = self._records[urgency] = deque(maxlen=self._samples)
+            bucket.append((max(0.0, finished_at - received), deadline - received, finished_at <= deadline))
+
+    def report(self) -> Dict[str, dict]:
+        """
+        各紧急程度的达成情况
+
+        @return: {紧急程度: {'count', 'met', 'met_rate', 'target_seconds', 'p50_seconds', 'p90_seconds', 'max_seconds'}}
+                 target_seconds 为样本目标时限的中位数（medium 的时限随收信时刻变化）
+        """
+        with self._lock:
+            snapshot = {urgency: list(bucket) for urgency, bucket in self._records.items()}
+        result = {}
+        for urgency, rows in snapshot.items():
+            if not rows:
+                continue
+            actual = sorted(row[0] for row in rows)
+            targets = sorted(row[1] for row in rows)
+            met = sum(1 for row in rows if row[2])
+            result[urgency] = {
+                'count': len(rows),
+                'met': met,
+                'met_rate': round(met / len(rows), 4),
+                'target_seconds': round(targets[len(targets) // 2], 1),
+                'p50_seconds': round(actual[len(actual) // 2], 1),
+                'p90_seconds': round(actual[min(len(actual) - 1, int(len(actual) * 0.9))], 1),
+                'max_seconds': round(actual[-1], 1),
+            }
+        return result
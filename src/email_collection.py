@@ -0,0 +1,333 @@
+"""
+带索引的邮件缓存
+SystemState.emails_cache 使用的列表类型：保持插入顺序，
+同时维护 邮件ID -> 记录 与 状态 -> 记录 两个索引，按ID查找、按状态筛选和计数均为常数时间。
+"""
+import threading
+from abc import ABCMeta, abstractmethod
+from typing import Callable, Dict, Iterable, List, Optional
+
+from src.user_store import TrackedRecord
+
+
+def make_email_record(data: dict = ()) -> TrackedRecord:
+    """
+    创建可被 EmailCollection 跟踪的邮件记录
+
+    普通 dict 放入缓存时会被转换为新的 TrackedRecord（调用方手里的原 dict 不再被跟踪）；
+    新建邮件时使用本函数，之后对返回值的修改会即时更新索引。
+
+    @param data: 邮件字段
+    @return: 邮件记录
+    """
+    return TrackedRecord(data)
+
+
+class IndexedRecordList(list, metaclass=ABCMeta):
+    """
+    带二级索引的记录列表基类
+
+    仍然是 list 子类：遍历、切片、len、JSON 序列化等现有用法不变。
+    子类实现 _reset_entries/_add_entry/_remove_entry/_refresh_entry 维护自己的索引；
+    加入的普通 dict 会被转换为 TrackedRecord，记录被修改时通过回调即时刷新索引。
+    外部可以通过 add_observer 订阅记录的加入/移除/修改事件（如统计汇总）。
+    """
+
+    def __init__(self, iterable: Iterable[dict] = ()):
+        if self.__abstractmethods__:
+            # list 子类不经过 object.__new__ 的抽象方法检查，这里补上
+            raise TypeError(f"无法实例化抽象类 {type(self).__name__}")
+        super().__init__(self._track(record) for record in iterable)
+        self._index_lock = threading.RLock()
+        self._records: Dict[int, dict] = {}
+        self._observers: List[Callable] = []
+        self._rebuild()
+
+    # ==================== 子类实现 ====================
+
+    @abstractmethod
+    def _reset_entries(self):
+        """清空子类索引"""
+
+    @abstractmethod
+    def _add_entry(self, key: int, record: dict, seq: int):
+        """把记录加入索引（seq 为加入顺序）"""
+
+    @abstractmethod
+    def _remove_entry(self, key: int):
+        """把记录移出索引"""
+
+    @abstractmethod
+    def _refresh_entry(self, key: int, record: dict) -> bool:
+        """记录内容变化后刷新索引，返回索引字段是否变化"""
+
+    def _initial_records(self) -> Iterable[dict]:
+        """重建索引时记录的加入顺序（默认与列表顺序一致）"""
+        return list.__iter__(self)
+
+    # ==================== 索引维护 ====================
+
+    def _rebuild(self):
+        """按当前列表内容重建全部索引"""
+        with self._index_lock:
+            for record in self._records.values():
+                self._unwatch(record)
+            self._seq = 0
+            self._records = {}
+            self.version = getattr(self, 'version', 0) + 1
+            self._reset_entries()
+            self._notify('reset', 0, None)
+            for record in self._initial_records():
+                self._add(record)
+
+    @staticmethod
+    def _track(record):
+        """普通 dict 转换为 TrackedRecord（列表中保存转换后的对象），其他值原样返回"""
+        if isinstance(record, dict) and not isinstance(record, TrackedRecord):
+            return TrackedRecord(record)
+        return record
+
+    def _watch(self, record):
+        # 同一条记录只由最后加入的集合跟踪（集合被整体替换时旧集合会先 release）
+        record._watcher = self._on_record_changed
+
+    def _unwatch(self, record):
+        if isinstance(record, TrackedRecord) and record._watcher == self._on_record_changed:
+            record._watcher = None
+
+    def _add(self, record):
+        if not isinstance(record, dict):
+            return
+        key = id(record)
+        if key in self._records:
+            # 同一对象重复出现：只索引一次
+            return
+        self._seq += 1
+        self._records[key] = record
+        self._add_entry(key, record, self._seq)
+        self._watch(record)
+        self.version += 1
+        self._notify('add', key, record)
+
+    def _discard(self, record):
+        key = id(record)
+        if self._records.pop(key, None) is None:
+            return
+        self._remove_entry(key)
+        self._unwatch(record)
+        self.version += 1
+        self._notify('remove', key, record)
+
+    def _index_of(self, record) -> int:
+        """按对象（而不是按内容相等）查找记录在列表中的位置"""
+        for i, r in enumerate(list.__iter__(self)):
+            if r is record:
+                return i
+        raise ValueError("记录不在列表中")
+
+    def _on_record_changed(self, record):
+        """记录被修改后的回调"""
+        with self._index_lock:
+            key = id(record)
+            if self._records.get(key) is not record:
+                return
+            if self._refresh_entry(key, record):
+                self.version += 1
+            self._notify('change', key, record)
+
+    def release(self):
+        """
+        解除对记录的回调（集合被整体替换时调用），记录之后由新的集合跟踪；
+        本集合的索引不再随记录的修改更新
+        """
+        with self._index_lock:
+            for record in self._records.values():
+                self._unwatch(record)
+
+    # ==================== 事件订阅 ====================
+
+    def _notify(self, event: str, key: int, record: Optional[dict]):
+        for observer in self._observers:
+            try:
+                observer(event, key, record)
+            except Exception as e:
+                print(f"⚠️ [索引] 事件回调失败: {e}")
+
+    def add_observer(self, observer: Callable):
+        """
+        订阅记录变化事件，并立即为现有记录补发 'add' 事件
+
+        @param observer: 回调 observer(event, key, record)，event 为 'reset'/'add'/'remove'/'change'
+        """
+        with self._index_lock:
+            self._observers.append(observer)
+            for key, record in self._records.items():
+                observer('add', key, record)
+
+    def remove_observer(self, observer: Callable):
+        """取消订阅"""
+        with self._index_lock:
+            if observer in self._observers:
+                self._observers.remove(observer)
+
+    @staticmethod
+    def _pop_index(index: dict, value, key: int):
+        bucket = index.get(value)
+        if bucket is not None:
+            bucket.pop(key, None)
+            if not bucket:
+                del index[value]
+
+    # ==================== list 修改操作 ====================
+
+    def append(self, record):
+        record = self._track(record)
+        with self._index_lock:
+            super().append(record)
+            self._add(record)
+
+    def extend(self, records):
+        records = [self._track(record) for record in records]
+        with self._index_lock:
+            super().extend(records)
+            for record in records:
+                self._add(record)
+
+    def __iadd__(self, records):
+        self.extend(records)
+        return self
+
+    def insert(self, index, record):
+        record = self._track(record)
+        with self._index_lock:
+            super().insert(index, record)
+            self._add(record)
+
+    def remove(self, record):
+        """按对象移除记录（与 list.remove 不同，内容相等的其他记录不受影响）"""
+        with self._index_lock:
+            super().__delitem__(self._index_of(record))
+            self._discard(record)
+
+    def pop(self, index=-1):
+        with self._index_lock:
+            record = super().pop(index)
+            self._discard(record)
+            return record
+
+    def clear(self):
+        with self._index_lock:
+            super().clear()
+            self._rebuild()
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [self._track(record) for record in value]
+        else:
+            value = self._track(value)
+        with self._index_lock:
+            super().__setitem__(index, value)
+            self._rebuild()
+
+    def __delitem__(self, index):
+        with self._index_lock:
+            super().__delitem__(index)
+            self._rebuild()
+
+    def sort(self, *args, **kwargs):
+        with self._index_lock:
+            super().sort(*args, **kwargs)
+            self._rebuild()
+
+    def reverse(self):
+        with self._index_lock:
+            super().reverse()
+            self._rebuild()
+
+    def __reduce__(self):
+        # 拷贝/序列化时退化为普通 list
+        return (list, (list(self),))
+
+
+class EmailCollection(IndexedRecordList):
+    """
+    带索引的邮件列表
+
+    提供 get(email_id)、by_status(status)、count_status(status) 三个常数时间的查询，
+    记录内的 id/status 被修改时索引自动更新。
+    """
+
+    def _reset_entries(self):
+        # id(record) -> (邮件ID, 状态, 加入顺序)
+        self._entries: Dict[int, tuple] = {}
+        self._by_id: Dict[str, Dict[int, dict]] = {}
+        self._by_status: Dict[str, Dict[int, dict]] = {}
+
+    def _add_entry(self, key, record, seq):
+        email_id, status = record.get('id'), record.get('status')
+        self._entries[key] = (email_id, status, seq)
+        self._by_id.setdefault(email_id, {})[key] = record
+        self._by_status.setdefault(status, {})[key] = record
+
+    def _remove_entry(self, key):
+        email_id, status, _ = self._entries.pop(key)
+        self._pop_index(self._by_id, email_id, key)
+        self._pop_index(self._by_status, status, key)
+
+    def _refresh_entry(self, key, record):
+        old_id, old_status, seq = self._entries[key]
+        email_id, status = record.get('id'), record.get('status')
+        if email_id == old_id and status == old_status:
+            return False
+        if email_id != old_id:
+            self._pop_index(self._by_id, old_id, key)
+            self._by_id.setdefault(email_id, {})[key] = record
+        if status != old_status:
+            self._pop_index(self._by_status, old_status, key)
+            self._by_status.setdefault(status, {})[key] = record
+        self._entries[key] = (email_id, status, seq)
+        return True
+
+    # ==================== 查询 ====================
+
+    def get(self, email_id) -> Optional[dict]:
+        """
+        按邮件ID查找记录
+
+        @param email_id: 邮件ID
+        @return: 最早进入该ID索引的同ID记录，不存在时返回 None
+        """
+        with self._index_lock:
+            bucket = self._by_id.get(email_id)
+            if not bucket:
+                return None
+            return next(iter(bucket.values()))
+
+    def has_id(self, email_id) -> bool:
+        """缓存中是否存在该ID的邮件"""
+        return self.get(email_id) is not None
+
+    def by_status(self, status: str) -> List[dict]:
+        """
+        按状态筛选记录（按进入该状态的先后顺序，不再额外排序）
+
+        @param status: 邮件状态，如 'pending'、'processed'
+        @return: 记录列表
+        """
+        with self._index_lock:
+            return list(self._by_status.get(status, {}).values())
+
+    def count_status(self, status: str) -> int:
+        """
+        统计某个状态的记录数
+
+        @param status: 邮件状态
+        @return: 记录数
+        """
+        with self._index_lock:
+            return len(self._by_status.get(status, ()))
+
+    def ids(self) -> set:
+        """缓存中所有邮件ID的集合"""
+        with self._index_lock:
+            return set(self._by_id.keys())
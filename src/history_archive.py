@@ -0,0 +1,508 @@
+"""
+历史记录归档
+超过保留期的历史记录从 SQLite 热数据中移出，按月写入 gzip 压缩的 JSON Lines 分段：
+
+    <归档目录>/index.json                      各分段的记录数、日期范围、分类/状态计数
+    <归档目录>/history-YYYY-MM.jsonl.gz        记录（每次归档追加一个 gzip 成员）
+    <归档目录>/history-YYYY-MM.stats.jsonl.gz  每条记录对统计汇总的贡献（邮件ID + 计数键）
+
+查询只在日期范围与分段重叠时才读取分段；完全落在日期范围内的分段直接用索引计数，
+所以启动时间和常驻内存取决于近期的数据量，而不是全部历史。
+归档记录都早于热数据中的记录，分页时先返回热数据，再按月从新到旧返回归档记录。
+"""
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from src.history_index import HistoryCollection, HistoryQuery, make_entry
+from src.stats_rollup import record_contributions
+
+
+INDEX_FILE = "index.json"
+INDEX_VERSION = 1
+
+# 同时保留在内存中的已解压分段数（翻页时避免重复解压同一个月）
+SEGMENT_CACHE_SIZE = 2
+
+# 翻页进入归档后使用的游标前缀，后面是归档内的偏移量
+ARCHIVE_CURSOR_PREFIX = "archive:"
+
+
+def record_day(record: dict) -> str:
+    """记录的归档日期（与排序一致：优先 time，其次 processed_time），无法确定时返回空字符串"""
+    day = str(record.get('time') or record.get('processed_time') or '')[:10].replace('/', '-')
+    return day if len(day) == 10 else ''
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _encode_keys(keys: Iterable[tuple]) -> list:
+    return [[metric, list(bucket) if isinstance(bucket, tuple) else bucket] for metric, bucket in keys]
+
+
+def _decode_keys(keys: list) -> frozenset:
+    return frozenset((metric, tuple(bucket) if isinstance(bucket, list) else bucket) for metric, bucket in keys)
+
+
+class HistoryArchive:
+    """
+    一个用户的历史记录归档
+
+    所有方法都是线程安全的；分段文件只追加，删除部分记录时整体重写该分段。
+    """
+
+    def __init__(self, archive_dir: str):
+        """
+        @param archive_dir: 归档目录（不存在时在第一次归档时创建）
+        """
+        self.archive_dir = archive_dir
+        self._lock = threading.RLock()
+        self._index: Optional[dict] = None
+        self._segments: "OrderedDict[str, list]" = OrderedDict()
+        self._count_cache: Dict[tuple, tuple] = {}
+        self.version = 0
+
+    # ==================== 文件与索引 ====================
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.archive_dir, name)
+
+    @staticmethod
+    def _segment_file(month: str) -> str:
+        return f"history-{month}.jsonl.gz"
+
+    @staticmethod
+    def _stats_file(month: str) -> str:
+        return f"history-{month}.stats.jsonl.gz"
+
+    def _load_index(self) -> dict:
+        if self._index is None:
+            index = {"version": INDEX_VERSION, "segments": {}}
+            path = self._path(INDEX_FILE)
+            if os.path.exists(path):
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        index = json.load(f)
+                except Exception as e:
+                    print(f"⚠️ [历史归档] 读取索引失败，将根据分段重建: {e}")
+                    index = self._rebuild_index()
+            self._index = index
+        return self._index
+
+    def _save_index(self):
+        os.makedirs(self.archive_dir, exist_ok=True)
+        path = self._path(INDEX_FILE)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._index, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self.version += 1
+        self._count_cache.clear()
+
+    def _rebuild_index(self) -> dict:
+        """索引损坏时扫描全部分段重建"""
+        index = {"version": INDEX_VERSION, "segments": {}}
+        if not os.path.isdir(self.archive_dir):
+            return index
+        for name in sorted(os.listdir(self.archive_dir)):
+            if name.startswith("history-") and name.endswith(".jsonl.gz") and ".stats." not in name:
+                month = name[len("history-"):-len(".jsonl.gz")]
+                index["segments"][month] = self._segment_meta(self._read_segment(month))
+        return index
+
+    @staticmethod
+    def _segment_meta(records: List[dict]) -> dict:
+        """根据分段内的记录计算索引信息"""
+        counts: Dict[tuple, int] = {}
+        date_min = date_max = None
+        for seq, record in enumerate(records):
+            _, rec_min, rec_max, category, group, _ = make_entry(record, seq)
+            counts[(category, group)] = counts.get((category, group), 0) + 1
+            if rec_min is not None:
+                date_min = rec_min if date_min is None else min(date_min, rec_min)
+                date_max = rec_max if date_max is None else max(date_max, rec_max)
+        return {
+            "count": len(records),
+            "date_min": date_min,
+            "date_max": date_max,
+            "counts": [[category, group, n] for (category, group), n in counts.items()],
+        }
+
+    @staticmethod
+    def _merge_meta(meta: Optional[dict], added: dict) -> dict:
+        if not meta:
+            return added
+        counts = {(c, g): n for c, g, n in meta["counts"]}
+        for c, g, n in added["counts"]:
+            counts[(c, g)] = counts.get((c, g), 0) + n
+        mins = [d for d in (meta["date_min"], added["date_min"]) if d]
+        maxs = [d for d in (meta["date_max"], added["date_max"]) if d]
+        return {
+            "count": meta["count"] + added["count"],
+            "date_min": min(mins) if mins else None,
+            "date_max": max(maxs) if maxs else None,
+            "counts": [[c, g, n] for (c, g), n in counts.items()],
+        }
+
+    def _read_segment(self, month: str) -> List[dict]:
+        path = self._path(self._segment_file(month))
+        if not os.path.exists(path):
+            return []
+        records = []
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+        return records
+
+    @staticmethod
+    def _append_lines(path: str, lines: Iterable[str]):
+        """以新 gzip 成员的形式追加（多成员 gzip 文件可以被整体顺序读取）"""
+        with open(path, 'ab') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                for line in lines:
+                    gz.write((line + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def _write_lines(path: str, lines: Iterable[str]):
+        """整体重写分段文件（先写临时文件再替换）"""
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as gz:
+            for line in lines:
+                gz.write(line + '\n')
+        os.replace(tmp_path, path)
+
+    def _segment_entries(self, month: str) -> List[tuple]:
+        """
+        读取分段并按时间倒序排列（最近使用的分段缓存在内存中）
+
+        @return: [(索引条目, 记录), ...]
+        """
+        entries = self._segments.get(month)
+        if entries is not None:
+            self._segments.move_to_end(month)
+            return entries
+        records = self._read_segment(month)
+        entries = sorted(((make_entry(r, seq), r) for seq, r in enumerate(records)),
+                         key=lambda item: item[0][0], reverse=True)
+        self._segments[month] = entries
+        while len(self._segments) > SEGMENT_CACHE_SIZE:
+            self._segments.popitem(last=False)
+        return entries
+
+    # ==================== 写入 ====================
+
+    def archive(self, records: List[dict]) -> int:
+        """
+        把记录追加到对应月份的分段中
+
+        @param records: 历史记录（没有日期的记录会被忽略）
+        @return: 写入的记录数
+        """
+        by_month: Dict[str, List[dict]] = {}
+        for record in records:
+            day = record_day(record)
+            if day:
+                by_month.setdefault(day[:7], []).append(dict(record))
+        if not by_month:
+            return 0
+
+        with self._lock:
+            index = self._load_index()
+            os.makedirs(self.archive_dir, exist_ok=True)
+            for month, month_records in by_month.items():
+                self._append_lines(self._path(self._segment_file(month)),
+                                   (_dumps(r) for r in month_records))
+                self._append_lines(self._path(self._stats_file(month)),
+                                   (_dumps(self._contribution_line(r)) for r in month_records))
+                index["segments"][month] = self._merge_meta(
+                    index["segments"].get(month), self._segment_meta(month_records))
+                self._segments.pop(month, None)
+            self._save_index()
+        return sum(len(v) for v in by_month.values())
+
+    @staticmethod
+    def _contribution_line(record: dict) -> list:
+        email_id, keys = record_contributions(record, 'history')
+        return [email_id, _encode_keys(keys)]
+
+    def _rewrite_segment(self, month: str, records: List[dict]):
+        index = self._load_index()
+        segment_path = self._path(self._segment_file(month))
+        stats_path = self._path(self._stats_file(month))
+        if records:
+            self._write_lines(segment_path, (_dumps(r) for r in records))
+            self._write_lines(stats_path, (_dumps(self._contribution_line(r)) for r in records))
+            index["segments"][month] = self._segment_meta(records)
+        else:
+            for path in (segment_path, stats_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            index["segments"].pop(month, None)
+        self._segments.pop(month, None)
+
+    def delete_before(self, before_date: str) -> int:
+        """
+        删除日期早于 before_date 的归档记录（与 /api/history/clear 的规则一致）
+
+        @param before_date: 'YYYY-MM-DD'
+        @return: 删除的记录数
+        """
+        deleted = 0
+        with self._lock:
+            index = self._load_index()
+            for month in sorted(index["segments"]):
+                meta = index["segments"][month]
+                if month > before_date[:7]:
+                    continue
+                if meta["date_max"] and meta["date_max"] < before_date:
+                    deleted += meta["count"]
+                    self._rewrite_segment(month, [])
+                    continue
+                records = self._read_segment(month)
+                kept = [r for r in records if not (record_day(r) and record_day(r) < before_date)]
+                if len(kept) != len(records):
+                    deleted += len(records) - len(kept)
+                    self._rewrite_segment(month, kept)
+            if deleted:
+                self._save_index()
+        return deleted
+
+    def clear(self) -> int:
+        """
+        删除全部归档记录
+
+        @return: 删除的记录数
+        """
+        with self._lock:
+            index = self._load_index()
+            deleted = sum(meta["count"] for meta in index["segments"].values())
+            for month in list(index["segments"]):
+                self._rewrite_segment(month, [])
+            self._save_index()
+        return deleted
+
+    # ==================== 查询 ====================
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(meta["count"] for meta in self._load_index()["segments"].values())
+
+    def _overlapping(self, query: HistoryQuery) -> List[Tuple[str, dict, bool]]:
+        """
+        与查询日期范围重叠的分段（按月从新到旧）
+
+        @return: [(月份, 分段索引, 是否整个分段都在日期范围内), ...]
+        """
+        result = []
+        for month in sorted(self._load_index()["segments"], reverse=True):
+            meta = self._load_index()["segments"][month]
+            if not meta["count"]:
+                continue
+            if query.start_date and (meta["date_max"] is None or meta["date_max"] < query.start_date):
+                continue
+            if query.end_date and (meta["date_min"] is None or meta["date_min"] > query.end_date):
+                continue
+            contained = ((not query.start_date or (meta["date_min"] or '') >= query.start_date)
+                         and (not query.end_date or (meta["date_max"] or '') <= query.end_date))
+            result.append((month, meta, contained))
+        return result
+
+    @staticmethod
+    def _index_count(meta: dict, query: HistoryQuery) -> int:
+        return sum(n for category, group, n in meta["counts"]
+                   if (not query.category or category == query.category)
+                   and (not query.group or group == query.group))
+
+    def _segment_matches(self, month: str, query: HistoryQuery) -> List[dict]:
+        entries = self._segment_entries(month)
+        if query.is_empty:
+            return [record for _, record in entries]
+        return [record for entry, record in entries if query.matches(entry)]
+
+    def count(self, query: HistoryQuery) -> int:
+        """
+        统计满足条件的归档记录数（只解压与日期范围部分重叠的分段）
+
+        @param query: 筛选条件
+        @return: 记录数
+        """
+        with self._lock:
+            cached = self._count_cache.get(query.cache_key)
+            if cached is not None and cached[0] == self.version:
+                return cached[1]
+            total = 0
+            for month, meta, contained in self._overlapping(query):
+                if contained:
+                    total += self._index_count(meta, query)
+                else:
+                    total += len(self._segment_matches(month, query))
+            if len(self._count_cache) > 64:
+                self._count_cache.clear()
+            self._count_cache[query.cache_key] = (self.version, total)
+            return total
+
+    def query(self, query: HistoryQuery, limit: int = 10, offset: int = 0) -> Tuple[List[dict], bool]:
+        """
+        查询一页归档记录（按时间倒序）
+
+        @param query: 筛选条件
+        @param limit: 每页数量
+        @param offset: 归档内的偏移量
+        @return: (记录列表, 是否还有更多记录)
+        """
+        records: List[dict] = []
+        with self._lock:
+            for month, meta, contained in self._overlapping(query):
+                if contained:
+                    # 整个分段都会被跳过时不需要解压
+                    n = self._index_count(meta, query)
+                    if not n:
+                        continue
+                    if len(records) >= limit:
+                        return records, True
+                    if offset >= n:
+                        offset -= n
+                        continue
+                matched = self._segment_matches(month, query)
+                if not matched:
+                    continue
+                if len(records) >= limit:
+                    return records, True
+                if offset >= len(matched):
+                    offset -= len(matched)
+                    continue
+                start, offset = offset, 0
+                page = matched[start:start + limit - len(records)]
+                records.extend(page)
+                if start + len(page) < len(matched):
+                    return records, True
+        return records, False
+
+    def iter_query(self, query: HistoryQuery) -> Iterator[dict]:
+        """
+        按时间倒序遍历满足条件的归档记录（每次只解压一个分段，用于导出）
+
+        @param query: 筛选条件
+        """
+        with self._lock:
+            months = [month for month, _, _ in self._overlapping(query)]
+        for month in months:
+            with self._lock:
+                matched = self._segment_matches(month, query)
+            yield from matched
+
+    def contributions(self) -> Iterator[Tuple[str, frozenset]]:
+        """
+        读取全部归档记录对统计汇总的贡献（不读取记录本身）
+
+        @return: (邮件ID, 计数键集合) 的迭代器
+        """
+        with self._lock:
+            months = list(self._load_index()["segments"])
+        for month in months:
+            path = self._path(self._stats_file(month))
+            if not os.path.exists(path):
+                continue
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        email_id, keys = json.loads(line)
+                        yield email_id, _decode_keys(keys)
+
+
+# ==================== 分层查询 ====================
+
+def encode_archive_cursor(offset: int) -> str:
+    """归档内偏移量 -> 游标字符串"""
+    return f"{ARCHIVE_CURSOR_PREFIX}{offset}"
+
+
+def decode_archive_cursor(cursor: Optional[str]) -> Optional[int]:
+    """游标字符串 -> 归档内偏移量，不是归档游标时返回 None"""
+    if not cursor or not cursor.startswith(ARCHIVE_CURSOR_PREFIX):
+        return None
+    try:
+        return max(0, int(cursor[len(ARCHIVE_CURSOR_PREFIX):]))
+    except ValueError:
+        return None
+
+
+def query_tiered(hot: HistoryCollection, archive: Optional[HistoryArchive], query: HistoryQuery,
+                 limit: int = 10, offset: int = 0,
+                 cursor: Optional[str] = None) -> Tuple[List[dict], int, Optional[str]]:
+    """
+    在热数据和归档上执行一次分页查询（先热数据，再归档）
+
+    @param hot: 热数据（SystemState.history）
+    @param archive: 归档，没有归档时为 None
+    @param query: 筛选条件
+    @param limit: 每页数量
+    @param offset: 跳过的记录数（页码分页时使用）
+    @param cursor: 上一页返回的游标（热数据游标或归档游标）
+    @return: (记录列表, 总数, 下一页游标)
+    """
+    hot_total = hot.count(query)
+    archive_total = archive.count(query) if archive is not None else 0
+    total = hot_total + archive_total
+
+    archive_offset = decode_archive_cursor(cursor)
+    if archive_offset is None:
+        records, next_cursor = hot.query(query, limit=limit, offset=offset, cursor=cursor)
+        if next_cursor is not None or not archive_total:
+            return records, total, next_cursor
+        # 热数据已经取完，剩余位置由归档补足
+        archive_offset = 0 if cursor else max(0, offset - hot_total)
+    else:
+        records = []
+
+    if archive_offset >= archive_total:
+        return records, total, None
+    remaining = max(0, limit - len(records))
+    if remaining == 0:
+        return records, total, encode_archive_cursor(archive_offset)
+    archived, has_more = archive.query(query, limit=remaining, offset=archive_offset)
+    records = records + archived
+    next_cursor = encode_archive_cursor(archive_offset + len(archived)) if has_more else None
+    return records, total, next_cursor
+
+
+def iter_tiered(hot: HistoryCollection, archive: Optional[HistoryArchive],
+                query: HistoryQuery) -> Iterator[dict]:
+    """按时间倒序遍历热数据和归档中满足条件的全部记录（用于导出）"""
+    yield from hot.iter_query(query)
+    if archive is not None:
+        yield from archive.iter_query(query)
+
+
+# ==================== 归档对象缓存 ====================
+
+_archives: Dict[str, HistoryArchive] = {}
+_archives_lock = threading.Lock()
+
+
+def get_history_archive(archive_dir: str) -> HistoryArchive:
+    """
+    获取（或创建）指定目录的归档对象
+
+    @param archive_dir: 归档目录
+    @return: HistoryArchive 实例
+    """
+    key = os.path.abspath(archive_dir)
+    with _archives_lock:
+        archive = _archives.get(key)
+        if archive is None:
+            archive = HistoryArchive(archive_dir)
+            _archives[key] = archive
+        return archive
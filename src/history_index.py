@@ -0,0 +1,352 @@
+"""
+历史记录查询引擎
+SystemState.history 使用的列表类型：在保持原列表行为的同时，
+预先解析每条记录的排序时间，并维护日期、分类、状态索引，
+支持基于游标（keyset）的分页，翻到第 N 页不需要先生成前 N-1 页。
+"""
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from src.email_collection import IndexedRecordList
+
+
+# 前端状态筛选值 -> 记录状态分组
+STATUS_GROUPS = {
+    'success': 'success',
+    'processed': 'success',
+    'sent': 'success',
+    'failed': 'failed',
+    'skipped': 'skipped',
+}
+
+# 候选集合小于全部记录的该比例时，先筛选再排序；否则沿时间顺序扫描
+CANDIDATE_SORT_RATIO = 0.25
+
+
+def status_group(status) -> str:
+    """记录状态 -> 筛选分组（success/failed/skipped/pending）"""
+    return STATUS_GROUPS.get(status, 'pending')
+
+
+def parse_record_time(value) -> float:
+    """
+    解析记录时间为时间戳（用于排序）
+
+    @param value: 时间字符串，如 '2024-01-01 12:00:00' 或 ISO 格式
+    @return: 时间戳，无法解析时返回 0
+    """
+    if not value:
+        return 0.0
+    text = str(value).strip().replace('/', '-')
+    for candidate in (text, text[:19], text[:10]):
+        try:
+            return datetime.fromisoformat(candidate).timestamp()
+        except (ValueError, OverflowError, OSError):
+            continue
+    return 0.0
+
+
+def encode_cursor(sort_key: Tuple[float, int]) -> str:
+    """排序键 -> 游标字符串"""
+    return f"{sort_key[0]!r}:{sort_key[1]}"
+
+
+def decode_cursor(cursor: str) -> Optional[Tuple[float, int]]:
+    """游标字符串 -> 排序键，格式错误时返回 None"""
+    try:
+        ts, seq = cursor.rsplit(':', 1)
+        return (float(ts), int(seq))
+    except (ValueError, AttributeError):
+        return None
+
+
+def _raw_fields(record: dict) -> tuple:
+    return (record.get('time'), record.get('processed_time'), record.get('category'), record.get('status'))
+
+
+def _lookup_keys(record: dict) -> tuple:
+    """按邮件查找历史记录用的键：(邮件ID, (主题, 发件人))"""
+    return (record.get('id'), (record.get('subject'), record.get('sender')))
+
+
+def make_entry(record: dict, seq: int) -> tuple:
+    """
+    计算一条记录的索引条目（HistoryQuery.matches 使用）
+
+    @param record: 历史记录
+    @param seq: 加入顺序（同一时间的记录按它排序）
+    @return: (排序键, 最早日期, 最晚日期, 分类, 状态分组, 原始字段)
+    """
+    raw = _raw_fields(record)
+    time_value, processed_time, category, status = raw
+    # 与原接口一致：优先使用 time，其次 processed_time
+    sort_key = (parse_record_time(time_value or processed_time), seq)
+    dates = [str(v)[:10] for v in (time_value, processed_time) if v]
+    date_min = min(dates) if dates else None
+    date_max = max(dates) if dates else None
+    return (sort_key, date_min, date_max, category, status_group(status), raw)
+
+
+class HistoryQuery:
+    """一次历史记录查询的筛选条件（与 /api/history 的参数一致）"""
+
+    def __init__(self, start_date: str = None, end_date: str = None,
+                 category: str = None, status: str = None):
+        self.start_date = start_date or None
+        self.end_date = end_date or None
+        self.category = category or None
+        # 未知的状态值不做筛选（与原接口行为一致）
+        self.group = status if status in ('success', 'failed', 'skipped', 'pending') else None
+
+    @property
+    def cache_key(self) -> tuple:
+        return (self.start_date, self.end_date, self.category, self.group)
+
+    @property
+    def is_empty(self) -> bool:
+        return not any(self.cache_key)
+
+    def matches(self, entry: tuple) -> bool:
+        """判断索引条目是否满足条件"""
+        _, date_min, date_max, category, group, _ = entry
+        if self.category and category != self.category:
+            return False
+        if self.group and group != self.group:
+            return False
+        # 日期：time 或 processed_time 任一满足即可（只比较日期部分）
+        if self.start_date and (date_max is None or date_max < self.start_date):
+            return False
+        if self.end_date and (date_min is None or date_min > self.end_date):
+            return False
+        return True
+
+
+class HistoryCollection(IndexedRecordList):
+    """
+    带查询索引的历史记录列表（新记录在前）
+
+    每条记录预先计算：排序键 (时间戳, 加入序号)、日期范围、分类和状态分组。
+    - _sorted: 按排序键升序的列表，倒序遍历即为最新在前
+    - _by_category / _by_group: 分类、状态分组 -> 记录
+    - _by_date_max / _by_date_min: 按日期排序的列表，用于日期范围筛选
+    - _by_email_id / _by_subject_sender: 邮件ID、(主题, 发件人) -> 记录，用于回复流程按邮件查找
+    """
+
+    def _initial_records(self):
+        # 列表是新记录在前，从最旧的开始编号，保证同一时间的记录仍按列表顺序排列
+        return list.__reversed__(self)
+
+    def _rebuild(self):
+        # 批量建立索引时先追加、最后统一排序，避免逐条 insort
+        self._bulk = True
+        try:
+            super()._rebuild()
+        finally:
+            self._bulk = False
+        self._sorted.sort()
+        self._by_date_max.sort()
+        self._by_date_min.sort()
+
+    def _reset_entries(self):
+        # id(record) -> (排序键, 最早日期, 最晚日期, 分类, 状态分组, 原始字段)
+        self._entries: Dict[int, tuple] = {}
+        self._sorted: List[tuple] = []
+        self._key_by_sort: Dict[tuple, int] = {}
+        self._by_category: Dict[str, Dict[int, dict]] = {}
+        self._by_group: Dict[str, Dict[int, dict]] = {}
+        self._by_date_max: List[tuple] = []
+        self._by_date_min: List[tuple] = []
+        self._total_cache: Dict[tuple, tuple] = {}
+        # id(record) -> _lookup_keys(record)
+        self._lookup: Dict[int, tuple] = {}
+        self._by_email_id: Dict[str, Dict[int, dict]] = {}
+        self._by_subject_sender: Dict[tuple, Dict[int, dict]] = {}
+
+    def _add_entry(self, key, record, seq):
+        entry = make_entry(record, seq)
+        self._entries[key] = entry
+        sort_key, date_min, date_max, category, group, _ = entry
+        add = list.append if getattr(self, '_bulk', False) else insort
+        add(self._sorted, sort_key)
+        self._key_by_sort[sort_key] = key
+        self._by_category.setdefault(category, {})[key] = record
+        self._by_group.setdefault(group, {})[key] = record
+        if date_max is not None:
+            add(self._by_date_max, (date_max, sort_key))
+            add(self._by_date_min, (date_min, sort_key))
+        email_id, subject_sender = self._lookup[key] = _lookup_keys(record)
+        self._by_email_id.setdefault(email_id, {})[key] = record
+        self._by_subject_sender.setdefault(subject_sender, {})[key] = record
+
+    def _remove_entry(self, key):
+        sort_key, date_min, date_max, category, group, _ = self._entries.pop(key)
+        self._remove_sorted(self._sorted, sort_key)
+        self._key_by_sort.pop(sort_key, None)
+        self._pop_index(self._by_category, category, key)
+        self._pop_index(self._by_group, group, key)
+        if date_max is not None:
+            self._remove_sorted(self._by_date_max, (date_max, sort_key))
+            self._remove_sorted(self._by_date_min, (date_min, sort_key))
+        email_id, subject_sender = self._lookup.pop(key)
+        self._pop_index(self._by_email_id, email_id, key)
+        self._pop_index(self._by_subject_sender, subject_sender, key)
+
+    def _refresh_entry(self, key, record):
+        entry = self._entries[key]
+        if _raw_fields(record) == entry[5] and _lookup_keys(record) == self._lookup[key]:
+            return False
+        seq = entry[0][1]
+        self._remove_entry(key)
+        self._add_entry(key, record, seq)
+        return True
+
+    @staticmethod
+    def _remove_sorted(items: list, value):
+        i = bisect_left(items, value)
+        if i < len(items) and items[i] == value:
+            del items[i]
+
+    # ==================== 查询 ====================
+
+    def find_email(self, email_id, subject=None, sender=None) -> Optional[dict]:
+        """
+        查找邮件对应的历史记录：邮件ID相同，或提供了主题和发件人且两者都相同
+
+        @param email_id: 邮件ID
+        @param subject: 邮件主题（None 表示只按ID查找）
+        @param sender: 发件人
+        @return: 满足条件的最新加入的记录（即列表中最靠前的），不存在时返回 None
+        """
+        with self._index_lock:
+            found = dict(self._by_email_id.get(email_id, {}))
+            if subject is not None:
+                found.update(self._by_subject_sender.get((subject, sender), {}))
+            if not found:
+                return None
+            return self._records[max(found, key=lambda k: self._entries[k][0][1])]
+
+    def records_before(self, timestamp: float) -> List[dict]:
+        """
+        取出排序时间早于 timestamp 的记录（用于归档；没有时间的记录不返回）
+
+        @param timestamp: 时间戳
+        @return: 记录列表（从旧到新）
+        """
+        with self._index_lock:
+            end = bisect_left(self._sorted, (timestamp,))
+            return [self._records[self._key_by_sort[sk]] for sk in self._sorted[:end] if sk[0] > 0]
+
+    def _candidates(self, query: HistoryQuery) -> Optional[List[tuple]]:
+        """
+        用索引找出最小的候选集合（排序键列表），没有筛选条件时返回 None
+        """
+        options = []
+        if query.category:
+            bucket = self._by_category.get(query.category, {})
+            options.append((len(bucket), lambda b=bucket: [self._entries[k][0] for k in b]))
+        if query.group:
+            bucket = self._by_group.get(query.group, {})
+            options.append((len(bucket), lambda b=bucket: [self._entries[k][0] for k in b]))
+        if query.start_date:
+            i = bisect_left(self._by_date_max, (query.start_date,))
+            options.append((len(self._by_date_max) - i,
+                            lambda i=i: [sk for _, sk in self._by_date_max[i:]]))
+        if query.end_date:
+            # end_date 之后的任意时刻都大于 (end_date,)，用一个更大的哨兵截断
+            j = bisect_right(self._by_date_min, (query.end_date, (float('inf'), 0)))
+            options.append((j, lambda j=j: [sk for _, sk in self._by_date_min[:j]]))
+        if not options:
+            return None
+        _, build = min(options, key=lambda o: o[0])
+        return build()
+
+    def _iter_sorted(self, query: HistoryQuery, after: Optional[tuple]) -> Iterator[tuple]:
+        """按时间倒序产生满足条件的排序键（after 为游标，只返回比它更旧的记录）"""
+        candidates = self._candidates(query)
+        if candidates is not None and len(candidates) <= len(self._sorted) * CANDIDATE_SORT_RATIO:
+            # 候选集合较小：先筛选再排序
+            keys = sorted(sk for sk in candidates
+                          if (after is None or sk < after)
+                          and query.matches(self._entries[self._key_by_sort[sk]]))
+            yield from reversed(keys)
+            return
+        # 候选集合较大：沿时间顺序倒序扫描，凑够一页即停止
+        end = bisect_left(self._sorted, after) if after is not None else len(self._sorted)
+        check = not query.is_empty
+        for i in range(end - 1, -1, -1):
+            sk = self._sorted[i]
+            if not check or query.matches(self._entries[self._key_by_sort[sk]]):
+                yield sk
+
+    def count(self, query: HistoryQuery) -> int:
+        """
+        统计满足条件的记录数（结果按数据版本缓存，数据未变化时直接返回）
+
+        @param query: 筛选条件
+        @return: 记录数
+        """
+        with self._index_lock:
+            cached = self._total_cache.get(query.cache_key)
+            if cached is not None and cached[0] == self.version:
+                return cached[1]
+            if query.is_empty:
+                total = len(self._sorted)
+            else:
+                candidates = self._candidates(query)
+                total = sum(1 for sk in candidates
+                            if query.matches(self._entries[self._key_by_sort[sk]]))
+            if len(self._total_cache) > 64:
+                self._total_cache.clear()
+            self._total_cache[query.cache_key] = (self.version, total)
+            return total
+
+    def query(self, query: HistoryQuery, limit: int = 10, offset: int = 0,
+              cursor: Optional[str] = None) -> Tuple[List[dict], Optional[str]]:
+        """
+        查询一页记录（按时间倒序）
+
+        @param query: 筛选条件
+        @param limit: 每页数量
+        @param offset: 跳过的记录数（页码分页时使用；提供 cursor 时应为 0）
+        @param cursor: 上一页返回的游标，只返回比它更旧的记录
+        @return: (记录列表, 下一页游标；没有更多记录时为 None)
+        """
+        after = decode_cursor(cursor) if cursor else None
+        limit = max(0, int(limit))
+        offset = max(0, int(offset))
+        with self._index_lock:
+            if query.is_empty and after is None:
+                # 无筛选条件：直接按位置定位页首
+                end = max(0, len(self._sorted) - offset)
+                keys = [self._sorted[i] for i in range(end - 1, max(-1, end - 1 - limit), -1)]
+                has_more = end - len(keys) > 0
+            else:
+                keys = []
+                has_more = False
+                skipped = 0
+                for sk in self._iter_sorted(query, after):
+                    if skipped < offset:
+                        skipped += 1
+                        continue
+                    if len(keys) >= limit:
+                        has_more = True
+                        break
+                    keys.append(sk)
+            records = [self._records[self._key_by_sort[sk]] for sk in keys]
+        next_cursor = encode_cursor(keys[-1]) if keys and has_more else None
+        return records, next_cursor
+
+    def iter_query(self, query: HistoryQuery, batch_size: int = 500) -> Iterator[dict]:
+        """
+        按时间倒序逐批遍历全部满足条件的记录（用于导出）
+
+        @param query: 筛选条件
+        @param batch_size: 每批数量（每批之间释放锁）
+        """
+        cursor = None
+        while True:
+            records, cursor = self.query(query, limit=batch_size, cursor=cursor)
+            yield from records
+            if not cursor:
+                break
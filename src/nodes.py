@@ -3,6 +3,7 @@ from .agents import Agents
 from .tools.QQEmailTools import QQEmailToolsClass
 from .state import GraphState, Email, EmailUrgencyLevel
 from .tools.EmailUrgencyDetector import urgency_detector
+from .tools.EmailBodyCleaner import email_body_cleaner
 
 
 class Nodes:
@@ -38,6 +39,13 @@ class Nodes:
         )
         self.email_tools = QQEmailToolsClass(email_address=email_address, auth_code=auth_code)
 
+    def abort(self):
+        """
+        中断本实例进行中的模型请求和邮箱操作（终止处理时调用，实例之后不再使用）
+        """
+        self.agents.http_client.abort()
+        self.email_tools.abort()
+
     def load_new_emails(self, state: GraphState) -> GraphState:
         """从QQ邮箱加载新邮件并更新状态"""
         print(Fore.YELLOW + "正在加载新邮件...\n" + Style.RESET_ALL)
@@ -341,6 +349,16 @@ class Nodes:
             f'# **INFORMATION:**\n{state["retrieved_documents"]}' # Empty for feedback or complaint
         )
         
+        # 引用的历史邮件只截取开头作为上下文（正文中已去除）
+        quoted_context = email_body_cleaner.summarize_quoted(getattr(state["current_email"], "quoted_context", ""))
+        if quoted_context:
+            inputs += f'\n\n# **PREVIOUS CONVERSATION (for context only):**\n{quoted_context}'
+        
+        # 同一会话中更早的未回复邮件，本次回复需要一并答复
+        thread_context = getattr(state["current_email"], "thread_context", "")
+        if thread_context:
+            inputs += f'\n\n# **EARLIER UNANSWERED MESSAGES IN THIS THREAD (answer them too):**\n{thread_context}'
+        
         # Get messages history for current email
         writer_messages = state.get('writer_messages', [])
         
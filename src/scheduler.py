@@ -0,0 +1,338 @@
+"""
+定时任务调度器
+所有用户的周期任务（邮箱检查、自动发送、历史归档、摘要重试等）共用一个计时线程：
+任务按下次执行时间放在一个小顶堆中，到期后交给共享的线程池执行，
+线程数量与用户数量无关；注册、取消和重新调度都是 O(log n)。
+"""
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, Optional, Set, Tuple, Union
+
+
+# 过期堆条目超过有效任务数的该倍数时整理一次堆
+STALE_COMPACT_RATIO = 2
+
+
+class _Job:
+    """一个周期任务的状态（只在调度器锁内修改）"""
+
+    __slots__ = ('key', 'func', 'interval', 'jitter', 'timeout', 'on_timeout', 'generation',
+                 'next_run', 'requested', 'running', 'overdue', 'started', 'runs')
+
+    def __init__(self, key, func, interval, jitter, timeout, on_timeout=None):
+        self.key = key
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        self.timeout = timeout
+        self.on_timeout = on_timeout
+        # 每次调度取一个新的代数；堆中代数不一致的条目视为已失效
+        self.generation = 0
+        self.next_run = 0.0
+        # 执行期间被 reschedule 时请求的下次执行时间
+        self.requested: Optional[float] = None
+        self.running = False
+        # 本次执行已超过 timeout（超时检查条目已出堆）
+        self.overdue = False
+        self.started = 0.0
+        self.runs = 0
+
+
+class TimerScheduler:
+    """
+    基于小顶堆的周期任务调度器
+
+    - 任务以 (所属者, 类型) 为 key，同一个 key 只保留一个任务，重复注册即替换
+    - 一次执行结束后才计算下一次执行时间（固定间隔 + 随机抖动），同一任务不会并发执行，
+      替换后的任务到期时若旧的调用仍在执行，也会等旧调用结束后再执行
+    - 取消和重新调度不在堆中查找旧条目，只增加任务代数，旧条目出堆时丢弃
+    - 设置了 timeout 的任务执行超时后调用 on_timeout（用于中断卡住的 I/O、释放共享线程），
+      本次执行结束后才安排下一轮，避免同一任务重叠执行
+    - 任务函数返回 False 时不再继续调度
+    """
+
+    def __init__(self, workers: int = 8, name: str = "scheduler"):
+        """
+        @param workers: 共享线程池大小（同时执行的任务数上限）
+        @param name: 线程名前缀
+        """
+        self.workers = max(1, workers)
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        self._cond = threading.Condition()
+        # (执行时间, 代数, key)；代数全局递增，同时保证同一时间的条目按调度先后出堆
+        self._heap: list = []
+        self._seq = itertools.count()
+        self._jobs: Dict[Tuple[Hashable, str], _Job] = {}
+        self._owners: Dict[Hashable, Set[str]] = {}
+        self._stale = 0
+        # 正在线程池中执行的任务（key -> 任务），任务被替换或取消后旧的调用仍在其中直到结束
+        self._inflight: Dict[Tuple[Hashable, str], _Job] = {}
+        # 到期时同 key 的旧调用仍在执行、等它结束后再执行的任务 key
+        self._waiting: Set[Tuple[Hashable, str]] = set()
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = False
+        self.counters = {'dispatched': 0, 'failed': 0, 'timeouts': 0}
+
+    # ==================== 注册与取消 ====================
+
+    def schedule(self, owner: Hashable, kind: str, func: Callable,
+                 interval: Union[float, Callable[[], float]], jitter: float = 0.1,
+                 delay: Optional[float] = None, timeout: Optional[float] = None,
+                 on_timeout: Optional[Callable] = None):
+        """
+        注册（或替换）一个周期任务
+
+        @param owner: 任务所属者（通常是用户名）
+        @param kind: 任务类型，如 'mail_check'、'auto_send'
+        @param func: 无参数的任务函数，在共享线程池中执行
+        @param interval: 执行间隔（秒），也可以是每次调度时读取间隔的函数
+        @param jitter: 抖动比例，下次执行时间额外推迟 [0, interval*jitter) 秒，避免大量任务同时到期
+        @param delay: 首次执行前的等待秒数，None 表示等待一个间隔
+        @param timeout: 单次执行的超时时间（秒），None 表示不检查
+        @param on_timeout: 执行超时时调用的无参数函数（在独立线程中调用），应让本次执行尽快结束
+        """
+        key = (owner, kind)
+        with self._cond:
+            if self._stopped:
+                return
+            old = self._jobs.get(key)
+            if old is not None:
+                self._stale += 1
+            job = _Job(key, func, interval, jitter, timeout, on_timeout)
+            self._jobs[key] = job
+            self._owners.setdefault(owner, set()).add(kind)
+            self._push(job, self._next_delay(job) if delay is None else delay)
+        self._ensure_thread()
+
+    def ensure(self, owner: Hashable, kind: str, func: Callable,
+               interval: Union[float, Callable[[], float]], **kwargs) -> bool:
+        """
+        任务不存在时才注册（参数同 schedule）
+
+        @return: 是否新注册了任务
+        """
+        with self._cond:
+            if (owner, kind) in self._jobs:
+                return False
+        self.schedule(owner, kind, func, interval, **kwargs)
+        return True
+
+    def reschedule(self, owner: Hashable, kind: str, delay: float = 0) -> bool:
+        """
+        把已注册任务的下一次执行提前或推后到 delay 秒之后（正在执行时在本次结束后生效）
+
+        @return: 任务是否存在
+        """
+        with self._cond:
+            job = self._jobs.get((owner, kind))
+            if job is None:
+                return False
+            if job.running:
+                job.requested = time.monotonic() + max(0.0, delay)
+                return True
+            self._stale += 1
+            self._push(job, delay)
+            return True
+
+    def cancel(self, owner: Hashable, kind: str) -> bool:
+        """
+        取消一个任务（正在执行的调用会自然结束，之后不再调度）
+
+        @return: 任务是否存在
+        """
+        with self._cond:
+            return self._remove((owner, kind))
+
+    def cancel_owner(self, owner: Hashable) -> int:
+        """
+        取消某个所属者的全部任务
+
+        @return: 取消的任务数
+        """
+        with self._cond:
+            kinds = list(self._owners.get(owner, ()))
+            return sum(1 for kind in kinds if self._remove((owner, kind)))
+
+    def is_scheduled(self, owner: Hashable, kind: str) -> bool:
+        with self._cond:
+            return (owner, kind) in self._jobs
+
+    def _remove(self, key) -> bool:
+        job = self._jobs.pop(key, None)
+        if job is None:
+            return False
+        self._waiting.discard(key)
+        job.generation = next(self._seq)
+        self._stale += 1
+        kinds = self._owners.get(key[0])
+        if kinds is not None:
+            kinds.discard(key[1])
+            if not kinds:
+                del self._owners[key[0]]
+        self._maybe_compact()
+        self._cond.notify()
+        return True
+
+    # ==================== 堆维护 ====================
+
+    @staticmethod
+    def _interval(job: _Job) -> float:
+        try:
+            value = job.interval() if callable(job.interval) else job.interval
+            return max(1.0, float(value))
+        except Exception as e:
+            print(f"⚠️ [调度器] 读取任务 {job.key} 的执行间隔失败: {e}")
+            return 60.0
+
+    def _next_delay(self, job: _Job) -> float:
+        interval = self._interval(job)
+        return interval + random.uniform(0, interval * job.jitter) if job.jitter > 0 else interval
+
+    def _push(self, job: _Job, delay: float):
+        """调用方持有锁"""
+        job.generation = next(self._seq)
+        job.next_run = time.monotonic() + max(0.0, delay)
+        heapq.heappush(self._heap, (job.next_run, job.generation, job.key))
+        self._maybe_compact()
+        self._cond.notify()
+
+    def _maybe_compact(self):
+        """丢弃已失效的堆条目（失效条目过多时）"""
+        if self._stale <= STALE_COMPACT_RATIO * len(self._jobs) + 64:
+            return
+        self._heap = [entry for entry in self._heap
+                      if entry[2] in self._jobs and self._jobs[entry[2]].generation == entry[1]]
+        heapq.heapify(self._heap)
+        self._stale = 0
+
+    # ==================== 执行 ====================
+
+    def _ensure_thread(self):
+        with self._cond:
+            if self._thread is not None or self._stopped:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True, name=f"{self.name}_timer")
+            self._thread.start()
+        print(f"✅ [调度器] 定时调度已启动，共享线程数: {self.workers}")
+
+    def _run(self):
+        """计时线程：等待堆顶任务到期，交给线程池执行"""
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    when, generation, key = self._heap[0]
+                    job = self._jobs.get(key)
+                    if job is None or job.generation != generation:
+                        heapq.heappop(self._heap)
+                        self._stale = max(0, self._stale - 1)
+                        continue
+                    wait = when - time.monotonic()
+                    if wait > 0:
+                        self._cond.wait(wait)
+                        continue
+                    heapq.heappop(self._heap)
+                    break
+                if job.running:
+                    # 超时检查条目到期：本次执行仍未结束，等它结束后再安排下一轮（不重叠执行）
+                    self.counters['timeouts'] += 1
+                    job.overdue = True
+                    print(f"⚠️ [调度器] 任务 {key} 执行超过 {job.timeout} 秒，本次结束后再安排下一轮")
+                    if job.on_timeout is not None:
+                        # 不在锁内、也不占用线程池（线程池可能已被卡住的任务占满）
+                        threading.Thread(target=self._call_timeout_handler, args=(job,),
+                                         name=f"{self.name}-timeout", daemon=True).start()
+                    continue
+                if key in self._inflight:
+                    # 被替换或取消前的旧调用仍在执行，等它结束后再执行
+                    self._waiting.add(key)
+                    continue
+                job.running = True
+                job.started = time.monotonic()
+                self._inflight[key] = job
+                if job.timeout:
+                    self._push(job, job.timeout)
+                run_generation = job.generation
+                self.counters['dispatched'] += 1
+                try:
+                    self._executor.submit(self._execute, job, run_generation)
+                except RuntimeError:
+                    # 线程池已关闭
+                    return
+
+    @staticmethod
+    def _call_timeout_handler(job: _Job):
+        try:
+            job.on_timeout()
+        except Exception as e:
+            print(f"⚠️ [调度器] 任务 {job.key} 的超时处理失败: {e}")
+
+    def _execute(self, job: _Job, run_generation: int):
+        result = None
+        try:
+            result = job.func()
+        except Exception as e:
+            self.counters['failed'] += 1
+            print(f"❌ [调度器] 任务 {job.key} 执行失败: {e}")
+            import traceback
+            traceback.print_exc()
+        with self._cond:
+            if self._inflight.get(job.key) is job:
+                del self._inflight[job.key]
+            if self._jobs.get(job.key) is not job or job.generation != run_generation:
+                # 已取消或被替换：替换后的任务在等本次结束时立即执行
+                current = self._jobs.get(job.key)
+                if current is not None and job.key in self._waiting:
+                    self._waiting.discard(job.key)
+                    self._push(current, 0)
+                return
+            job.running = False
+            job.runs += 1
+            if job.timeout and not job.overdue:
+                # 尚未到期的超时检查条目已失效
+                self._stale += 1
+            job.overdue = False
+            if result is False:
+                self._remove(job.key)
+                return
+            if job.requested is not None:
+                # 执行期间被 reschedule
+                delay = job.requested - time.monotonic()
+                job.requested = None
+            else:
+                delay = self._next_delay(job)
+            self._push(job, delay)
+
+    # ==================== 状态与关闭 ====================
+
+    def get_stats(self) -> dict:
+        """调度器状态（任务数、堆大小、计数器）"""
+        with self._cond:
+            running = sum(1 for job in self._jobs.values() if job.running)
+            return {
+                'jobs': len(self._jobs),
+                'running': running,
+                'heap_size': len(self._heap),
+                'workers': self.workers,
+                **self.counters,
+            }
+
+    def shutdown(self):
+        """停止计时线程和线程池（应用关闭时调用），正在执行的任务不等待"""
+        with self._cond:
+            self._stopped = True
+            self._jobs.clear()
+            self._owners.clear()
+            self._waiting.clear()
+            self._heap = []
+            self._cond.notify_all()
+        self._executor.shutdown(wait=False)
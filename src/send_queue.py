@@ -0,0 +1,174 @@
+"""
+发送队列
+每个邮箱账户一个持久化的待发送队列，配合滑动窗口速率限制：
+限制器根据最近的发送时间精确计算下一次允许发送的时刻，
+发送调度只需等到该时刻再取队首发送，不需要定时扫描邮件缓存。
+"""
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import List, Optional, Sequence, Tuple
+
+
+class SlidingWindowLimiter:
+    """
+    滑动窗口速率限制
+
+    - windows: [(上限, 窗口秒数), ...]，任意连续 窗口秒数 内最多发送 上限 封
+    - min_interval: 相邻两次发送的最小间隔（秒）
+    """
+
+    def __init__(self, windows: Sequence[Tuple[int, float]], min_interval: float = 0):
+        """
+        @param windows: [(上限, 窗口秒数), ...]
+        @param min_interval: 最小发送间隔（秒）
+        """
+        self.windows = sorted((int(limit), float(seconds)) for limit, seconds in windows)
+        self.min_interval = float(min_interval)
+        self.horizon = max([seconds for _, seconds in self.windows] + [self.min_interval])
+        self._lock = threading.Lock()
+        # 窗口内的发送时间戳（升序）
+        self._times: List[float] = []
+
+    def load(self, timestamps: Sequence[float]):
+        """用持久化的发送记录恢复状态"""
+        with self._lock:
+            self._times = sorted(timestamps)
+
+    def _prune(self, now: float):
+        cut = bisect_right(self._times, now - self.horizon)
+        if cut:
+            del self._times[:cut]
+
+    def check(self, now: Optional[float] = None) -> Tuple[float, Optional[tuple]]:
+        """
+        计算距离下一次允许发送还需等待的时间
+
+        @param now: 当前时间戳，默认 time.time()
+        @return: (等待秒数，0 表示可以立即发送; 起限制作用的规则：(上限, 窗口秒数)、'interval' 或 None)
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._prune(now)
+            ready, rule = now, None
+            if self._times and self.min_interval > 0:
+                at = self._times[-1] + self.min_interval
+                if at > ready:
+                    ready, rule = at, 'interval'
+            for limit, seconds in self.windows:
+                start = bisect_right(self._times, now - seconds)
+                in_window = len(self._times) - start
+                if in_window >= limit > 0:
+                    # 窗口内最早的若干封移出窗口后才能再发送
+                    at = self._times[start + in_window - limit] + seconds
+                    if at > ready:
+                        ready, rule = at, (limit, seconds)
+            return max(0.0, ready - now), rule
+
+    def record(self, sent_at: Optional[float] = None) -> float:
+        """
+        记录一次发送
+
+        @return: 发送时间戳
+        """
+        sent_at = time.time() if sent_at is None else sent_at
+        with self._lock:
+            self._times.insert(bisect_right(self._times, sent_at), sent_at)
+            self._prune(sent_at)
+        return sent_at
+
+    def counts(self, now: Optional[float] = None) -> List[tuple]:
+        """
+        各窗口内的已发送数量
+
+        @return: [(上限, 窗口秒数, 已发送数), ...]
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            return [(limit, seconds, len(self._times) - bisect_right(self._times, now - seconds))
+                    for limit, seconds in self.windows]
+
+
+class SendQueue:
+    """
+    单个账户的待发送队列（先进先出，按邮件ID去重）
+
+    store 为 UserStateStore：入队、出队立即写入数据库，服务重启后队列和发送记录都会恢复。
+    """
+
+    def __init__(self, limiter: SlidingWindowLimiter, store=None):
+        """
+        @param limiter: 该账户的速率限制器
+        @param store: 持久化存储（UserStateStore），None 表示只保存在内存中
+        """
+        self.limiter = limiter
+        self.store = store
+        self._lock = threading.Lock()
+        # 邮件ID -> 入队时间戳
+        self._items: "OrderedDict[str, float]" = OrderedDict()
+        if store is not None:
+            for email_id, enqueued_at in store.load_send_queue():
+                self._items[email_id] = enqueued_at
+            limiter.load(store.load_send_log(time.time() - limiter.horizon))
+
+    def enqueue(self, email_id: str) -> bool:
+        """
+        把邮件加入队尾
+
+        @return: 是否新加入（已在队列中时返回 False）
+        """
+        if not email_id:
+            return False
+        with self._lock:
+            if email_id in self._items:
+                return False
+            enqueued_at = time.time()
+            self._items[email_id] = enqueued_at
+        if self.store is not None:
+            self.store.add_send_queue_item(email_id, enqueued_at)
+        return True
+
+    def remove(self, email_id: str) -> bool:
+        """把邮件移出队列（已发送或不再需要发送）"""
+        with self._lock:
+            if self._items.pop(email_id, None) is None:
+                return False
+        if self.store is not None:
+            self.store.delete_send_queue_item(email_id)
+        return True
+
+    def requeue(self, email_id: str):
+        """把邮件移到队尾（发送失败后稍后重试，不阻塞后面的邮件）；新的位置同时写入数据库，重启后保持"""
+        with self._lock:
+            if email_id not in self._items:
+                return
+            # 入队时间改为晚于队尾，恢复队列时按入队时间排序
+            last = next(reversed(self._items.values()))
+            enqueued_at = max(time.time(), last + 1e-6)
+            self._items[email_id] = enqueued_at
+            self._items.move_to_end(email_id)
+        if self.store is not None:
+            self.store.update_send_queue_item(email_id, enqueued_at)
+
+    def peek(self) -> Optional[str]:
+        """队首的邮件ID，队列为空时返回 None"""
+        with self._lock:
+            return next(iter(self._items), None)
+
+    def record_sent(self) -> float:
+        """记录一次成功发送（同时写入发送记录）"""
+        sent_at = self.limiter.record()
+        if self.store is not None:
+            self.store.add_send_log(sent_at, sent_at - self.limiter.horizon)
+        return sent_at
+
+    def ids(self) -> List[str]:
+        with self._lock:
+            return list(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, email_id):
+        return email_id in self._items
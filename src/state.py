@@ -18,6 +18,8 @@ class Email(BaseModel):
     sender: str = Field(..., description="Email address of the sender")
     subject: str = Field(..., description="Subject line of the email")
     body: str = Field(..., description="Body content of the email")
+    quoted_context: str = Field(default="", description="Quoted earlier messages stripped from the body")
+    thread_context: str = Field(default="", description="Earlier unanswered messages from the same thread")
     imap_id: bytes = Field(default=b'', description="IMAP ID for marking as read")
     urgency_level: str = Field(default=EmailUrgencyLevel.LOW, description="Urgency level of the email (low/medium/high/urgent)")
     urgency_keywords: list = Field(default_factory=list, description="Keywords that triggered the urgency level")
@@ -0,0 +1,205 @@
+"""
+统计汇总
+订阅邮件缓存和历史记录的变化事件，按天增量维护去重后的计数
+（收到、已处理、已发送、跳过、失败，以及按分类、紧急程度的分布），
+仪表盘的统计接口只需读取汇总结果，耗时与天数相关而与记录总数无关。
+"""
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src.email_collection import IndexedRecordList
+
+
+# 计为“已处理”的状态（邮件缓存 / 历史记录）
+CACHE_DONE_STATUSES = ('processed', 'sent', 'skipped')
+HISTORY_DONE_STATUSES = ('success', 'processed', 'sent', 'skipped')
+
+# 趋势图中计为“已处理”的状态（不含跳过）
+CACHE_TREND_STATUSES = ('processed', 'sent')
+HISTORY_TREND_STATUSES = ('success', 'processed', 'sent')
+
+# 全局（不分日期）计数使用的桶
+ALL = '*'
+
+
+def record_contributions(record: dict, source: str) -> Tuple[Optional[str], frozenset]:
+    """
+    计算一条记录对各项计数的贡献
+
+    @param record: 邮件缓存或历史记录中的一条记录
+    @param source: 'cache' 或 'history'
+    @return: (邮件ID, {(指标, 桶), ...})；没有ID的记录不参与统计
+    """
+    email_id = record.get('id')
+    if not email_id:
+        return None, frozenset()
+
+    if source == 'cache':
+        # 邮件缓存只看收信时间
+        day = str(record.get('time') or '')[:10]
+        done_statuses, trend_statuses = CACHE_DONE_STATUSES, CACHE_TREND_STATUSES
+    else:
+        day = str(record.get('time') or record.get('processed_time') or '')[:10]
+        done_statuses, trend_statuses = HISTORY_DONE_STATUSES, HISTORY_TREND_STATUSES
+    if len(day) < 10:
+        day = ''
+
+    status = record.get('status')
+    keys = []
+    if status in done_statuses:
+        keys.append(('processed', ALL))
+        if day:
+            keys.append(('processed', day))
+            keys.append(('processed_month', day[:7]))
+    if status == 'failed':
+        keys.append(('failed', ALL))
+    if status == 'sent':
+        keys.append(('sent', ALL))
+
+    if day:
+        keys.append(('received', day))
+        if status in trend_statuses:
+            keys.append(('trend_processed', day))
+        if status == 'sent':
+            keys.append(('sent', day))
+        if status == 'skipped':
+            keys.append(('skipped', day))
+        if status == 'failed':
+            keys.append(('failed', day))
+        category = record.get('category')
+        if category and category != 'unknown':
+            keys.append(('category', (day, category)))
+        urgency = record.get('urgency_level')
+        if urgency:
+            keys.append(('urgency', (day, urgency)))
+    return email_id, frozenset(keys)
+
+
+class StatsRollup:
+    """
+    按天的增量统计
+
+    每个 (指标, 桶) 维护 邮件ID -> 引用次数，同一封邮件同时出现在缓存和历史记录中只计一次。
+    记录的加入、移除和状态变化都只调整它涉及的几个计数。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (指标, 桶) -> {邮件ID: 引用次数}
+        self._counts: Dict[tuple, Dict[str, int]] = {}
+        # 来源 -> {记录key: (邮件ID, 贡献集合)}
+        self._contrib: Dict[str, Dict[int, tuple]] = {}
+        # 来源 -> (集合, 回调)
+        self._sources: Dict[str, tuple] = {}
+
+    # ==================== 数据源 ====================
+
+    def attach(self, source: str, collection: IndexedRecordList):
+        """
+        绑定数据源（替换同名的旧数据源），并用现有记录回填计数
+
+        @param source: 'cache' 或 'history'
+        @param collection: EmailCollection 或 HistoryCollection
+        """
+        old = self._sources.pop(source, None)
+        if old is not None:
+            old[0].remove_observer(old[1])
+        self._reset_source(source)
+
+        def observer(event, key, record):
+            self._on_event(source, event, key, record)
+
+        self._sources[source] = (collection, observer)
+        collection.add_observer(observer)
+
+    def load_static(self, source: str, contributions: Iterable[Tuple[str, frozenset]]):
+        """
+        用预先计算好的贡献替换一个不会变化的数据源（如历史归档）
+
+        @param source: 数据源名称，如 'archive'
+        @param contributions: (邮件ID, 计数键集合) 的迭代器
+        """
+        old = self._sources.pop(source, None)
+        if old is not None:
+            old[0].remove_observer(old[1])
+        self._reset_source(source)
+        with self._lock:
+            contrib = self._contrib[source]
+            for key, (email_id, keys) in enumerate(contributions):
+                if email_id:
+                    self._apply(email_id, keys, 1)
+                    contrib[key] = (email_id, keys)
+
+    def _reset_source(self, source: str):
+        with self._lock:
+            for email_id, keys in self._contrib.pop(source, {}).values():
+                self._apply(email_id, keys, -1)
+            self._contrib[source] = {}
+
+    def _on_event(self, source: str, event: str, key: int, record: Optional[dict]):
+        if event == 'reset':
+            self._reset_source(source)
+            return
+        with self._lock:
+            contrib = self._contrib.setdefault(source, {})
+            old = contrib.pop(key, None)
+            new = record_contributions(record, source) if event != 'remove' else None
+            if old == new:
+                if new is not None:
+                    contrib[key] = new
+                return
+            if old is not None:
+                self._apply(old[0], old[1], -1)
+            if new is not None and new[0]:
+                self._apply(new[0], new[1], 1)
+                contrib[key] = new
+
+    def _apply(self, email_id: str, keys: Iterable[tuple], delta: int):
+        for counter_key in keys:
+            ids = self._counts.setdefault(counter_key, {})
+            count = ids.get(email_id, 0) + delta
+            if count > 0:
+                ids[email_id] = count
+            else:
+                ids.pop(email_id, None)
+                if not ids:
+                    del self._counts[counter_key]
+
+    # ==================== 读取 ====================
+
+    def count(self, metric: str, bucket=ALL) -> int:
+        """
+        读取去重后的计数
+
+        @param metric: 指标，如 'received'、'processed'、'failed'、'sent'
+        @param bucket: 桶（日期 'YYYY-MM-DD'、月份 'YYYY-MM' 或 ALL）
+        @return: 邮件数
+        """
+        with self._lock:
+            return len(self._counts.get((metric, bucket), ()))
+
+    def daily(self, metric: str, days: List[str]) -> List[int]:
+        """
+        读取若干天的计数
+
+        @param metric: 指标
+        @param days: 日期列表（'YYYY-MM-DD'）
+        @return: 与 days 对应的计数列表
+        """
+        with self._lock:
+            return [len(self._counts.get((metric, day), ())) for day in days]
+
+    def breakdown(self, metric: str, day: str) -> Dict[str, int]:
+        """
+        读取某一天按分类或紧急程度的分布
+
+        @param metric: 'category' 或 'urgency'
+        @param day: 日期（'YYYY-MM-DD'）
+        @return: {分类/紧急程度: 邮件数}
+        """
+        with self._lock:
+            return {
+                bucket[1]: len(ids)
+                for (name, bucket), ids in self._counts.items()
+                if name == metric and bucket[0] == day
+            }
@@ -0,0 +1,154 @@
+"""
+邮件正文清理器
+在邮件进入大模型处理流程之前，分离出客户本次新写的内容，
+去除引用的历史往来邮件、签名和免责声明。
+"""
+import os
+import re
+from typing import List
+
+
+# 传给回复撰写的引用上下文最大字符数（0 表示不传），可通过环境变量 EMAIL_QUOTED_CONTEXT_CHARS 覆盖
+DEFAULT_QUOTED_CONTEXT_CHARS = 600
+
+
+class EmailBodyCleaner:
+    """
+    邮件正文清理器
+
+    识别以下内容并从正文中移除：
+    - 引用块：以 ">" 开头的行
+    - 引用头："在 ... 写道："、"On ... wrote:"、"-----原始邮件-----"、
+      Outlook 风格的 "发件人:/From: ... 发送时间:/Sent:" 头（其后的内容都视为引用）
+    - 签名：RFC 3676 签名分隔符 "-- " 以及 "发自我的iPhone" 等客户端签名
+    - 免责声明：保密声明、免责声明等法律脚注
+    """
+
+    # 引用头（匹配位置之后的内容全部视为被引用的历史邮件）
+    QUOTE_HEADER_PATTERNS = [
+        r'^[ \t]*在[^\n]{0,200}?写道[：:][ \t]*$',
+        r'^[ \t]*On\b[^\n]{0,200}(?:\n[^\n]{0,200})?\bwrote:[ \t]*$',
+        r'^[ \t]*-{2,}[ \t]*(?:原始邮件|Original Message|Forwarded message|转发邮件)[ \t]*-{2,}',
+        r'^[ \t]*(?:发件人|From)[ \t]*[：:][^\n]*\n(?:[^\n]*\n){0,3}?[ \t]*(?:发送时间|时间|日期|Sent|Date)[ \t]*[：:]',
+    ]
+
+    # 签名起始行（匹配行及其后的内容视为签名）
+    SIGNATURE_PATTERNS = [
+        r'^--[ \t]?$',
+        r'^[ \t]*(?:发自我的|来自我的|Sent from my)[^\n]{0,40}$',
+        r'^[ \t]*发自[ \t]*(?:网易邮箱|QQ邮箱|手机|iPad|iPhone|Android)[^\n]{0,40}$',
+    ]
+
+    # 免责声明起始行
+    DISCLAIMER_PATTERNS = [
+        r'^[ \t]*(?:免责声明|保密声明|保密提示|法律声明)[：:]?',
+        r'^[ \t]*本邮件(?:及其附件)?(?:含有|包含|可能包含)[^\n]{0,20}(?:保密|机密)',
+        r'^[ \t]*This (?:e-?mail|message)(?: and any (?:attachments|files)[^\n]{0,40})? (?:is|are|may contain) (?:confidential|intended)',
+    ]
+
+    # 英文大写标题的免责声明（区分大小写）：只在全大写、且作为空行之后的独立段落出现时匹配，
+    # 避免截掉 "Important notice: my order..." 这样的正文（签名分隔符之后的内容已在签名一步移除）
+    TRAILING_DISCLAIMER_PATTERNS = [
+        r'\n[ \t]*\n[ \t]*(?:CONFIDENTIALITY|DISCLAIMER|IMPORTANT NOTICE)\b',
+    ]
+
+    _QUOTED_LINE = re.compile(r'^[ \t]*>[^\n]*(?:\n|$)', re.MULTILINE)
+
+    def __init__(self, quoted_context_chars: int = None):
+        """
+        @param quoted_context_chars: 保留给回复撰写的引用上下文最大字符数（如果为None，则从环境变量读取）
+        """
+        if quoted_context_chars is None:
+            quoted_context_chars = int(os.getenv("EMAIL_QUOTED_CONTEXT_CHARS", DEFAULT_QUOTED_CONTEXT_CHARS))
+        self.quoted_context_chars = quoted_context_chars
+        self._compile_patterns()
+
+    def _compile_patterns(self):
+        """编译所有正则表达式模式"""
+        flags = re.MULTILINE | re.IGNORECASE
+        self.quote_header_patterns = [re.compile(p, flags) for p in self.QUOTE_HEADER_PATTERNS]
+        self.signature_patterns = [re.compile(p, flags) for p in self.SIGNATURE_PATTERNS]
+        self.disclaimer_patterns = [re.compile(p, flags) for p in self.DISCLAIMER_PATTERNS]
+        self.disclaimer_patterns += [re.compile(p) for p in self.TRAILING_DISCLAIMER_PATTERNS]
+
+    @staticmethod
+    def _first_match(patterns: List[re.Pattern], text: str) -> int:
+        """返回所有模式中最早的匹配位置，没有匹配时返回 -1"""
+        positions = [m.start() for m in (p.search(text) for p in patterns) if m]
+        return min(positions) if positions else -1
+
+    def clean(self, body: str) -> dict:
+        """
+        分离邮件正文中的新内容与引用内容
+
+        @param body: 原始正文
+        @return: {
+            'body': 客户本次新写的内容（清理后为空时返回原文）,
+            'quoted': 被引用的历史邮件内容,
+            'removed_chars': 从正文中移除的字符数
+        }
+        """
+        if not body:
+            return {'body': body or '', 'quoted': '', 'removed_chars': 0}
+
+        text = body
+        quoted_parts = []
+
+        # 1. 引用头之后的内容整体视为历史邮件
+        pos = self._first_match(self.quote_header_patterns, text)
+        if pos >= 0:
+            quoted_parts.append(text[pos:])
+            text = text[:pos]
+
+        # 2. 以 ">" 开头的引用行
+        quoted_lines = self._QUOTED_LINE.findall(text)
+        if quoted_lines:
+            quoted_parts.insert(0, ''.join(quoted_lines))
+            text = self._QUOTED_LINE.sub('', text)
+
+        # 3. 签名和免责声明（直接丢弃，不作为上下文）
+        for patterns in (self.signature_patterns, self.disclaimer_patterns):
+            pos = self._first_match(patterns, text)
+            if pos > 0:
+                text = text[:pos]
+
+        text = text.strip()
+        if not text:
+            # 整封邮件都是引用（如直接转发），保留原文避免丢失内容
+            return {'body': body, 'quoted': '', 'removed_chars': 0}
+
+        quoted = '\n'.join(part.strip() for part in quoted_parts if part.strip())
+        return {
+            'body': text,
+            'quoted': quoted,
+            'removed_chars': len(body) - len(text)
+        }
+
+    def summarize_quoted(self, quoted: str) -> str:
+        """
+        截取引用内容作为回复撰写的上下文（只保留最近一封历史邮件的开头）
+
+        @param quoted: 引用内容
+        @return: 截断后的上下文，未启用时返回空字符串
+        """
+        if not quoted or self.quoted_context_chars <= 0:
+            return ''
+        # 去掉引用符号，便于模型阅读
+        context = re.sub(r'^[ \t]*>+[ \t]?', '', quoted, flags=re.MULTILINE).strip()
+        if len(context) > self.quoted_context_chars:
+            context = context[:self.quoted_context_chars] + '...'
+        return context
+
+
+# 创建全局实例
+email_body_cleaner = EmailBodyCleaner()
+
+
+def clean_email_body(body: str) -> dict:
+    """
+    清理邮件正文的便捷函数
+
+    @param body: 原始正文
+    @return: {'body': 新内容, 'quoted': 引用内容, 'removed_chars': 移除的字符数}
+    """
+    return email_body_cleaner.clean(body)
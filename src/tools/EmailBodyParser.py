@@ -0,0 +1,194 @@
+"""
+邮件正文解析器
+使用 BytesFeedParser 分块解析 MIME 邮件，只解码选中的正文部分（优先 text/plain），
+附件不做解码；HTML 正文通过线性时间的解析器转换为纯文本。
+"""
+import os
+import re
+from email.feedparser import BytesFeedParser
+from html.parser import HTMLParser
+from typing import Optional
+
+
+# 正文最大字符数（超出部分截断），可通过环境变量 EMAIL_MAX_BODY_CHARS 覆盖
+DEFAULT_MAX_BODY_CHARS = 8000
+
+# 喂给 BytesFeedParser 的分块大小
+FEED_CHUNK_SIZE = 64 * 1024
+
+# 常见的错误/过窄字符集声明，统一使用超集解码
+CHARSET_ALIASES = {
+    'gb2312': 'gb18030',
+    'gbk': 'gb18030',
+    'x-gbk': 'gb18030',
+    'cp936': 'gb18030',
+    'ascii': 'utf-8',
+    'us-ascii': 'utf-8',
+}
+
+
+class _HTMLTextExtractor(HTMLParser):
+    """
+    HTML 转纯文本（单次扫描，线性时间）
+
+    丢弃 script/style/head 等不可见内容，块级标签转换为换行，实体自动解码。
+    """
+
+    SKIP_TAGS = {'script', 'style', 'head', 'title', 'noscript', 'template'}
+    BLOCK_TAGS = {
+        'br', 'p', 'div', 'li', 'tr', 'table', 'ul', 'ol', 'blockquote',
+        'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'pre', 'section', 'article'
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_startendtag(self, tag, attrs):
+        if tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            if self.skip_depth > 0:
+                self.skip_depth -= 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.parts.append(data)
+
+
+class EmailBodyParser:
+    """
+    邮件正文解析器
+
+    从原始邮件字节或单个已下载的正文部分中提取干净、长度受限的纯文本，
+    减少后续每次大模型调用的提示词长度。
+    """
+
+    # 空白折叠规则（预编译）
+    _INLINE_SPACE = re.compile(r'[ \t\f\v\u00a0\u3000]+')
+    _SPACE_AROUND_NEWLINE = re.compile(r' *\n *')
+    _MULTI_NEWLINE = re.compile(r'\n{3,}')
+
+    def __init__(self, max_chars: Optional[int] = None):
+        """
+        @param max_chars: 正文最大字符数（如果为None，则从环境变量读取）
+        """
+        self.max_chars = int(max_chars or os.getenv("EMAIL_MAX_BODY_CHARS", DEFAULT_MAX_BODY_CHARS))
+
+    def html_to_text(self, html: str) -> str:
+        """
+        将 HTML 转换为纯文本
+
+        @param html: HTML 字符串
+        @return: 纯文本
+        """
+        extractor = _HTMLTextExtractor()
+        try:
+            extractor.feed(html)
+            extractor.close()
+        except Exception:
+            # 极端畸形的 HTML：保留已提取的部分
+            pass
+        return ''.join(extractor.parts)
+
+    def normalize_text(self, text: str) -> str:
+        """
+        折叠空白并按 max_chars 截断
+
+        @param text: 原始文本
+        @return: 规范化后的文本
+        """
+        text = text.replace('\r\n', '\n').replace('\r', '\n')
+        text = self._INLINE_SPACE.sub(' ', text)
+        text = self._SPACE_AROUND_NEWLINE.sub('\n', text)
+        text = self._MULTI_NEWLINE.sub('\n\n', text)
+        text = text.strip()
+        if len(text) > self.max_chars:
+            text = text[:self.max_chars]
+        return text
+
+    def decode_text(self, payload: bytes, charset: Optional[str] = None, subtype: str = 'plain') -> str:
+        """
+        解码单个已去除传输编码的正文部分
+
+        @param payload: 正文字节
+        @param charset: 声明的字符集
+        @param subtype: 'plain' 或 'html'
+        @return: 规范化后的纯文本
+        """
+        charset = (charset or 'utf-8').strip().strip('"\'').lower()
+        charset = CHARSET_ALIASES.get(charset, charset)
+        try:
+            text = payload.decode(charset, errors='replace')
+        except LookupError:
+            text = payload.decode('utf-8', errors='replace')
+        if subtype == 'html':
+            text = self.html_to_text(text)
+        return self.normalize_text(text)
+
+    def parse_bytes(self, raw: bytes) -> str:
+        """
+        解析完整（或被截断的）原始邮件，返回正文纯文本
+
+        @param raw: 原始邮件字节
+        @return: 规范化后的纯文本（没有可用正文时返回空字符串）
+        """
+        parser = BytesFeedParser()
+        for start in range(0, len(raw), FEED_CHUNK_SIZE):
+            parser.feed(raw[start:start + FEED_CHUNK_SIZE])
+        msg = parser.close()
+
+        html_part = None
+        for part in msg.walk():
+            if part.is_multipart():
+                continue
+            # 附件直接跳过，不解码其内容
+            disposition = (part.get('Content-Disposition') or '').split(';')[0].strip().lower()
+            if disposition == 'attachment':
+                continue
+            content_type = part.get_content_type()
+            if content_type == 'text/plain':
+                text = self._decode_part(part, 'plain')
+                if text:
+                    return text
+            elif content_type == 'text/html' and html_part is None:
+                html_part = part
+
+        if html_part is not None:
+            return self._decode_part(html_part, 'html')
+        return ""
+
+    def _decode_part(self, part, subtype: str) -> str:
+        """去除传输编码并解码单个 MIME 部分"""
+        try:
+            payload = part.get_payload(decode=True)
+        except Exception:
+            return ""
+        if not payload:
+            return ""
+        return self.decode_text(payload, part.get_content_charset(), subtype)
+
+
+# 创建全局实例
+email_body_parser = EmailBodyParser()
+
+
+def extract_email_body(raw: bytes) -> str:
+    """
+    从原始邮件字节中提取正文的便捷函数
+
+    @param raw: 原始邮件字节
+    @return: 规范化后的纯文本
+    """
+    return email_body_parser.parse_bytes(raw)
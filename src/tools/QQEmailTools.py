@@ -7,15 +7,478 @@ from email.header import decode_header
 from datetime import datetime, timedelta
 import re
 import os
+import base64
+import quopri
+import threading
+import time
+import weakref
+from .EmailBodyParser import email_body_parser
+from .EmailBodyCleaner import email_body_cleaner
+
+
+# 第一阶段需要的邮件头
+HEADER_FIELDS = "FROM SUBJECT MESSAGE-ID IN-REPLY-TO REFERENCES"
+
+# 单封邮件正文的默认下载上限（字节），可通过环境变量 EMAIL_MAX_BODY_BYTES 覆盖
+DEFAULT_MAX_BODY_BYTES = 64 * 1024
+
+# 标记已读请求合并提交的延迟（秒）
+FLAG_FLUSH_DELAY = float(os.getenv("EMAIL_FLAG_FLUSH_DELAY", "2"))
+
+# 标记已读提交失败后的重试间隔（秒）
+FLAG_RETRY_DELAY = float(os.getenv("EMAIL_FLAG_RETRY_DELAY", "60"))
+
+# 标记已读连续失败的最多重试次数，超过后放弃这些标记
+FLAG_MAX_RETRIES = 5
+
+# IMAP 连接和每次读写的超时时间（秒），避免服务器无响应时一直占用线程，可通过环境变量 IMAP_TIMEOUT 覆盖
+IMAP_TIMEOUT = float(os.getenv("IMAP_TIMEOUT", "60"))
+
+# 每个账号待提交的已读标记：{email_address: {'uids': set, 'tools': QQEmailToolsClass, 'timer': Timer, 'failures': int}}
+_pending_seen_flags = {}
+_flag_queue_lock = threading.Lock()
+
+
+def _normalize_imap_id(email_id):
+    """
+    将各种格式的 imap_id 统一为数字字符串
+    
+    @param email_id: bytes、字符串或 bytes 的字符串表示形式（如 "b'89'"，来自JSON缓存）
+    @return: 数字字符串，无效时返回 None
+    """
+    if isinstance(email_id, bytes):
+        try:
+            email_id_str = email_id.decode('utf-8')
+        except UnicodeDecodeError:
+            email_id_str = email_id.decode('latin-1')
+    elif isinstance(email_id, str):
+        email_id_str = email_id.strip()
+        # 如果字符串是 "b'...'" 或 "b\"...\"" 格式，提取实际内容
+        if email_id_str.startswith(("b'", 'b"')) and email_id_str[-1:] in ("'", '"'):
+            email_id_str = email_id_str[2:-1]
+    else:
+        email_id_str = str(email_id)
+    
+    email_id_str = email_id_str.strip()
+    return email_id_str if email_id_str.isdigit() else None
+
+
+def _flush_seen_flags(account):
+    """
+    提交指定账号队列中的所有已读标记
+    
+    提交失败时这些 UID 放回队列，FLAG_RETRY_DELAY 秒后重试（连续失败 FLAG_MAX_RETRIES 次后放弃）。
+    
+    @param account: 邮箱地址
+    @return: 是否成功（队列为空时返回True）
+    """
+    with _flag_queue_lock:
+        pending = _pending_seen_flags.pop(account, None)
+    if not pending:
+        return True
+    if pending['timer'] is not None:
+        pending['timer'].cancel()
+    if not pending['uids']:
+        return True
+    if pending['tools'].mark_emails_as_read(list(pending['uids'])):
+        return True
+    
+    failures = pending.get('failures', 0) + 1
+    if failures > FLAG_MAX_RETRIES:
+        print(f"❌ [标记已读] 账号 {account} 连续 {failures} 次提交失败，放弃 {len(pending['uids'])} 个已读标记")
+        return False
+    with _flag_queue_lock:
+        current = _pending_seen_flags.setdefault(
+            account, {'uids': set(), 'tools': pending['tools'], 'timer': None, 'failures': 0})
+        current['uids'].update(pending['uids'])
+        current['failures'] = max(current.get('failures', 0), failures)
+        if current['timer'] is None:
+            timer = threading.Timer(FLAG_RETRY_DELAY, _flush_seen_flags, args=(account,))
+            timer.daemon = True
+            current['timer'] = timer
+            timer.start()
+    print(f"⚠️ [标记已读] 账号 {account} 提交失败，{len(pending['uids'])} 个已读标记已放回队列，{FLAG_RETRY_DELAY:.0f} 秒后重试")
+    return False
+
+
+def flush_all_mark_as_read():
+    """提交所有账号队列中的已读标记（应用关闭时调用）"""
+    with _flag_queue_lock:
+        accounts = list(_pending_seen_flags.keys())
+    for account in accounts:
+        _flush_seen_flags(account)
+
+
+def _parse_imap_tokens(data, pos=0):
+    """
+    解析IMAP响应中的括号列表（支持原子、带引号字符串、NIL 和 {n} 字面量）
+    
+    @param data: 原始响应字节
+    @param pos: 起始位置（必须指向 '('）
+    @return: (解析出的列表, 结束位置)
+    """
+    items = []
+    pos += 1
+    length = len(data)
+    while pos < length:
+        ch = data[pos:pos + 1]
+        if ch in (b' ', b'\r', b'\n'):
+            pos += 1
+        elif ch == b')':
+            return items, pos + 1
+        elif ch == b'(':
+            sub, pos = _parse_imap_tokens(data, pos)
+            items.append(sub)
+        elif ch == b'"':
+            end = pos + 1
+            buf = bytearray()
+            while end < length and data[end:end + 1] != b'"':
+                if data[end:end + 1] == b'\\':
+                    end += 1
+                buf += data[end:end + 1]
+                end += 1
+            items.append(bytes(buf))
+            pos = end + 1
+        elif ch == b'{':
+            end = data.index(b'}', pos)
+            size = int(data[pos + 1:end])
+            start = end + 3  # 跳过 "}\r\n"
+            items.append(data[start:start + size])
+            pos = start + size
+        else:
+            # 原子；BODY[HEADER.FIELDS (...)]<0> 这类带方括号的原子整体读取
+            end = pos
+            depth = 0
+            while end < length:
+                c = data[end:end + 1]
+                if c == b'[':
+                    depth += 1
+                elif c == b']':
+                    depth -= 1
+                elif depth == 0 and c in (b' ', b'(', b')', b'\r', b'\n'):
+                    break
+                end += 1
+            atom = data[pos:end]
+            items.append(None if atom.upper() == b'NIL' else atom)
+            pos = end
+    return items, pos
+
+
+def _parse_fetch_response(fetch_data):
+    """
+    将 imaplib 的 FETCH 返回值解析为 {UID: [键, 值, 键, 值, ...]}
+    
+    @param fetch_data: mail.uid('fetch', ...) 返回的数据列表
+    @return: 按邮件UID（bytes）分组的解析结果（响应中没有UID时使用序列号）
+    """
+    # 还原成服务器原始响应流：元组的第一个元素以 {n} 结尾，第二个元素是字面量内容
+    chunks = []
+    for item in fetch_data or []:
+        if isinstance(item, tuple):
+            chunks.append(item[0] + b'\r\n' + item[1])
+        elif isinstance(item, bytes):
+            chunks.append(b' ' + item)
+    raw = b''.join(chunks)
+    
+    results = {}
+    pos = 0
+    length = len(raw)
+    while pos < length:
+        paren = raw.find(b'(', pos)
+        if paren == -1:
+            break
+        seq = raw[pos:paren].strip()
+        items, pos = _parse_imap_tokens(raw, paren)
+        if seq.isdigit():
+            uid = _find_fetch_value(items, b'UID')
+            results.setdefault(uid if isinstance(uid, bytes) else seq, []).extend(items)
+    return results
+
+
+def _find_fetch_value(items, key_prefix):
+    """
+    在解析后的 FETCH 键值列表中查找指定键的值
+    
+    @param items: _parse_fetch_response 返回的单封邮件列表
+    @param key_prefix: 键前缀（如 b'BODYSTRUCTURE'、b'BODY['）
+    @return: 对应的值，不存在时返回 None
+    """
+    for i in range(0, len(items) - 1, 2):
+        key = items[i]
+        if isinstance(key, bytes) and key.upper().startswith(key_prefix):
+            return items[i + 1]
+    return None
+
+
+def _select_text_part(structure, section=""):
+    """
+    从 BODYSTRUCTURE 中选出要下载的正文部分（优先 text/plain，其次 text/html，跳过附件）
+    
+    @param structure: 解析后的 BODYSTRUCTURE 列表
+    @param section: 当前部分的编号前缀
+    @return: (section, subtype, encoding, charset, size)，找不到时返回 None（size 为部分的字节数，未知时为 None）
+    """
+    html_part = None
+    for candidate in _iter_text_parts(structure, section):
+        if candidate[1] == 'plain':
+            return candidate
+        if html_part is None and candidate[1] == 'html':
+            html_part = candidate
+    return html_part
+
+
+def _iter_text_parts(structure, section):
+    """按顺序遍历 BODYSTRUCTURE 中所有非附件的 text/* 部分"""
+    if not structure:
+        return
+    if isinstance(structure[0], list):
+        # multipart：前面若干个元素是子部分，之后是子类型和扩展数据
+        index = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            index += 1
+            child_section = f"{section}.{index}" if section else str(index)
+            yield from _iter_text_parts(child, child_section)
+        return
+    
+    main_type = (structure[0] or b'').decode('ascii', 'ignore').lower()
+    sub_type = (structure[1] or b'').decode('ascii', 'ignore').lower() if len(structure) > 1 else ''
+    if main_type != 'text' or sub_type not in ('plain', 'html'):
+        return
+    
+    # text 类型的扩展字段：8=md5, 9=disposition
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and isinstance(disposition[0], bytes):
+        if disposition[0].lower() == b'attachment':
+            return
+    
+    charset = None
+    params = structure[2] if len(structure) > 2 else None
+    if isinstance(params, list):
+        for i in range(0, len(params) - 1, 2):
+            if isinstance(params[i], bytes) and params[i].lower() == b'charset' and params[i + 1]:
+                charset = params[i + 1].decode('ascii', 'ignore')
+    encoding = structure[5] if len(structure) > 5 and structure[5] else b'7bit'
+    size = structure[6] if len(structure) > 6 else None
+    size = int(size) if isinstance(size, bytes) and size.isdigit() else None
+    
+    # 非 multipart 的单部分邮件，正文用 TEXT 获取
+    yield (section or "TEXT", sub_type, encoding.decode('ascii', 'ignore').lower(), charset, size)
+
+
+def _decode_transfer_encoding(raw, encoding):
+    """
+    按 Content-Transfer-Encoding 解码（兼容被截断的部分获取结果）
+    
+    @param raw: 原始正文字节
+    @param encoding: 传输编码（base64 / quoted-printable / 7bit / 8bit）
+    @return: 解码后的字节
+    """
+    if encoding == 'base64':
+        cleaned = re.sub(rb'[^A-Za-z0-9+/=]', b'', raw)
+        cleaned = cleaned[:len(cleaned) - len(cleaned) % 4]
+        try:
+            return base64.b64decode(cleaned)
+        except Exception:
+            return b''
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(raw)
+    return raw
+
+
+
+# SMTP连接复用配置：空闲超过 SMTP_NOOP_INTERVAL 秒的连接在复用前先发送 NOOP 探活，
+# 空闲超过 SMTP_MAX_IDLE 秒的连接直接关闭重连
+SMTP_NOOP_INTERVAL = float(os.getenv("SMTP_NOOP_INTERVAL", "30"))
+SMTP_MAX_IDLE = float(os.getenv("SMTP_MAX_IDLE", "240"))
+SMTP_MAX_IDLE_SESSIONS = int(os.getenv("SMTP_MAX_IDLE_SESSIONS", "2"))
+
+
+class SMTPSessionPool:
+    """
+    单个邮箱账号的SMTP会话池
+    
+    复用已完成 TLS 握手和登录的连接，避免每封回复都重新握手、登录
+    （频繁登录会触发QQ邮箱的反滥用限制）。
+    """
+    
+    def __init__(self, host, port, username, password, use_ssl=True, max_idle_sessions=None):
+        """
+        @param host: SMTP服务器地址
+        @param port: SMTP服务器端口
+        @param username: 登录账号
+        @param password: 授权码（为空时不登录，便于连接本地测试服务器）
+        @param use_ssl: 是否使用 SMTP_SSL（本地测试服务器可设为False）
+        @param max_idle_sessions: 最多保留的空闲连接数
+        """
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.max_idle_sessions = max_idle_sessions or SMTP_MAX_IDLE_SESSIONS
+        self._idle = []  # [(连接, 最后使用时间)]
+        self._lock = threading.Lock()
+        self.connect_count = 0
+    
+    def _connect(self):
+        """建立新的已认证连接"""
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=30)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=30)
+        if self.password:
+            server.login(self.username, self.password)
+        self.connect_count += 1
+        return server
+    
+    @staticmethod
+    def _close(server):
+        """关闭连接（忽略已断开的连接产生的错误）"""
+        try:
+            server.quit()
+        except Exception:
+            try:
+                server.close()
+            except Exception:
+                pass
+    
+    def _checkout(self):
+        """取出一个可用连接：优先复用空闲连接，必要时用 NOOP 探活"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, last_used = self._idle.pop()
+            idle_seconds = time.monotonic() - last_used
+            if idle_seconds > SMTP_MAX_IDLE:
+                self._close(server)
+                continue
+            if idle_seconds > SMTP_NOOP_INTERVAL:
+                try:
+                    code, _ = server.noop()
+                    if code != 250:
+                        raise smtplib.SMTPServerDisconnected(f"NOOP 返回 {code}")
+                except (smtplib.SMTPException, OSError):
+                    self._close(server)
+                    continue
+            return server
+        return self._connect()
+    
+    def _checkin(self, server):
+        """归还连接，超出空闲上限时直接关闭"""
+        with self._lock:
+            if len(self._idle) < self.max_idle_sessions:
+                self._idle.append((server, time.monotonic()))
+                return
+        self._close(server)
+    
+    def send_messages(self, messages):
+        """
+        在同一个已认证会话上依次发送多封邮件
+        
+        连接被服务器断开（SMTPServerDisconnected）时自动重连并重试当前邮件一次；
+        建立连接或登录失败（如授权码错误）时不再重试，剩余邮件全部记为失败。
+        
+        @param messages: email.message.Message 列表
+        @return: 与 messages 一一对应的结果列表，成功为 None，失败为异常对象
+        """
+        results = []
+        server = None
+        try:
+            for msg in messages:
+                for attempt in range(2):
+                    if server is None:
+                        # 建立连接或登录失败时直接进入外层处理，不再为每封邮件重复登录
+                        server = self._checkout()
+                    try:
+                        server.send_message(msg)
+                        results.append(None)
+                        break
+                    except (smtplib.SMTPServerDisconnected, ConnectionError) as e:
+                        if server is not None:
+                            self._close(server)
+                            server = None
+                        if attempt == 1:
+                            results.append(e)
+                        else:
+                            print(f"⚠️ [SMTP] 连接已断开，重新连接: {e}")
+                    except smtplib.SMTPException as e:
+                        # 单封邮件被拒收等错误不影响连接继续使用
+                        results.append(e)
+                        break
+        except Exception as e:
+            # 建立连接或登录失败：剩余邮件全部记为失败
+            if server is not None:
+                self._close(server)
+                server = None
+            results.extend([e] * (len(messages) - len(results)))
+        if server is not None:
+            self._checkin(server)
+        return results
+    
+    def send_message(self, msg):
+        """
+        发送单封邮件（复用池中的连接）
+        
+        @param msg: email.message.Message
+        @raise: 发送失败时抛出对应异常
+        """
+        error = self.send_messages([msg])[0]
+        if error is not None:
+            raise error
+    
+    def close(self):
+        """关闭池中所有空闲连接"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _ in idle:
+            self._close(server)
+
+
+# 按 (服务器, 端口, 账号) 复用的SMTP会话池
+_smtp_pools = {}
+_smtp_pools_lock = threading.Lock()
+
+
+def get_smtp_pool(host, port, username, password, use_ssl=True):
+    """
+    获取（或创建）指定账号的SMTP会话池
+    
+    授权码变化时会关闭旧池并重新创建。
+    
+    @return: SMTPSessionPool
+    """
+    key = (host, port, username)
+    with _smtp_pools_lock:
+        pool = _smtp_pools.get(key)
+        if pool is not None and (pool.password != password or pool.use_ssl != use_ssl):
+            pool.close()
+            pool = None
+        if pool is None:
+            pool = SMTPSessionPool(host, port, username, password, use_ssl=use_ssl)
+            _smtp_pools[key] = pool
+        return pool
+
+
+def close_all_smtp_pools():
+    """关闭所有SMTP会话池（应用关闭时调用）"""
+    with _smtp_pools_lock:
+        pools = list(_smtp_pools.values())
+        _smtp_pools.clear()
+    for pool in pools:
+        pool.close()
 
 
 class QQEmailToolsClass:
-    def __init__(self, email_address=None, auth_code=None):
+    def __init__(self, email_address=None, auth_code=None, max_body_bytes=None):
         """
         初始化QQ邮箱工具类
         
         @param email_address: QQ邮箱地址（如果为None，则从环境变量读取）
         @param auth_code: QQ邮箱授权码（如果为None，则从环境变量读取）
+        @param max_body_bytes: 单封邮件正文下载上限（字节，如果为None，则从环境变量读取）
         """
         self.email_address = email_address or os.getenv("MY_EMAIL", "")
         self.auth_code = auth_code or os.getenv("QQ_EMAIL_AUTH_CODE", "")
@@ -23,10 +486,41 @@ class QQEmailToolsClass:
         self.imap_port = 993
         self.smtp_server = "smtp.qq.com"
         self.smtp_port = 465
+        self.smtp_use_ssl = True
+        self.max_body_bytes = int(max_body_bytes or os.getenv("EMAIL_MAX_BODY_BYTES", DEFAULT_MAX_BODY_BYTES))
+        # 进行中的IMAP连接（abort 时断开）
+        self._imap_connections = weakref.WeakSet()
+        self._aborted = False
+    
+    def _open_imap(self):
+        """建立IMAP连接（已中断的实例不再建立新连接）"""
+        if self._aborted:
+            raise ConnectionAbortedError("邮箱操作已中断")
+        mail = imaplib.IMAP4_SSL(self.imap_server, self.imap_port, timeout=IMAP_TIMEOUT)
+        self._imap_connections.add(mail)
+        return mail
+    
+    def abort(self):
+        """
+        中断进行中的IMAP操作，并拒绝之后的IMAP连接和SMTP发送
+        
+        已经开始传输的SMTP会话不打断（避免对方收到不完整的邮件），会话结束后才生效。
+        """
+        self._aborted = True
+        for mail in list(self._imap_connections):
+            try:
+                mail.shutdown()
+            except Exception:
+                pass
         
     def fetch_unanswered_emails(self, max_results=50):
         """
-        获取未读邮件
+        获取未读邮件（两阶段获取）
+        
+        第一阶段只获取 BODYSTRUCTURE 和必要的邮件头（BODY.PEEK，不会标记已读），
+        第二阶段只下载选中的 text/plain（或 text/html）正文部分，并按
+        max_body_bytes 做部分获取（<0.N>），附件不会被下载；
+        BODYSTRUCTURE 中正文部分大小为 0 的空邮件不进入第二阶段。
         
         @param max_results: 最大返回数量
         @return: 邮件列表
@@ -36,7 +530,7 @@ class QQEmailToolsClass:
         
         try:
             # 连接到IMAP服务器
-            mail = imaplib.IMAP4_SSL(self.imap_server, self.imap_port)
+            mail = self._open_imap()
             mail.login(self.email_address, self.auth_code)
             
             # 选择收件箱
@@ -49,7 +543,7 @@ class QQEmailToolsClass:
             # 搜索未读邮件（最近8小时）
             since_date = (datetime.now() - timedelta(hours=8)).strftime('%d-%b-%Y')
             search_criteria = f'(UNSEEN SINCE {since_date})'
-            status, message_ids = mail.search(None, search_criteria)
+            status, message_ids = mail.uid('search', None, search_criteria)
                 
             if status != 'OK' or not message_ids[0]:
                 mail.logout()
@@ -62,19 +556,29 @@ class QQEmailToolsClass:
             filtered_count = 0
             fetch_failed_count = 0
             
+            # 第一阶段：一次性获取所有邮件的结构和邮件头（不含正文）
+            status, head_data = mail.uid(
+                'fetch',
+                b','.join(email_ids),
+                f'(BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])'
+            )
+            if status != 'OK':
+                print(f"❌ 获取邮件头失败: {status}")
+                mail.logout()
+                return []
+            fetch_items = _parse_fetch_response(head_data)
+            
             for email_id in email_ids:
                 try:
-                    # 获取邮件
-                    status, msg_data = mail.fetch(email_id, '(RFC822)')
-                    if status != 'OK':
+                    item = fetch_items.get(email_id)
+                    if not item:
                         fetch_failed_count += 1
                         continue
                     
-                    # 解析邮件
-                    email_body = msg_data[0][1]
-                    msg = email.message_from_bytes(email_body)
-            
                     # 解析邮件头
+                    header_bytes = _find_fetch_value(item, b'BODY[HEADER')
+                    msg = email.message_from_bytes(header_bytes if isinstance(header_bytes, bytes) else b'')
+                    
                     subject, encoding = decode_header(msg["Subject"])[0] if msg["Subject"] else (None, None)
                     if isinstance(subject, bytes):
                         subject = subject.decode(encoding or 'utf-8')
@@ -130,32 +634,26 @@ class QQEmailToolsClass:
                         fetch_failed_count += 1
                         continue
                     
-                    # 解析邮件正文
-                    body = ""
-                    if msg.is_multipart():
-                        for part in msg.walk():
-                            content_type = part.get_content_type()
-                            if content_type == "text/plain" or content_type == "text/html":
-                                try:
-                                    payload = part.get_payload(decode=True)
-                                    if payload:
-                                        charset = part.get_content_charset() or 'utf-8'
-                                        body = payload.decode(charset, errors='ignore')
-                                        if content_type == "text/html":
-                                            # 简单去除HTML标签
-                                            import re
-                                            body = re.sub(r'<[^>]+>', '', body)
-                                        break
-                                except:
-                                    pass
-                    else:
-                        try:
-                            payload = msg.get_payload(decode=True)
-                            if payload:
-                                charset = msg.get_content_charset() or 'utf-8'
-                                body = payload.decode(charset, errors='ignore')
-                        except:
-                            pass
+                    # 自己发送的邮件不需要下载正文
+                    if self._is_own_email(sender_email):
+                        filtered_count += 1
+                        continue
+                    
+                    bodystructure = _find_fetch_value(item, b'BODYSTRUCTURE')
+                    part = _select_text_part(bodystructure) if isinstance(bodystructure, list) else None
+                    
+                    # 正文部分大小为 0 的空邮件直接跳过，不再下载正文
+                    if part is not None and part[4] == 0:
+                        filtered_count += 1
+                        continue
+                    
+                    # 第二阶段：只下载选中的正文部分（带大小上限）
+                    body = self._fetch_body_text(mail, email_id, part)
+                    
+                    # 分离客户新写的内容和引用的历史邮件、签名、免责声明
+                    cleaned = email_body_cleaner.clean(body)
+                    if cleaned['removed_chars'] > 0:
+                        print(f"✂️ [获取邮件] 正文清理移除 {cleaned['removed_chars']} 个字符（引用/签名/免责声明）: {(subject or '')[:30]}")
                     
                     # 获取Message-ID
                     message_id = msg.get("Message-ID", "")
@@ -170,8 +668,11 @@ class QQEmailToolsClass:
                         'references': references,
                         'sender': sender_email,
                         'subject': subject or '(无主题)',
-                        'body': body,
-                        'imap_id': email_id
+                        'body': cleaned['body'],
+                        'quoted_context': cleaned['quoted'],
+                        'removed_chars': cleaned['removed_chars'],
+                        'imap_id': email_id,
+                        'imap_id_type': 'uid'  # 旧版本缓存的 imap_id 是序号，加载时据此区分
                     }
                     
                     # 检查是否应该处理这封邮件
@@ -198,6 +699,45 @@ class QQEmailToolsClass:
                     pass
             return []
     
+    def _fetch_body_text(self, mail, email_id, part):
+        """
+        只下载邮件中选中的正文部分（优先 text/plain，其次 text/html）
+        
+        @param mail: 已选择收件箱的IMAP连接
+        @param email_id: 邮件UID
+        @param part: 第一阶段从 BODYSTRUCTURE 选出的正文部分（_select_text_part 的返回值），None 表示无法解析结构
+        @return: 规范化后的正文纯文本（HTML 已转换为文本，长度受 EMAIL_MAX_BODY_CHARS 限制）
+        """
+        if part is None:
+            # 无法解析结构时，退化为获取邮件开头的 max_body_bytes 字节再解析
+            status, data = mail.uid('fetch', email_id, f'(BODY.PEEK[]<0.{self.max_body_bytes}>)')
+            if status != 'OK':
+                return ""
+            raw = _find_fetch_value(_parse_fetch_response(data).get(email_id, []), b'BODY[')
+            if not isinstance(raw, bytes):
+                return ""
+            return email_body_parser.parse_bytes(raw)
+        
+        section, subtype, encoding, charset, _ = part
+        status, data = mail.uid('fetch', email_id, f'(BODY.PEEK[{section}]<0.{self.max_body_bytes}>)')
+        if status != 'OK':
+            return ""
+        raw = _find_fetch_value(_parse_fetch_response(data).get(email_id, []), b'BODY[')
+        if not isinstance(raw, bytes):
+            return ""
+        
+        payload = _decode_transfer_encoding(raw, encoding)
+        return email_body_parser.decode_text(payload, charset, subtype)
+    
+    def _is_own_email(self, sender):
+        """
+        检查邮件是否由自己发送
+        
+        @param sender: 发件人地址
+        @return: 是否是自己发送的邮件
+        """
+        return bool(self.email_address) and self.email_address in sender
+    
     def _should_process_email(self, email_data):
         """
         检查是否应该处理这封邮件
@@ -206,7 +746,7 @@ class QQEmailToolsClass:
         @return: 是否应该处理
         """
         # 跳过自己发送的邮件
-        if self.email_address in email_data['sender']:
+        if self._is_own_email(email_data['sender']):
             return False
         
         # 跳过空邮件
@@ -219,12 +759,34 @@ class QQEmailToolsClass:
         """
         将邮件标记为已读
         
-        @param email_id: 邮件的IMAP ID（bytes类型或字符串）
+        @param email_id: 邮件的IMAP UID（bytes类型或字符串）
+        @return: 是否成功
+        """
+        return self.mark_emails_as_read([email_id])
+    
+    def mark_emails_as_read(self, email_ids):
+        """
+        批量将邮件标记为已读（一次连接，一条 UID STORE 命令）
+        
+        @param email_ids: 邮件的IMAP UID列表（bytes类型或字符串）
         @return: 是否成功
         """
+        uids = []
+        for email_id in email_ids:
+            uid = _normalize_imap_id(email_id)
+            if uid:
+                uids.append(uid)
+            else:
+                print(f"❌ 无效的邮件UID格式: {email_id}, 类型: {type(email_id)}")
+        if not uids:
+            return False
+        
+        # 去重并排序，生成 UID 集合（如 "3,5,8"）
+        uid_set = ','.join(sorted(set(uids), key=int))
+        mail = None
         try:
             # 连接到IMAP服务器
-            mail = imaplib.IMAP4_SSL(self.imap_server, self.imap_port)
+            mail = self._open_imap()
             mail.login(self.email_address, self.auth_code)
             
             # 选择收件箱
@@ -234,82 +796,60 @@ class QQEmailToolsClass:
                 mail.logout()
                 return False
             
-            # 处理 email_id 格式
-            # IMAP序列号应该是数字字符串或bytes格式的数字
-            email_id_str = None
-            
-            if isinstance(email_id, bytes):
-                # 如果是bytes，直接解码为字符串
-                try:
-                    email_id_str = email_id.decode('utf-8')
-                except:
-                    email_id_str = email_id.decode('latin-1')
-            elif isinstance(email_id, str):
-                # 如果是字符串，检查是否是bytes的字符串表示形式（如 "b'89'"）
-                email_id_str = email_id.strip()
-                # 如果字符串是 "b'...'" 或 "b\"...\"" 格式，提取实际内容
-                if email_id_str.startswith("b'") and email_id_str.endswith("'"):
-                    # 提取 b'89' 中的 89
-                    email_id_str = email_id_str[2:-1]
-                elif email_id_str.startswith('b"') and email_id_str.endswith('"'):
-                    # 提取 b"89" 中的 89
-                    email_id_str = email_id_str[2:-1]
-            else:
-                # 其他类型，转换为字符串
-                email_id_str = str(email_id)
-            
-            # 验证序列号格式（应该是纯数字）
-            if not email_id_str or not email_id_str.isdigit():
-                print(f"❌ 无效的邮件序列号格式: {email_id_str}")
-                print(f"   原始值: {email_id}, 类型: {type(email_id)}")
-                mail.logout()
-                return False
-            
-            # 检查邮件是否存在（使用SEARCH命令验证）
-            try:
-                status, data = mail.search(None, f'UID {email_id_str}')
-                if status == 'OK' and data[0]:
-                    # 邮件存在，尝试标记为已读
-                    status, response = mail.store(email_id_str, '+FLAGS', '\\Seen')
-                    if status == 'OK':
-                        print(f"✓ 邮件已标记为已读 (序列号: {email_id_str})")
-                        mail.logout()
-                        return True
-                    else:
-                        print(f"❌ 标记已读失败: {response}")
-                        mail.logout()
-                        return False
-                else:
-                    # 邮件不存在或已被删除
-                    print(f"⚠️ 邮件不存在或已被删除 (序列号: {email_id_str})，跳过标记已读")
-                    mail.logout()
-                    return False
-            except Exception as store_err:
-                # 如果SEARCH失败，尝试直接STORE（兼容旧格式）
-                try:
-                    status, response = mail.store(email_id_str, '+FLAGS', '\\Seen')
-                    if status == 'OK':
-                        print(f"✓ 邮件已标记为已读 (序列号: {email_id_str})")
-                        mail.logout()
-                        return True
-                    else:
-                        print(f"❌ 标记已读失败: {response}")
-                        print(f"   序列号: {email_id_str}, 类型: {type(email_id)}")
-                        mail.logout()
-                        return False
-                except Exception as e:
-                    print(f"❌ 标记邮件为已读时出错: {e}")
-                    print(f"   序列号: {email_id_str}, 类型: {type(email_id)}")
-                    mail.logout()
-                    return False
+            # 已被删除的UID会被服务器忽略，不需要事先 SEARCH
+            status, response = mail.uid('STORE', uid_set, '+FLAGS', '(\\Seen)')
+            mail.logout()
+            if status == 'OK':
+                print(f"✓ {len(uids)} 封邮件已标记为已读 (UID: {uid_set})")
+                return True
+            print(f"❌ 标记已读失败: {response}")
+            return False
             
         except Exception as e:
             print(f"❌ 标记邮件为已读时出错: {e}")
-            print(f"   邮件ID: {email_id}, 类型: {type(email_id)}")
+            print(f"   邮件UID: {uid_set}")
             import traceback
             print(traceback.format_exc())
+            if mail:
+                try:
+                    mail.logout()
+                except:
+                    pass
             return False
     
+    def queue_mark_as_read(self, email_id):
+        """
+        将邮件加入待标记已读队列（不立即连接IMAP）
+        
+        同一账号的标记请求会被合并，在 FLAG_FLUSH_DELAY 秒后或调用
+        flush_mark_as_read() 时通过一条 UID STORE 命令统一提交。
+        
+        @param email_id: 邮件的IMAP UID（bytes类型或字符串）
+        """
+        uid = _normalize_imap_id(email_id)
+        if not uid:
+            print(f"❌ 无效的邮件UID格式: {email_id}, 类型: {type(email_id)}")
+            return
+        
+        account = self.email_address
+        with _flag_queue_lock:
+            pending = _pending_seen_flags.setdefault(account, {'uids': set(), 'tools': self, 'timer': None, 'failures': 0})
+            pending['uids'].add(uid)
+            pending['tools'] = self
+            if pending['timer'] is None:
+                timer = threading.Timer(FLAG_FLUSH_DELAY, _flush_seen_flags, args=(account,))
+                timer.daemon = True
+                pending['timer'] = timer
+                timer.start()
+    
+    def flush_mark_as_read(self):
+        """
+        立即提交当前账号队列中所有待标记已读的邮件（批处理结束时调用）
+        
+        @return: 是否成功（队列为空时返回True）
+        """
+        return _flush_seen_flags(self.email_address)
+    
     def create_draft_reply(self, initial_email, reply_text):
         """
         发送邮件回复
@@ -318,65 +858,81 @@ class QQEmailToolsClass:
         result = self.send_reply(initial_email, reply_text)
         return result
     
+    def _get_smtp_pool(self):
+        """获取当前账号的SMTP会话池"""
+        return get_smtp_pool(self.smtp_server, self.smtp_port, self.email_address, self.auth_code, use_ssl=self.smtp_use_ssl)
+    
+    def _build_reply_message(self, initial_email, reply_text):
+        """
+        构建回复邮件
+        
+        @param initial_email: 原始邮件对象（需要有sender, subject, messageId, references属性）
+        @param reply_text: 回复内容
+        @return: (MIME邮件对象, 收件人地址)
+        @raise ValueError: 收件人地址无效
+        """
+        # 提取收件人邮箱地址（处理可能包含名称的格式，如 "名称 <email@example.com>"）
+        sender_email = initial_email.sender
+        if not sender_email:
+            print(f"❌ [发送邮件] 错误：收件人地址为空，原始邮件对象: {initial_email}")
+            raise ValueError("收件人地址为空，无法发送邮件")
+        
+        # 如果包含 < >，提取邮箱地址部分
+        if '<' in sender_email and '>' in sender_email:
+            try:
+                sender_email = sender_email.split('<')[1].split('>')[0].strip()
+            except (IndexError, AttributeError) as e:
+                print(f"❌ [发送邮件] 提取邮箱地址失败: {e}, 原始地址: {initial_email.sender}")
+                raise ValueError(f"无法从地址中提取邮箱: {initial_email.sender}")
+        
+        # 清理可能的空白字符
+        sender_email = sender_email.strip()
+        
+        # 验证邮箱地址格式
+        if not sender_email:
+            print(f"❌ [发送邮件] 错误：提取后的邮箱地址为空，原始地址: {initial_email.sender}")
+            raise ValueError(f"提取后的邮箱地址为空: {initial_email.sender}")
+        
+        if '@' not in sender_email:
+            print(f"❌ [发送邮件] 错误：邮箱地址格式无效（缺少@符号），地址: {sender_email}, 原始: {initial_email.sender}")
+            raise ValueError(f"无效的收件人地址格式（缺少@符号）: {sender_email}")
+        
+        print(f"📧 [发送邮件] 收件人地址: {sender_email}")
+        
+        # 创建回复邮件
+        msg = MIMEMultipart()
+        msg['From'] = self.email_address
+        msg['To'] = sender_email
+        msg['Subject'] = f"Re: {initial_email.subject}"
+        
+        # 设置回复相关的头信息
+        if initial_email.messageId:
+            msg['In-Reply-To'] = initial_email.messageId
+            if initial_email.references:
+                msg['References'] = initial_email.references
+            else:
+                msg['References'] = initial_email.messageId
+        
+        # 添加回复内容
+        msg.attach(MIMEText(reply_text, 'plain', 'utf-8'))
+        return msg, sender_email
+    
     def send_reply(self, initial_email, reply_text):
         """
-        发送回复邮件
+        发送回复邮件（复用账号的SMTP会话）
         
         @param initial_email: 原始邮件对象（需要有sender, subject, messageId, references, imap_id属性）
         @param reply_text: 回复内容
         @return: 是否成功
         """
+        if self._aborted:
+            print(f"⏹️ 邮箱操作已中断，不再发送回复")
+            return False
         try:
-            # 提取收件人邮箱地址（处理可能包含名称的格式，如 "名称 <email@example.com>"）
-            sender_email = initial_email.sender
-            if not sender_email:
-                print(f"❌ [发送邮件] 错误：收件人地址为空，原始邮件对象: {initial_email}")
-                raise ValueError("收件人地址为空，无法发送邮件")
-            
-            # 如果包含 < >，提取邮箱地址部分
-            if '<' in sender_email and '>' in sender_email:
-                try:
-                    sender_email = sender_email.split('<')[1].split('>')[0].strip()
-                except (IndexError, AttributeError) as e:
-                    print(f"❌ [发送邮件] 提取邮箱地址失败: {e}, 原始地址: {initial_email.sender}")
-                    raise ValueError(f"无法从地址中提取邮箱: {initial_email.sender}")
-            
-            # 清理可能的空白字符
-            sender_email = sender_email.strip()
-            
-            # 验证邮箱地址格式
-            if not sender_email:
-                print(f"❌ [发送邮件] 错误：提取后的邮箱地址为空，原始地址: {initial_email.sender}")
-                raise ValueError(f"提取后的邮箱地址为空: {initial_email.sender}")
-            
-            if '@' not in sender_email:
-                print(f"❌ [发送邮件] 错误：邮箱地址格式无效（缺少@符号），地址: {sender_email}, 原始: {initial_email.sender}")
-                raise ValueError(f"无效的收件人地址格式（缺少@符号）: {sender_email}")
-            
-            print(f"📧 [发送邮件] 收件人地址: {sender_email}")
-            
-            # 创建回复邮件
-            msg = MIMEMultipart()
-            msg['From'] = self.email_address
-            msg['To'] = sender_email
-            msg['Subject'] = f"Re: {initial_email.subject}"
-            
-            # 设置回复相关的头信息
-            if initial_email.messageId:
-                msg['In-Reply-To'] = initial_email.messageId
-                if initial_email.references:
-                    msg['References'] = initial_email.references
-                else:
-                    msg['References'] = initial_email.messageId
-            
-            # 添加回复内容
-            msg.attach(MIMEText(reply_text, 'plain', 'utf-8'))
+            msg, sender_email = self._build_reply_message(initial_email, reply_text)
             
             # 发送邮件
-            server = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port)
-            server.login(self.email_address, self.auth_code)
-            server.send_message(msg)
-            server.quit()
+            self._get_smtp_pool().send_message(msg)
             
             print(f"✓ 回复已发送给: {sender_email}")
             return True
@@ -0,0 +1,598 @@
+"""
+用户状态存储
+基于 SQLite（WAL 模式）保存每个用户的邮件缓存、历史记录、操作记录和统计数据，
+取代每次整体重写的 user_email_data_<id>.json。
+
+保存时只写入发生变化的行：
+- 从数据库加载的记录是 TrackedRecord（dict 子类），被修改时自动标记为脏
+- 运行时新建的 TrackedRecord（make_email_record）插入后同样由表跟踪，之后只在被修改时写入
+- 运行时新建的普通 dict 通过身份映射跟踪，按序列化结果比较是否变化（每次保存都要序列化）
+- 列表中不再出现的记录对应的行会被删除
+"""
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+
+# 默认统计数据
+DEFAULT_STATS = {
+    "today_emails": 0,
+    "processed": 0,
+    "pending": 0,
+    "failed": 0
+}
+
+# 保存在 meta 表中的 SystemState 标量字段及默认值
+META_DEFAULTS = {
+    "last_check_time": None,
+    "is_running": False,
+    "auto_process": False,
+    "check_interval": 900,
+    "last_save_time": None,
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS emails (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    email_id TEXT,
+    status TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_emails_email_id ON emails(email_id);
+CREATE INDEX IF NOT EXISTS idx_emails_status ON emails(status);
+
+CREATE TABLE IF NOT EXISTS history (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    email_id TEXT,
+    status TEXT,
+    category TEXT,
+    time TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_history_email_id ON history(email_id);
+CREATE INDEX IF NOT EXISTS idx_history_status ON history(status);
+CREATE INDEX IF NOT EXISTS idx_history_category ON history(category);
+CREATE INDEX IF NOT EXISTS idx_history_time ON history(time);
+
+CREATE TABLE IF NOT EXISTS activities (
+    seq INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS stats (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+
+CREATE TABLE IF NOT EXISTS send_queue (
+    email_id TEXT PRIMARY KEY,
+    enqueued_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS send_log (
+    sent_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_send_log_sent_at ON send_log(sent_at);
+"""
+
+
+def _dumps(value) -> str:
+    """与原 JSON 文件一致的序列化方式（不可序列化的对象转为字符串）"""
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+class TrackedRecord(dict):
+    """
+    可跟踪修改的记录
+
+    行为与普通 dict 完全一致，额外记录所属的表、行号以及自上次保存以来是否被修改；
+    设置了 _watcher 时，每次修改后都会回调（用于维护 EmailCollection 的索引）。
+    """
+
+    __slots__ = ('_owner', '_rowid', '_dirty', '_watcher')
+
+    def __init__(self, data=(), owner=None, rowid=None):
+        super().__init__(data)
+        self._owner = owner
+        self._rowid = rowid
+        self._dirty = False
+        self._watcher = None
+
+    def _changed(self):
+        watcher = self._watcher
+        if watcher is not None:
+            watcher(self)
+
+    def __setitem__(self, key, value):
+        self._dirty = True
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        self._dirty = True
+        super().__delitem__(key)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        self._dirty = True
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self._dirty = True
+        value = super().setdefault(key, default)
+        self._changed()
+        return value
+
+    def pop(self, *args):
+        self._dirty = True
+        value = super().pop(*args)
+        self._changed()
+        return value
+
+    def popitem(self):
+        self._dirty = True
+        item = super().popitem()
+        self._changed()
+        return item
+
+    def clear(self):
+        self._dirty = True
+        super().clear()
+        self._changed()
+
+    def __ior__(self, other):
+        self._dirty = True
+        super().__ior__(other)
+        self._changed()
+        return self
+
+    def __reduce__(self):
+        # 拷贝/序列化时退化为普通 dict
+        return (dict, (dict(self),))
+
+
+class _RecordTable:
+    """
+    一张记录表（emails 或 history）的变更跟踪
+
+    @param name: 表名
+    @param newest_first: 列表是否按新到旧排列（history 使用 insert(0, ...)）
+    """
+
+    def __init__(self, name: str, newest_first: bool = False):
+        self.name = name
+        self.newest_first = newest_first
+        self.generation = 0
+        self.rowids = set()
+        # 运行时新建的普通 dict：id(obj) -> (obj, rowid, 序列化结果)
+        self.plain: Dict[int, tuple] = {}
+        self._pending = None
+
+    @property
+    def owner(self):
+        return (self.name, self.generation)
+
+    def reset(self):
+        """重新加载后丢弃旧的跟踪信息"""
+        self.generation += 1
+        self.rowids = set()
+        self.plain = {}
+        self._pending = None
+
+    def columns(self, record: dict) -> tuple:
+        """提取需要建立索引的列"""
+        email_id = record.get('id')
+        status = record.get('status')
+        if self.name == 'history':
+            time_value = record.get('processed_time') or record.get('timestamp') or record.get('date')
+            return (
+                str(email_id) if email_id is not None else None,
+                status,
+                record.get('category'),
+                str(time_value) if time_value is not None else None,
+            )
+        return (str(email_id) if email_id is not None else None, status)
+
+    def insert(self, conn, record: dict, payload: str) -> int:
+        if self.name == 'history':
+            cur = conn.execute(
+                "INSERT INTO history (email_id, status, category, time, data) VALUES (?, ?, ?, ?, ?)",
+                self.columns(record) + (payload,)
+            )
+        else:
+            cur = conn.execute(
+                "INSERT INTO emails (email_id, status, data) VALUES (?, ?, ?)",
+                self.columns(record) + (payload,)
+            )
+        return cur.lastrowid
+
+    def update(self, conn, rowid: int, record: dict, payload: str):
+        if self.name == 'history':
+            conn.execute(
+                "UPDATE history SET email_id = ?, status = ?, category = ?, time = ?, data = ? WHERE seq = ?",
+                self.columns(record) + (payload, rowid)
+            )
+        else:
+            conn.execute(
+                "UPDATE emails SET email_id = ?, status = ?, data = ? WHERE seq = ?",
+                self.columns(record) + (payload, rowid)
+            )
+
+    def load(self, conn) -> List[dict]:
+        """加载全部记录，保持原列表顺序"""
+        self.reset()
+        order = "DESC" if self.newest_first else "ASC"
+        records = []
+        for rowid, data in conn.execute(f"SELECT seq, data FROM {self.name} ORDER BY seq {order}"):
+            try:
+                value = json.loads(data)
+            except ValueError:
+                continue
+            records.append(TrackedRecord(value, owner=self.owner, rowid=rowid))
+            self.rowids.add(rowid)
+        return records
+
+    def save(self, conn, records: List[dict]) -> int:
+        """
+        把列表中的变化写入数据库
+
+        @param conn: 数据库连接（调用方负责事务）
+        @param records: 当前内存中的记录列表
+        @return: 写入（插入/更新/删除）的行数
+        """
+        written = 0
+        seen = set()
+        plain = {}
+        cleaned = []
+        # 本次插入、提交后归本表跟踪的 TrackedRecord：id(obj) -> (obj, rowid)
+        adopted = {}
+        # 新记录按时间顺序插入，保证自增序号与列表顺序一致
+        ordered = reversed(records) if self.newest_first else records
+        for record in list(ordered):
+            if not isinstance(record, dict):
+                continue
+            if (isinstance(record, TrackedRecord) and record._owner == self.owner
+                    and record._rowid in self.rowids and record._rowid not in seen):
+                seen.add(record._rowid)
+                if record._dirty:
+                    # 先清除标记再序列化，序列化期间的并发修改会在下次保存时写入
+                    record._dirty = False
+                    cleaned.append(record)
+                    self.update(conn, record._rowid, record, _dumps(record))
+                    written += 1
+                continue
+
+            key = id(record)
+            if key in plain or key in adopted:
+                continue
+            if isinstance(record, TrackedRecord) and record._owner is None:
+                record._dirty = False
+                rowid = self.insert(conn, record, _dumps(record))
+                written += 1
+                seen.add(rowid)
+                adopted[key] = (record, rowid)
+                continue
+            payload = _dumps(record)
+            known = self.plain.get(key)
+            if known is not None and known[0] is record and known[1] not in seen:
+                rowid = known[1]
+                if known[2] != payload:
+                    self.update(conn, rowid, record, payload)
+                    written += 1
+            else:
+                rowid = self.insert(conn, record, payload)
+                written += 1
+            seen.add(rowid)
+            plain[key] = (record, rowid, payload)
+
+        removed = self.rowids - seen
+        if removed:
+            conn.executemany(f"DELETE FROM {self.name} WHERE seq = ?", [(rowid,) for rowid in removed])
+            written += len(removed)
+        self._pending = (seen, plain, cleaned, list(adopted.values()))
+        return written
+
+    def commit(self):
+        """事务提交后应用本次保存的跟踪信息"""
+        pending = self._pending
+        if pending is not None:
+            self.rowids, self.plain, _, adopted = pending
+            for record, rowid in adopted:
+                if record._owner is None:
+                    record._owner = self.owner
+                    record._rowid = rowid
+            self._pending = None
+
+    def rollback(self):
+        """事务回滚后恢复被清除的脏标记"""
+        pending = self._pending
+        if pending is not None:
+            for record in pending[2]:
+                record._dirty = True
+            for record, _ in pending[3]:
+                record._dirty = True
+            self._pending = None
+
+
+class UserStateStore:
+    """
+    单个用户的 SQLite 状态存储
+
+    @param db_path: 数据库文件路径
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._conn: Optional[sqlite3.Connection] = None
+        self._emails = _RecordTable('emails')
+        self._history = _RecordTable('history', newest_first=True)
+        self._activities_payload = None
+        self._stats_payload: Dict[str, str] = {}
+        self._meta_payload: Dict[str, str] = {}
+
+    # ==================== 连接管理 ====================
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def exists(self) -> bool:
+        """数据库文件是否已存在"""
+        return os.path.exists(self.db_path)
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.close()
+                except Exception:
+                    pass
+                self._conn = None
+
+    # ==================== 读取 ====================
+
+    def load(self) -> dict:
+        """
+        加载用户全部状态
+
+        @return: 与原 JSON 文件结构相同的字典
+        """
+        with self._lock:
+            conn = self._connect()
+            emails_cache = self._emails.load(conn)
+            history = self._history.load(conn)
+
+            activities = []
+            self._activities_payload = None
+            rows = conn.execute("SELECT data FROM activities ORDER BY seq ASC").fetchall()
+            for (data,) in rows:
+                try:
+                    activities.append(json.loads(data))
+                except ValueError:
+                    continue
+            self._activities_payload = _dumps(activities)
+
+            stats = dict(DEFAULT_STATS)
+            self._stats_payload = {}
+            for key, value in conn.execute("SELECT key, value FROM stats"):
+                self._stats_payload[key] = value
+                stats[key] = json.loads(value)
+
+            meta = dict(META_DEFAULTS)
+            self._meta_payload = {}
+            for key, value in conn.execute("SELECT key, value FROM meta"):
+                self._meta_payload[key] = value
+                meta[key] = json.loads(value)
+
+        return {
+            "emails_cache": emails_cache,
+            "history": history,
+            "activities": activities,
+            "stats": stats,
+            **meta
+        }
+
+    # ==================== 写入 ====================
+
+    def save(self, user_state, **meta) -> int:
+        """
+        保存用户状态，只写入发生变化的行
+
+        @param user_state: SystemState 对象（读取 emails_cache/history/activities/stats 等属性）
+        @param meta: 额外需要覆盖的标量字段（如 is_running=False）
+        @return: 写入的行数
+        """
+        values = {key: getattr(user_state, key, default) for key, default in META_DEFAULTS.items()}
+        values.update(meta)
+        return self.save_data({
+            "emails_cache": list(user_state.emails_cache),
+            "history": list(user_state.history),
+            "activities": list(user_state.activities),
+            "stats": dict(user_state.stats),
+            **values
+        })
+
+    def save_data(self, data: dict) -> int:
+        """
+        保存与 JSON 文件结构相同的字典
+
+        @param data: 包含 emails_cache/history/activities/stats 及标量字段的字典
+        @return: 写入的行数
+        """
+        with self._lock:
+            conn = self._connect()
+            written = 0
+            saved = dict(self._stats_payload), dict(self._meta_payload), self._activities_payload
+            conn.execute("BEGIN")
+            try:
+                written += self._emails.save(conn, data.get("emails_cache") or [])
+                written += self._history.save(conn, data.get("history") or [])
+
+                # 操作记录最多50条，有变化时整体重写
+                activities = data.get("activities") or []
+                payload = _dumps(activities)
+                if payload != self._activities_payload:
+                    conn.execute("DELETE FROM activities")
+                    conn.executemany(
+                        "INSERT INTO activities (seq, data) VALUES (?, ?)",
+                        [(i, _dumps(a)) for i, a in enumerate(activities)]
+                    )
+                    written += len(activities) + 1
+                    self._activities_payload = payload
+
+                written += self._save_key_values(conn, "stats", data.get("stats") or {}, self._stats_payload)
+                meta = {key: data.get(key, default) for key, default in META_DEFAULTS.items()}
+                written += self._save_key_values(conn, "meta", meta, self._meta_payload)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                # 数据库已回滚，内存中的跟踪信息也恢复到保存前
+                self._emails.rollback()
+                self._history.rollback()
+                self._stats_payload, self._meta_payload, self._activities_payload = saved
+                raise
+            self._emails.commit()
+            self._history.commit()
+        return written
+
+    @staticmethod
+    def _save_key_values(conn, table: str, values: dict, known: Dict[str, str]) -> int:
+        written = 0
+        for key, value in values.items():
+            payload = _dumps(value)
+            if known.get(key) != payload:
+                conn.execute(f"INSERT OR REPLACE INTO {table} (key, value) VALUES (?, ?)", (key, payload))
+                known[key] = payload
+                written += 1
+        for key in [k for k in known if k not in values]:
+            conn.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+            del known[key]
+            written += 1
+        return written
+
+    # ==================== 发送队列 ====================
+
+    def load_send_queue(self) -> List[tuple]:
+        """
+        读取待发送队列
+
+        @return: [(邮件ID, 入队时间戳), ...]，按入队时间排序
+        """
+        with self._lock:
+            conn = self._connect()
+            return conn.execute("SELECT email_id, enqueued_at FROM send_queue ORDER BY enqueued_at ASC").fetchall()
+
+    def add_send_queue_item(self, email_id: str, enqueued_at: float):
+        """把邮件加入待发送队列（已存在时忽略）"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR IGNORE INTO send_queue (email_id, enqueued_at) VALUES (?, ?)", (email_id, enqueued_at))
+
+    def update_send_queue_item(self, email_id: str, enqueued_at: float):
+        """更新邮件的入队时间（移到队尾）"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("UPDATE send_queue SET enqueued_at = ? WHERE email_id = ?", (enqueued_at, email_id))
+
+    def delete_send_queue_item(self, email_id: str):
+        """把邮件移出待发送队列"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM send_queue WHERE email_id = ?", (email_id,))
+
+    def load_send_log(self, since: float) -> List[float]:
+        """
+        读取某个时间之后的发送记录（用于恢复速率限制）
+
+        @param since: 时间戳
+        @return: 发送时间戳列表（升序）
+        """
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute("SELECT sent_at FROM send_log WHERE sent_at > ? ORDER BY sent_at ASC", (since,)).fetchall()
+            return [row[0] for row in rows]
+
+    def add_send_log(self, sent_at: float, prune_before: float):
+        """
+        记录一次发送，并删除不再影响速率限制的旧记录
+
+        @param sent_at: 发送时间戳
+        @param prune_before: 早于该时间的记录会被删除
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN")
+            try:
+                conn.execute("INSERT INTO send_log (sent_at) VALUES (?)", (sent_at,))
+                conn.execute("DELETE FROM send_log WHERE sent_at < ?", (prune_before,))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    # ==================== 迁移 ====================
+
+    def migrate_from_json(self, json_path: str) -> Optional[dict]:
+        """
+        从旧的 JSON 文件一次性迁移数据，迁移成功后将原文件重命名为 .migrated 备份
+
+        @param json_path: JSON 文件路径
+        @return: 迁移后加载的数据，失败时返回 None
+        """
+        with self._lock:
+            with open(json_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # 插入顺序决定自增序号：history 需要从最旧的记录开始插入
+            self._emails.reset()
+            self._history.reset()
+            self.save_data({**data, "is_running": False})
+            os.replace(json_path, json_path + ".migrated")
+            print(f"✓ [数据迁移] {json_path} -> {self.db_path}（原文件已备份为 .migrated）")
+            return self.load()
+
+
+# 每个数据库文件共用一个存储对象（保持跟踪信息和连接）
+_stores: Dict[str, UserStateStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_user_store(db_path: str) -> UserStateStore:
+    """
+    获取（或创建）指定数据库文件的存储对象
+
+    @param db_path: 数据库文件路径
+    @return: UserStateStore 实例
+    """
+    key = os.path.abspath(db_path)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = UserStateStore(db_path)
+            _stores[key] = store
+        return store
+
+
+def close_all_user_stores():
+    """关闭所有数据库连接（应用关闭时调用）"""
+    with _stores_lock:
+        stores = list(_stores.values())
+    for store in stores:
+        store.close()
@@ -0,0 +1,217 @@
+"""
+处理任务调度器
+所有用户的邮件处理任务（自动处理、处理全部、单封处理）共用一组数量固定的工作线程：
+每个用户按任务类型各有一个队列和并发上限，空闲线程在有排队任务的用户之间轮转取任务，
+一个用户积压大量邮件时，其他用户的新任务在下一个空闲线程上就能开始。
+队列内按优先级（如回复截止时间）从小到大取任务，未指定优先级的任务按提交顺序排在最后。
+"""
+import heapq
+import itertools
+import math
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from typing import Callable, Dict, Hashable, Optional
+
+
+class _Lane:
+    """一个用户某类任务的队列"""
+
+    __slots__ = ('queue', 'running', 'cap')
+
+    def __init__(self, cap: int):
+        # 小顶堆：(优先级, 提交序号, 任务)
+        self.queue = []
+        self.running = 0
+        self.cap = cap
+
+
+class _Owner:
+    """一个用户的全部队列"""
+
+    __slots__ = ('lanes', 'running', 'queued')
+
+    def __init__(self):
+        # 任务类型 -> _Lane，同一用户的各类任务也轮流取
+        self.lanes: "OrderedDict[str, _Lane]" = OrderedDict()
+        self.running = 0
+        self.queued = 0
+
+
+class FairShareScheduler:
+    """
+    按用户公平调度的有界线程池
+
+    - 线程总数固定为 workers（按需创建，不会因为用户设置变化而重建线程池）
+    - 每个 (用户, 任务类型) 一个优先队列，并发上限由提交时的 cap 指定（如 batchSize）；
+      优先级相同时先提交先执行，新提交的高优先级任务排到已排队任务前面，但不打断执行中的任务
+    - 空闲线程按轮转顺序从下一个有可执行任务的用户取一个任务，各用户轮流获得线程
+    - 单个用户最多占用 workers - reserved 个线程，保证其他用户的任务不必等积压的用户
+    """
+
+    def __init__(self, workers: int, reserved: Optional[int] = None, name: str = "pipeline"):
+        """
+        @param workers: 工作线程总数
+        @param reserved: 单个用户不能占用、留给其他用户的线程数，默认 workers // 4
+        @param name: 线程名前缀
+        """
+        self.workers = max(1, int(workers))
+        if reserved is None:
+            reserved = self.workers // 4
+        self.reserved = max(0, min(int(reserved), self.workers - 1))
+        self.name = name
+        self._cond = threading.Condition()
+        self._owners: Dict[Hashable, _Owner] = {}
+        # 有排队任务的用户（轮转顺序）
+        self._ring = deque()
+        self._threads = []
+        self._idle = 0
+        self._stopped = False
+        self._seq = itertools.count()
+        self.counters = {'submitted': 0, 'completed': 0, 'failed': 0, 'cancelled': 0}
+
+    @property
+    def owner_limit(self) -> int:
+        """单个用户最多同时占用的线程数"""
+        return self.workers - self.reserved
+
+    # ==================== 提交 ====================
+
+    def submit(self, owner: Hashable, kind: str, fn: Callable, *args, cap: int = 1,
+               priority: Optional[float] = None, **kwargs) -> Future:
+        """
+        提交一个任务
+
+        @param owner: 任务所属用户
+        @param kind: 任务类型，如 'batch'、'single'；同一用户的每类任务单独限制并发
+        @param fn: 任务函数
+        @param cap: 该用户该类任务的并发上限（以最近一次提交为准）
+        @param priority: 优先级，越小越先执行（如截止时间戳），None 排在最后
+        @return: Future
+        """
+        future = Future()
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("调度器已关闭")
+            entry = self._owners.get(owner)
+            if entry is None:
+                entry = self._owners[owner] = _Owner()
+            lane = entry.lanes.get(kind)
+            if lane is None:
+                lane = entry.lanes[kind] = _Lane(cap)
+            lane.cap = max(1, int(cap))
+            key = math.inf if priority is None else priority
+            heapq.heappush(lane.queue, (key, next(self._seq), (future, fn, args, kwargs)))
+            if entry.queued == 0:
+                self._ring.append(owner)
+            entry.queued += 1
+            self.counters['submitted'] += 1
+            if self._idle == 0 and len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, daemon=True,
+                                          name=f"{self.name}_{len(self._threads)}")
+                self._threads.append(thread)
+                thread.start()
+            else:
+                self._cond.notify()
+        return future
+
+    # ==================== 取任务 ====================
+
+    def _pick(self):
+        """轮转选出下一个可执行的任务（调用方持有锁）"""
+        for _ in range(len(self._ring)):
+            owner = self._ring[0]
+            self._ring.rotate(-1)
+            entry = self._owners[owner]
+            if entry.running >= self.owner_limit:
+                continue
+            for _ in range(len(entry.lanes)):
+                kind, lane = next(iter(entry.lanes.items()))
+                entry.lanes.move_to_end(kind)
+                if lane.queue and lane.running < lane.cap:
+                    task = heapq.heappop(lane.queue)[2]
+                    lane.running += 1
+                    entry.running += 1
+                    entry.queued -= 1
+                    if entry.queued == 0:
+                        self._ring.remove(owner)
+                    return owner, kind, task
+        return None
+
+    def _finish(self, owner, kind):
+        """任务结束后释放并发名额（调用方持有锁）"""
+        entry = self._owners[owner]
+        lane = entry.lanes[kind]
+        lane.running -= 1
+        entry.running -= 1
+        if not lane.queue and lane.running == 0:
+            del entry.lanes[kind]
+            if not entry.lanes:
+                del self._owners[owner]
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    picked = self._pick()
+                    if picked is not None:
+                        break
+                    self._idle += 1
+                    self._cond.wait()
+                    self._idle -= 1
+            owner, kind, (future, fn, args, kwargs) = picked
+            failed = False
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    failed = True
+                    future.set_exception(e)
+                outcome = 'failed' if failed else 'completed'
+            else:
+                outcome = 'cancelled'
+            with self._cond:
+                self.counters[outcome] += 1
+                self._finish(owner, kind)
+                # 释放的名额可能让其他线程等待中的任务变为可执行
+                self._cond.notify()
+
+    # ==================== 状态与关闭 ====================
+
+    def get_stats(self, owner: Optional[Hashable] = None) -> dict:
+        """
+        调度器状态
+
+        @param owner: 只返回该用户的队列明细，None 表示不返回明细
+        @return: {'workers', 'threads', 'busy', 'queued', 'owners', 计数器..., 'lanes'}
+        """
+        with self._cond:
+            stats = {
+                'workers': self.workers,
+                'owner_limit': self.owner_limit,
+                'threads': len(self._threads),
+                'busy': len(self._threads) - self._idle,
+                'queued': sum(entry.queued for entry in self._owners.values()),
+                'owners': len(self._owners),
+                **self.counters,
+            }
+            entry = self._owners.get(owner) if owner is not None else None
+            stats['lanes'] = {
+                kind: {'queued': len(lane.queue), 'running': lane.running, 'cap': lane.cap}
+                for kind, lane in (entry.lanes.items() if entry else ())
+            }
+        return stats
+
+    def shutdown(self):
+        """停止调度（应用关闭时调用）：取消排队中的任务，正在执行的任务不等待"""
+        with self._cond:
+            self._stopped = True
+            for entry in self._owners.values():
+                for lane in entry.lanes.values():
+                    for _, _, (future, _, _, _) in lane.queue:
+                        future.cancel()
+                    lane.queue.clear()
+            self._ring.clear()
+            self._cond.notify_all()